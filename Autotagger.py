@@ -1,75 +1,237 @@
 import sys
-import json
 import os
+import time
 import threading
-import platform
+import multiprocessing
+
+STARTUP_TIME = time.perf_counter()  # --startup-timing counts from here
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    if sys.argv[1:2] == ['--batch']:
+        # No window: the rest of the command line goes to the command-line tagger (python -m tagger --help),
+        # before any widget code is even imported
+        argv = [arg for arg in sys.argv[2:] if arg != '--startup-timing']
+        from tagger.cli import main
+        if len(argv) < len(sys.argv) - 2:
+            print(f"Startup: {(time.perf_counter() - STARTUP_TIME) * 1000:.0f} ms until tagging starts", file=sys.stderr)
+        sys.exit(main(argv))
+
 from PyQt5.QtWidgets import (
     QApplication, QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QLabel, QSlider, QComboBox,
     QLineEdit, QColorDialog, QMessageBox, QCheckBox, QFileDialog, QGroupBox, QProgressBar,
-    QListWidget, QPlainTextEdit, QListWidgetItem, QMenu
+    QListWidget, QListWidgetItem, QMenu, QTableView, QHeaderView, QAbstractItemView, QInputDialog
 )
-from PyQt5.QtCore import Qt, QRect, QTimer, QThreadPool, QRunnable, pyqtSlot, pyqtSignal, QObject, QPoint
-from PyQt5.QtGui import QPixmap, QPainter, QImage, QFont, QColor, QFontDatabase, QMouseEvent, QTextCursor
+from PyQt5.QtCore import (
+    Qt, QTimer, QThread, pyqtSignal, QPoint, QAbstractListModel, QModelIndex, QSortFilterProxyModel
+)
+from PyQt5.QtGui import QPixmap, QImage, QColor, QFontDatabase, QMouseEvent
 
-class WorkerSignals(QObject):
-    progress = pyqtSignal(int, int)  # current, total
-    status_update = pyqtSignal(str, str)  # file_path, status
+from tagger import ProgressChannel, RunReport, TagSettings, TaggingEngine, applyTextToImage, downsizeImageToSmallestSide
+from tagger.autotune import TuningStore, defaultTuningPath
+from tagger.discovery import scanSubfolders
+from tagger.template import TEMPLATE_FIELDS, TemplateValues, compileTemplate
+from tagger.settings import PROFILE_FIELDS, ConfigWriter, defaultConfigPath, loadConfigFile
 
-class ImageProcessorRunnable(QRunnable):
-    def __init__(self, file_path, parent):
-        super().__init__()
-        self.file_path = file_path
-        self.parent = parent
-        self.signals = WorkerSignals()
+IMPORTS_DONE = time.perf_counter()
+
+class EngineBatchThread(QThread):
+    # Drives a TaggingEngine off the GUI thread: discovery, tagging and the manifest all run in the engine,
+    # and status reaches the GUI only through the engine's ProgressChannel
+    def __init__(self, engine, folders, includeSubfolders, parent=None):
+        super().__init__(parent)
+        self.engine = engine
+        self.folders = folders
+        self.includeSubfolders = includeSubfolders
 
-    @pyqtSlot()
     def run(self):
-        try:
-            self.signals.status_update.emit(self.file_path, 'processing')
-            image = QImage(self.file_path)
-            if image.isNull():
-                raise Exception("Failed to load image.")
-
-            if self.parent.downsizeCheckBox.isChecked():
-                image = self.parent.downsizeImageToSmallestSide(image)
-            modifiedImage = self.parent.applyTextToImage(image)
-
-            output_folder = os.path.join(os.path.dirname(self.file_path), "tagged")
-            os.makedirs(output_folder, exist_ok=True)
-            output_path = os.path.join(output_folder, os.path.basename(self.file_path))
-            modifiedImage.save(output_path)
-
-            self.signals.status_update.emit(self.file_path, 'success')
-        except Exception:
-            self.signals.status_update.emit(self.file_path, 'failed')
-        finally:
-            with self.parent.lock:
-                self.parent.completed_tasks += 1
-                self.signals.progress.emit(self.parent.completed_tasks, self.parent.total_files)
+        for _ in self.engine.processFolders(self.folders, self.includeSubfolders):
+            pass
+
+class FolderScanThread(QThread):
+    foldersFound = pyqtSignal(list)
+
+    def __init__(self, folder, parent=None):
+        super().__init__(parent)
+        self.folder = folder
+
+    def run(self):
+        self.foldersFound.emit(scanSubfolders(self.folder))
+
+class FileStatusModel(QAbstractListModel):
+    # One row per file; the view only asks for the rows it paints, so a million files stay cheap to show
+    STATUSES = ('pending', 'processing', 'success', 'failed', 'skipped', 'cancelled')
+    STATUS_COLORS = {
+        'pending': QColor(255, 255, 255),
+        'processing': QColor(255, 255, 224),
+        'success': QColor(144, 238, 144),
+        'failed': QColor(255, 102, 102),
+        'skipped': QColor(170, 170, 170),
+        'cancelled': QColor(255, 200, 140),
+    }
+    StatusRole = Qt.UserRole + 1
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.paths = []
+        self.statuses = []
+        self.rows = {}
+        self.counts = dict.fromkeys(self.STATUSES, 0)
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.paths)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        status = self.statuses[index.row()]
+        if role == Qt.DisplayRole:
+            return f"{self.paths[index.row()]} - {status.capitalize()}"
+        if role == Qt.ForegroundRole:
+            return self.STATUS_COLORS.get(status, QColor(255, 255, 255))
+        if role == self.StatusRole:
+            return status
+        return None
+
+    def clear(self):
+        self.beginResetModel()
+        self.paths, self.statuses, self.rows = [], [], {}
+        self.counts = dict.fromkeys(self.STATUSES, 0)
+        self.endResetModel()
+
+    def applyUpdates(self, updates):
+        # updates: {file_path: status}, already coalesced; new files are appended in one insert
+        new_paths = [file_path for file_path in updates if file_path not in self.rows]
+        changed_rows = []
+        for file_path, status in updates.items():
+            row = self.rows.get(file_path)
+            if row is None:
+                continue
+            old_status = self.statuses[row]
+            if old_status != status:
+                self.counts[old_status] = self.counts.get(old_status, 0) - 1
+                self.counts[status] = self.counts.get(status, 0) + 1
+                self.statuses[row] = status
+                changed_rows.append(row)
+        # One dataChanged per contiguous run, so a filter proxy never re-checks rows that did not change
+        changed_rows.sort()
+        start = previous = None
+        for row in changed_rows:
+            if start is None:
+                start = previous = row
+            elif row == previous + 1:
+                previous = row
+            else:
+                self.dataChanged.emit(self.index(start), self.index(previous))
+                start = previous = row
+        if start is not None:
+            self.dataChanged.emit(self.index(start), self.index(previous))
+        if new_paths:
+            first = len(self.paths)
+            self.beginInsertRows(QModelIndex(), first, first + len(new_paths) - 1)
+            for file_path in new_paths:
+                status = updates[file_path]
+                self.rows[file_path] = len(self.paths)
+                self.paths.append(file_path)
+                self.statuses.append(status)
+                self.counts[status] = self.counts.get(status, 0) + 1
+            self.endInsertRows()
+
+class StatusFilterModel(QSortFilterProxyModel):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.statuses = None  # None shows every row
+
+    def setStatuses(self, statuses):
+        self.statuses = statuses
+        self.invalidateFilter()
+
+    def filterAcceptsRow(self, source_row, source_parent):
+        return self.statuses is None or self.sourceModel().statuses[source_row] in self.statuses
+
+class FontComboBox(QComboBox):
+    # Holds only the current family until the list is first opened, scrolled or typed in: enumerating
+    # thousands of installed fonts can take seconds, which would otherwise all happen before the window appears
+    def __init__(self, fontFamily, parent=None):
+        super().__init__(parent)
+        self.addItem(fontFamily)
+        self.filled = False
+
+    def fill(self):
+        if self.filled:
+            return
+        self.filled = True
+        current = self.currentText()
+        self.blockSignals(True)
+        self.clear()
+        self.addItems(QFontDatabase().families())
+        if self.findText(current) < 0:
+            self.insertItem(0, current)  # not installed here, but still the configured font
+        self.setCurrentText(current)
+        self.blockSignals(False)
+
+    def showPopup(self):
+        self.fill()
+        super().showPopup()
+
+    def keyPressEvent(self, event):
+        self.fill()
+        super().keyPressEvent(event)
+
+    def wheelEvent(self, event):
+        self.fill()
+        super().wheelEvent(event)
+
+
+def describeStartup(timings):
+    return (f"Startup: first window after {timings['first window'] * 1000:.0f} ms (imports {timings['imports'] * 1000:.0f} ms, "
+            f"window {timings['window'] * 1000:.0f} ms); panels and clipboard {timings['deferred'] * 1000:.0f} ms later")
+
 
 class AutoTagger(QWidget):
-    def __init__(self):
+    # Status changes are buffered and pushed into the list model at this fixed rate
+    STATUS_REFRESH_INTERVAL_MS = 100
+    PREVIEW_DEBOUNCE_MS = 60
+    PREVIEW_MAX_HEIGHT = 500
+    EXECUTION_MODES = (
+        ("Threads", 'thread'),
+        ("Worker Processes (one per CPU core)", 'process'),
+        ("Read / Render / Write Pipeline", 'pipeline'),
+        ("Distributed Workers (python -m tagger --worker)", 'distributed'),
+    )
+    STATUS_FILTERS = (
+        ("All Files", None),
+        ("Failed Only", ('failed',)),
+        ("In Progress", ('pending', 'processing')),
+        ("Finished", ('success', 'skipped', 'cancelled')),
+    )
+
+    def __init__(self, reportStartup=False):
         super().__init__()
-        self.threadPool = QThreadPool()
-        self.threadCount = 10
+        self.startupTimings = {'imports': IMPORTS_DONE - STARTUP_TIME}
+        self.reportStartup = reportStartup  # print the startup timings to stderr once the window is complete
+        started = time.perf_counter()
+        self.settings = TagSettings()
+        self.configPath = defaultConfigPath()
+        # Saves are coalesced and written off the GUI thread; closeEvent flushes what is still pending
+        self.configWriter = ConfigWriter(self.configPath)
 
-        # Determine config path based on platform
-        if platform.system() == 'Windows':
-            self.configPath = os.path.join(os.getenv('APPDATA'), 'AutoTagger', 'config.json')
-        else:
-            self.configPath = os.path.join(os.path.expanduser('~'), '.config', 'AutoTagger', 'config.json')
-        
         self.selectedFolders = []
-        self.completed_tasks = 0
-        self.total_files = 0
-        self.lock = threading.Lock()
-        self.file_status = {}
+        self.progressChannel = None
+        self.batchEngine = None
+        self.batchReport = None
+        self.batchThread = None
+        self.folderScanThreads = []
 
         self.loadConfig()
         self.lastImage = None
+        self.clipboardImage = QImage()
+        self.previewKey = None
+        self.previewBase = None
         self.initUI()
         self.initTimer()
         self.offset = None
+        self.startupTimings['window'] = time.perf_counter() - started
 
     def initUI(self):
         self.setWindowTitle('Auto Tagger')
@@ -135,7 +297,7 @@ class AutoTagger(QWidget):
                 border: none;
                 color: #f0f0f0;
             }
-            QPlainTextEdit {
+            QTableView {
                 background-color: #3a3a3a;
                 border: 1px solid #505050;
                 color: #f0f0f0;
@@ -191,7 +353,9 @@ class AutoTagger(QWidget):
 
         self.textInput = QLineEdit(self)
         self.textInput.setPlaceholderText("Enter your text here...")
-        self.textInput.setText(self.customText)
+        self.textInput.setText(self.settings.customText)
+        self.textInput.setToolTip("Fields filled in per image, e.g. {name} {date:%Y-%m-%d} #{index:03d}:\n" +
+                                  "\n".join(f"{{{field}}}  {meaning}" for field, meaning in TEMPLATE_FIELDS.items()))
         self.textInput.textChanged.connect(self.updateCustomText)
         mainLayout.addWidget(self.textInput)
 
@@ -200,9 +364,7 @@ class AutoTagger(QWidget):
         self.colorPickerButton.clicked.connect(self.pickTextColor)
         fontControlsLayout.addWidget(self.colorPickerButton)
 
-        self.fontComboBox = QComboBox(self)
-        self.fontComboBox.addItems(QFontDatabase().families())
-        self.fontComboBox.setCurrentText(self.fontFamily)
+        self.fontComboBox = FontComboBox(self.settings.fontFamily, self)
         self.fontComboBox.currentTextChanged.connect(self.updateFontFamily)
         fontControlsLayout.addWidget(self.fontComboBox)
 
@@ -212,7 +374,7 @@ class AutoTagger(QWidget):
         fontSizeLayout.addWidget(QLabel('Font Size:'))
         self.fontSizeSlider = QSlider(Qt.Horizontal, self)
         self.fontSizeSlider.setRange(10, 100)
-        self.fontSizeSlider.setValue(self.fontSize)
+        self.fontSizeSlider.setValue(self.settings.fontSize)
         self.fontSizeSlider.setTickInterval(5)
         self.fontSizeSlider.setTickPosition(QSlider.TicksBelow)
         self.fontSizeSlider.valueChanged.connect(self.updateFontSize)
@@ -223,7 +385,7 @@ class AutoTagger(QWidget):
         textYOffsetLayout.addWidget(QLabel('Text Vertical Offset:'))
         self.textYOffsetSlider = QSlider(Qt.Horizontal, self)
         self.textYOffsetSlider.setRange(0, 100)
-        self.textYOffsetSlider.setValue(int(self.textYOffsetRatio * 100))
+        self.textYOffsetSlider.setValue(int(self.settings.textYOffsetRatio * 100))
         self.textYOffsetSlider.setTickInterval(5)
         self.textYOffsetSlider.setTickPosition(QSlider.TicksBelow)
         self.textYOffsetSlider.valueChanged.connect(self.updateTextYOffset)
@@ -231,13 +393,13 @@ class AutoTagger(QWidget):
         mainLayout.addLayout(textYOffsetLayout)
 
         self.downsizeCheckBox = QCheckBox("Downsize Image", self)
-        self.downsizeCheckBox.setChecked(self.downsizeImage)
+        self.downsizeCheckBox.setChecked(self.settings.downsizeImage)
         self.downsizeCheckBox.stateChanged.connect(self.updateDownsizeImage)
         mainLayout.addWidget(self.downsizeCheckBox)
 
         self.sizeInput = QLineEdit(self)
         self.sizeInput.setPlaceholderText("Enter smallest side size...")
-        self.sizeInput.setText(str(self.downsizeValue))
+        self.sizeInput.setText(str(self.settings.downsizeValue))
         self.sizeInput.textChanged.connect(self.updateDownsizeValue)
         mainLayout.addWidget(self.sizeInput)
 
@@ -245,18 +407,81 @@ class AutoTagger(QWidget):
         threadSliderLayout.addWidget(QLabel('Threads (max 20):'))
         self.threadCountSlider = QSlider(Qt.Horizontal, self)
         self.threadCountSlider.setRange(1, 20)
-        self.threadCountSlider.setValue(self.threadCount)
+        self.threadCountSlider.setValue(self.settings.threadCount)
         self.threadCountSlider.setTickInterval(1)
         self.threadCountSlider.setTickPosition(QSlider.TicksBelow)
         self.threadCountSlider.valueChanged.connect(self.updateThreadCount)
         threadSliderLayout.addWidget(self.threadCountSlider)
+        # Auto tunes the thread count during each batch and remembers it per folder; moving the slider overrides it
+        self.autoThreadsCheckBox = QCheckBox("Auto", self)
+        self.autoThreadsCheckBox.setChecked(self.settings.autoThreads)
+        self.autoThreadsCheckBox.stateChanged.connect(self.updateAutoThreads)
+        threadSliderLayout.addWidget(self.autoThreadsCheckBox)
         mainLayout.addLayout(threadSliderLayout)
 
+        executionModeLayout = QHBoxLayout()
+        executionModeLayout.addWidget(QLabel('Run Batches On:'))
+        self.executionModeComboBox = QComboBox(self)
+        self.executionModeComboBox.addItems([label for label, _ in self.EXECUTION_MODES])
+        self.executionModeComboBox.setToolTip("Distributed: this window hands out the work and shows the progress; workers on "
+                                              "this or other machines connect to coordinatorAddress from config.json "
+                                              f"(now {self.settings.coordinatorAddress})")
+        modes = [mode for _, mode in self.EXECUTION_MODES]
+        self.executionModeComboBox.setCurrentIndex(modes.index(self.settings.executionMode) if self.settings.executionMode in modes else 0)
+        self.executionModeComboBox.currentIndexChanged.connect(self.updateExecutionMode)
+        executionModeLayout.addWidget(self.executionModeComboBox)
+        mainLayout.addLayout(executionModeLayout)
+
+        # Profiles, folders and the file list are built once the first frame is on screen (see buildProcessingPanels)
+        self.processingLayout = QVBoxLayout()
+        mainLayout.addLayout(self.processingLayout)
+
+        self.statusRefreshTimer = QTimer(self)
+        self.statusRefreshTimer.setInterval(self.STATUS_REFRESH_INTERVAL_MS)
+        self.statusRefreshTimer.timeout.connect(self.flushStatusUpdates)
+
+        self.processClipboardButton = QPushButton('Process Clipboard Image', self)
+        self.processClipboardButton.setStyleSheet("background-color: #559edb; color: white; font-weight: bold; padding: 10px; border-radius: 10px;")
+        self.processClipboardButton.clicked.connect(self.processClipboardImage)
+        mainLayout.addWidget(self.processClipboardButton)
+
+        progressLayout = QHBoxLayout()
+        self.progressBar = QProgressBar(self)
+        self.progressBar.setValue(0)
+        progressLayout.addWidget(self.progressBar)
+
+        self.progressLabel = QLabel("0/0")
+        progressLayout.addWidget(self.progressLabel)
+        mainLayout.addLayout(progressLayout)
+
+        self.setLayout(mainLayout)
+        self.loadSavedFolders()
+
+    def buildProcessingPanels(self):
+        layout = self.processingLayout
+        # Checked profiles are all written in one batch, each file decoded once; none checked = the plain tagged/ copy
+        profilesLayout = QHBoxLayout()
+        profilesLayout.addWidget(QLabel('Output Profiles:'))
+        self.profileListWidget = QListWidget(self)
+        self.profileListWidget.setMaximumHeight(70)
+        self.profileListWidget.itemChanged.connect(self.updateActiveProfiles)
+        profilesLayout.addWidget(self.profileListWidget)
+        profileButtonsLayout = QVBoxLayout()
+        self.saveProfileButton = QPushButton('Save as Profile', self)
+        self.saveProfileButton.clicked.connect(self.saveProfile)
+        profileButtonsLayout.addWidget(self.saveProfileButton)
+        self.removeProfileButton = QPushButton('Remove Profile', self)
+        self.removeProfileButton.clicked.connect(self.removeProfile)
+        profileButtonsLayout.addWidget(self.removeProfileButton)
+        profilesLayout.addLayout(profileButtonsLayout)
+        layout.addLayout(profilesLayout)
+        self.refreshProfileList()
+
         self.toggleProcessingButton = QPushButton('Toggle Folder and File Processing', self)
         self.toggleProcessingButton.setCheckable(True)
         self.toggleProcessingButton.setChecked(True)
         self.toggleProcessingButton.toggled.connect(self.toggleProcessingViews)
-        mainLayout.addWidget(self.toggleProcessingButton)
+        layout.addWidget(self.toggleProcessingButton)
 
         folderGroupBox = QGroupBox("Folder Processing")
         folderGroupBox.setStyleSheet("QGroupBox { background-color: #3a3a3a; border: 1px solid #3a8dde; padding: 10px; border-radius: 10px; }")
@@ -287,38 +512,98 @@ class AutoTagger(QWidget):
         self.includeSubfoldersCheckBox = QCheckBox("Include Subfolders", self)
         folderLayout.addWidget(self.includeSubfoldersCheckBox)
 
+        self.incrementalCheckBox = QCheckBox("Skip Unchanged Files", self)
+        self.incrementalCheckBox.setChecked(self.settings.incremental)
+        self.incrementalCheckBox.stateChanged.connect(self.updateIncremental)
+        folderLayout.addWidget(self.incrementalCheckBox)
+
+        self.collectTimingsCheckBox = QCheckBox("Collect Stage Timings", self)
+        self.collectTimingsCheckBox.setChecked(self.settings.collectTimings)
+        self.collectTimingsCheckBox.stateChanged.connect(self.updateCollectTimings)
+        folderLayout.addWidget(self.collectTimingsCheckBox)
+
         self.processFoldersButton = QPushButton('Process Folders', self)
         self.processFoldersButton.clicked.connect(self.startFolderProcessing)
         folderLayout.addWidget(self.processFoldersButton)
 
-        folderGroupBox.setLayout(folderLayout)
-        mainLayout.addWidget(folderGroupBox)
-
-        self.processingFilesTextBox = QPlainTextEdit(self)
-        self.processingFilesTextBox.setReadOnly(True)
-        mainLayout.addWidget(self.processingFilesTextBox)
-
-        self.processClipboardButton = QPushButton('Process Clipboard Image', self)
-        self.processClipboardButton.setStyleSheet("background-color: #559edb; color: white; font-weight: bold; padding: 10px; border-radius: 10px;")
-        self.processClipboardButton.clicked.connect(self.processClipboardImage)
-        mainLayout.addWidget(self.processClipboardButton)
-
-        progressLayout = QHBoxLayout()
-        self.progressBar = QProgressBar(self)
-        self.progressBar.setValue(0)
-        progressLayout.addWidget(self.progressBar)
-
-        self.progressLabel = QLabel("0/0")
-        progressLayout.addWidget(self.progressLabel)
-        mainLayout.addLayout(progressLayout)
+        batchControlLayout = QHBoxLayout()
+        self.pauseBatchButton = QPushButton('Pause', self)
+        self.pauseBatchButton.clicked.connect(self.togglePauseBatch)
+        batchControlLayout.addWidget(self.pauseBatchButton)
+        self.cancelBatchButton = QPushButton('Cancel', self)
+        self.cancelBatchButton.clicked.connect(self.cancelBatch)
+        batchControlLayout.addWidget(self.cancelBatchButton)
+        self.exportReportButton = QPushButton('Export Report', self)
+        self.exportReportButton.clicked.connect(self.exportReport)
+        batchControlLayout.addWidget(self.exportReportButton)
+        folderLayout.addLayout(batchControlLayout)
+        self.updateBatchControls()
 
-        self.setLayout(mainLayout)
-        self.loadSavedFolders()
+        folderGroupBox.setLayout(folderLayout)
+        layout.addWidget(folderGroupBox)
+
+        self.fileStatusModel = FileStatusModel(self)
+        self.fileStatusFilter = StatusFilterModel(self)
+
+        statusFilterLayout = QHBoxLayout()
+        self.statusFilterComboBox = QComboBox(self)
+        self.statusFilterComboBox.addItems([label for label, _ in self.STATUS_FILTERS])
+        self.statusFilterComboBox.currentIndexChanged.connect(self.updateStatusFilter)
+        statusFilterLayout.addWidget(self.statusFilterComboBox)
+        self.statusCountsLabel = QLabel(self)
+        statusFilterLayout.addWidget(self.statusCountsLabel)
+        statusFilterLayout.addStretch()
+        layout.addLayout(statusFilterLayout)
+
+        # A single-column table with fixed-height rows: unlike QListView it does not re-lay out every row
+        # when rows are appended, so scrolling stays cheap with a million entries
+        self.processingListView = QTableView(self)
+        self.processingListView.setModel(self.fileStatusModel)
+        self.processingListView.horizontalHeader().hide()
+        self.processingListView.horizontalHeader().setStretchLastSection(True)
+        self.processingListView.verticalHeader().hide()
+        self.processingListView.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+        self.processingListView.verticalHeader().setDefaultSectionSize(self.fontMetrics().height() + 4)
+        self.processingListView.setShowGrid(False)
+        self.processingListView.setWordWrap(False)
+        self.processingListView.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.processingListView.setSelectionBehavior(QAbstractItemView.SelectRows)
+        layout.addWidget(self.processingListView)
+        self.updateStatusCounts()
+        for folder in self.selectedFolders:
+            self.folderListWidget.addItem(QListWidgetItem(folder))
+
+    def paintEvent(self, event):
+        super().paintEvent(event)
+        if 'first window' not in self.startupTimings:
+            self.startupTimings['first window'] = time.perf_counter() - STARTUP_TIME
+            QTimer.singleShot(0, self.finishStartup)
+
+    def finishStartup(self):
+        # Everything the first frame can do without: the processing panels and the clipboard preview (reading
+        # the clipboard can wait on the application that owns it)
+        started = time.perf_counter()
+        self.buildProcessingPanels()
+        self.clipboardChanged()
+        self.startupTimings['deferred'] = time.perf_counter() - started
+        if self.reportStartup:
+            print(describeStartup(self.startupTimings), file=sys.stderr)
 
     def initTimer(self):
-        self.timer = QTimer(self)
-        self.timer.timeout.connect(self.displayImage)
-        self.timer.start(1000)
+        # The preview follows the clipboard's dataChanged signal instead of polling it; settings changes
+        # restart a short single-shot timer so a slider drag redraws once it pauses, not on every tick
+        self.previewTimer = QTimer(self)
+        self.previewTimer.setSingleShot(True)
+        self.previewTimer.setInterval(self.PREVIEW_DEBOUNCE_MS)
+        self.previewTimer.timeout.connect(self.displayImage)
+        QApplication.clipboard().dataChanged.connect(self.clipboardChanged)
+
+    def clipboardChanged(self):
+        self.clipboardImage = QApplication.clipboard().image()
+        self.displayImage()
+
+    def schedulePreview(self):
+        self.previewTimer.start()
 
     def toggleMaximized(self):
         if self.isMaximized():
@@ -327,49 +612,109 @@ class AutoTagger(QWidget):
             self.showMaximized()
 
     def updateFontFamily(self, fontFamily):
-        self.fontFamily = fontFamily
+        self.settings.fontFamily = fontFamily
         self.saveConfig()
-        self.displayImage()
+        self.schedulePreview()
 
     def updateCustomText(self, text):
-        self.customText = text
+        self.settings.customText = text
         self.saveConfig()
-        self.displayImage()
+        self.schedulePreview()
 
     def updateFontSize(self, value):
-        self.fontSize = value
+        self.settings.fontSize = value
         self.saveConfig()
-        self.displayImage()
+        self.schedulePreview()
 
     def updateTextYOffset(self, value):
-        self.textYOffsetRatio = value / 100.0
+        self.settings.textYOffsetRatio = value / 100.0
         self.saveConfig()
-        self.displayImage()
+        self.schedulePreview()
 
     def updateDownsizeImage(self, state):
-        self.downsizeImage = state == Qt.Checked
+        self.settings.downsizeImage = state == Qt.Checked
         self.saveConfig()
 
     def updateDownsizeValue(self, value):
         try:
-            self.downsizeValue = int(value)
+            self.settings.downsizeValue = int(value)
         except ValueError:
-            self.downsizeValue = 800
+            self.settings.downsizeValue = 800
         self.saveConfig()
 
     def updateThreadCount(self, value):
-        self.threadCount = value
-        self.threadPool.setMaxThreadCount(self.threadCount)
+        self.settings.threadCount = value
+        self.settings.autoThreads = False
+        self.autoThreadsCheckBox.setChecked(False)
+        self.saveConfig()
+
+    def updateAutoThreads(self, state):
+        self.settings.autoThreads = state == Qt.Checked
+        self.saveConfig()
+
+    def updateExecutionMode(self, index):
+        self.settings.executionMode = self.EXECUTION_MODES[index][1]
+        self.saveConfig()
+
+    def updateIncremental(self, state):
+        self.settings.incremental = state == Qt.Checked
+        self.saveConfig()
+
+    def refreshProfileList(self):
+        self.profileListWidget.blockSignals(True)
+        self.profileListWidget.clear()
+        for profile in self.settings.profiles:
+            item = QListWidgetItem(profile['name'])
+            item.setFlags(item.flags() | Qt.ItemIsUserCheckable)
+            item.setCheckState(Qt.Checked if profile['name'] in self.settings.activeProfiles else Qt.Unchecked)
+            item.setToolTip(", ".join(f"{key}: {value}" for key, value in profile.items() if key != 'name'))
+            self.profileListWidget.addItem(item)
+        self.profileListWidget.blockSignals(False)
+
+    def updateActiveProfiles(self, item=None):
+        self.settings.activeProfiles = [self.profileListWidget.item(row).text() for row in range(self.profileListWidget.count())
+                                        if self.profileListWidget.item(row).checkState() == Qt.Checked]
+        self.saveConfig()
+
+    def saveProfile(self):
+        # Stores the current text, font, colour and size settings under a name; its copies go to tagged/<name>/
+        name, ok = QInputDialog.getText(self, "Save as Profile", "Profile name:")
+        name = name.strip()
+        if not ok or not name:
+            return
+        profile = {'name': name, **{key: getattr(self.settings, key) for key in PROFILE_FIELDS}}
+        self.settings.profiles = [existing for existing in self.settings.profiles if existing['name'] != name] + [profile]
+        self.refreshProfileList()
+        self.saveConfig()
+
+    def removeProfile(self):
+        item = self.profileListWidget.currentItem()
+        if item is None:
+            return
+        self.settings.profiles = [profile for profile in self.settings.profiles if profile['name'] != item.text()]
+        self.settings.activeProfiles = [name for name in self.settings.activeProfiles if name != item.text()]
+        self.refreshProfileList()
+        self.saveConfig()
+
+    def updateCollectTimings(self, state):
+        self.settings.collectTimings = state == Qt.Checked
         self.saveConfig()
 
     def toggleProcessingViews(self, checked):
         self.folderListWidget.setVisible(checked)
-        self.processingFilesTextBox.setVisible(checked)
+        self.processingListView.setVisible(checked)
+        self.statusFilterComboBox.setVisible(checked)
+        self.statusCountsLabel.setVisible(checked)
         self.selectFolderButton.setVisible(checked)
         self.removeFolderButton.setVisible(checked)
         self.removeAllFoldersButton.setVisible(checked)
         self.includeSubfoldersCheckBox.setVisible(checked)
+        self.incrementalCheckBox.setVisible(checked)
+        self.collectTimingsCheckBox.setVisible(checked)
         self.processFoldersButton.setVisible(checked)
+        self.pauseBatchButton.setVisible(checked)
+        self.cancelBatchButton.setVisible(checked)
+        self.exportReportButton.setVisible(checked)
 
     def processClipboardImage(self):
         clipboard = QApplication.clipboard()
@@ -392,13 +737,20 @@ class AutoTagger(QWidget):
     def selectFolders(self):
         selected_folder = QFileDialog.getExistingDirectory(self, "Select Folder", "", QFileDialog.ShowDirsOnly | QFileDialog.DontResolveSymlinks)
         if selected_folder:
-            subfolders = [os.path.join(selected_folder, f) for f in os.listdir(selected_folder) if os.path.isdir(os.path.join(selected_folder, f))]
-            for folder in subfolders:
-                if folder not in self.selectedFolders:
-                    self.selectedFolders.append(folder)
-                    item = QListWidgetItem(folder)
-                    self.folderListWidget.addItem(item)
-            self.saveSelectedFolders()
+            # Listing a big folder on a network share can take a while, so it happens off the GUI thread
+            scanThread = FolderScanThread(selected_folder, self)
+            scanThread.foldersFound.connect(self.addFolders)
+            scanThread.finished.connect(lambda: self.folderScanThreads.remove(scanThread))
+            self.folderScanThreads.append(scanThread)
+            scanThread.start()
+
+    def addFolders(self, subfolders):
+        for folder in subfolders:
+            if folder not in self.selectedFolders:
+                self.selectedFolders.append(folder)
+                item = QListWidgetItem(folder)
+                self.folderListWidget.addItem(item)
+        self.saveSelectedFolders()
 
     def removeSelectedFolders(self):
         selected_items = self.folderListWidget.selectedItems()
@@ -428,163 +780,168 @@ class AutoTagger(QWidget):
         if not self.selectedFolders:
             self.showMessage("Error", "No subfolders selected.")
             return
+        if self.batchThread is not None and self.batchThread.isRunning():
+            self.showMessage("Info", "A batch is already running.")
+            return
 
-        self.completed_tasks = 0
-        self.total_files = 0
         self.progressBar.setValue(0)
         self.progressLabel.setText("0/0")
-        self.file_status.clear()
+        self.fileStatusModel.clear()
+        self.updateStatusCounts()
 
-        image_files = []
-        for folder in self.selectedFolders:
-            for root, dirs, files in os.walk(folder):
-                for file in files:
-                    if file.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.gif')):
-                        file_path = os.path.join(root, file)
-                        image_files.append(file_path)
-                        self.file_status[file_path] = 'pending'
-                if not self.includeSubfoldersCheckBox.isChecked():
-                    break
-
-        self.total_files = len(image_files)
-        self.progressBar.setMaximum(self.total_files)
-        self.updateProgress(0, self.total_files)
-
-        if self.total_files == 0:
-            self.showMessage("Info", "No image files found in the selected subfolders.")
+        self.progressChannel = ProgressChannel()
+        self.batchReport = RunReport()
+        try:
+            self.batchEngine = TaggingEngine(self.settings.snapshot(), progress=self.progressChannel, report=self.batchReport,
+                                             tuningStore=TuningStore(defaultTuningPath(self.configPath)))
+        except ValueError as e:
+            self.showMessage("Error", str(e))
             return
-
-        for file_path in image_files:
-            runnable = ImageProcessorRunnable(file_path, self)
-            runnable.signals.progress.connect(self.updateProgress)
-            runnable.signals.status_update.connect(self.updateFileStatus)
-            self.threadPool.start(runnable)
-
-        self.refreshProcessingList()
-
-    def updateProgress(self, completed, total):
-        self.progressBar.setValue(completed)
-        self.progressLabel.setText(f"{completed}/{total}")
-
-    def updateFileStatus(self, file_path, status):
-        self.file_status[file_path] = status
-        QTimer.singleShot(0, self.refreshProcessingList)
-
-    def refreshProcessingList(self):
-        self.processingFilesTextBox.clear()
-        for file_path, status in self.file_status.items():
-            color = self.getStatusColor(status)
-            text = f"{file_path} - {status.capitalize()}"
-            self.appendTextWithColor(self.processingFilesTextBox, text, color)
-
-    def getStatusColor(self, status):
-        if status == 'pending':
-            return QColor(255, 255, 255)
-        elif status == 'processing':
-            return QColor(255, 255, 224)
-        elif status == 'success':
-            return QColor(144, 238, 144)
-        elif status == 'failed':
-            return QColor(255, 102, 102)
+        self.batchThread = EngineBatchThread(self.batchEngine, list(self.selectedFolders), self.includeSubfoldersCheckBox.isChecked(), self)
+        self.batchThread.finished.connect(self.batchFinished)
+        self.batchThread.start()
+        self.statusRefreshTimer.start()
+        self.updateBatchControls()
+
+    def togglePauseBatch(self):
+        if self.batchEngine is None:
+            return
+        if self.batchEngine.control.paused:
+            self.batchEngine.resume()
         else:
-            return QColor(255, 255, 255)
+            self.batchEngine.pause()
+        self.updateBatchControls()
+
+    def cancelBatch(self):
+        # Files already being tagged are finished; everything else is reported as cancelled
+        if self.batchEngine is not None:
+            self.batchEngine.cancel()
+            self.updateBatchControls()
+
+    def updateBatchControls(self):
+        running = self.batchThread is not None and self.batchThread.isRunning()
+        control = self.batchEngine.control if running else None
+        self.processFoldersButton.setEnabled(not running)
+        self.pauseBatchButton.setEnabled(running and not control.cancelled)
+        self.pauseBatchButton.setText('Resume' if running and control.paused else 'Pause')
+        self.cancelBatchButton.setEnabled(running and not control.cancelled)
+        self.exportReportButton.setEnabled(not running and self.batchReport is not None)
+
+    def batchFinished(self):
+        self.flushStatusUpdates()
+        self.updateBatchControls()
+        errors = self.batchReport.summary()['errors']
+        self.statusCountsLabel.setToolTip("\n".join(f"{error['count']} failed in {error['stage']}: {error['reason']}"
+                                                    for error in errors[:10]))
+        if self.progressChannel.snapshot().total == 0:
+            self.showMessage("Info", "No image files found in the selected subfolders.")
 
-    def appendTextWithColor(self, textbox, text, color):
-        cursor = textbox.textCursor()
-        cursor.movePosition(QTextCursor.End)
-        format_ = cursor.charFormat()
-        format_.setForeground(color)
-        cursor.insertText(text + '\n', format_)
-        textbox.setTextCursor(cursor)
-        textbox.ensureCursorVisible()
+    def exportReport(self):
+        if self.batchReport is None:
+            return
+        path, _ = QFileDialog.getSaveFileName(self, "Export Run Report", "autotagger-report.json",
+                                              "JSON report (*.json);;CSV stage summary (*.csv)")
+        if path:
+            try:
+                self.batchReport.write(path)
+            except OSError as e:
+                self.showMessage("Error", f"Could not write the report: {e}")
+
+    def updateProgress(self, snapshot):
+        self.progressBar.setMaximum(max(snapshot.total, 1))
+        self.progressBar.setValue(snapshot.completed)
+        text = snapshot.describe()
+        if self.batchEngine is not None and self.batchEngine.pipeline is not None:
+            # Queue depths in front of each stage; the stage with the full queue is the bottleneck
+            text += "  [" + "  ".join(f"{stage} {depth}" for stage, depth in self.batchEngine.stageDepths().items()) + "]"
+        if self.batchEngine is not None and self.batchEngine.tuner is not None:
+            text += f"  [{self.batchEngine.tuner.describe()}]"
+        if self.batchEngine is not None and self.batchEngine.coordinator is not None:
+            # Progress of every connected worker arrives here as their results come in
+            text += f"  [{self.batchEngine.coordinator.describe()}]"
+        self.progressLabel.setText(text)
+
+    def flushStatusUpdates(self):
+        # Workers only append to the progress channel; everything they reported since the last tick is
+        # applied here in one go, keeping only the latest status per file
+        if self.progressChannel is None:
+            return
+        updates = dict(self.progressChannel.drain())
+        if updates:
+            scrollBar = self.processingListView.verticalScrollBar()
+            atBottom = scrollBar.value() == scrollBar.maximum()
+            self.fileStatusModel.applyUpdates(updates)
+            if atBottom:
+                self.processingListView.scrollToBottom()
+            self.updateStatusCounts()
+        self.updateProgress(self.progressChannel.snapshot())
+        if self.batchThread is None or not self.batchThread.isRunning():
+            self.statusRefreshTimer.stop()
+
+    def updateStatusCounts(self):
+        counts = self.fileStatusModel.counts
+        self.statusCountsLabel.setText("  ".join(f"{status.capitalize()}: {counts[status]}"
+                                                 for status in FileStatusModel.STATUSES))
+
+    def updateStatusFilter(self, index):
+        # The proxy is only attached while a filter is active, so "All Files" costs nothing extra per update
+        statuses = self.STATUS_FILTERS[index][1]
+        if statuses is None:
+            self.processingListView.setModel(self.fileStatusModel)
+            self.fileStatusFilter.setSourceModel(None)
+            self.fileStatusFilter.setStatuses(None)
+        else:
+            # Re-filter while detached from the view, so the view sees one reset instead of piecemeal inserts
+            self.processingListView.setModel(self.fileStatusModel)
+            self.fileStatusFilter.setStatuses(statuses)
+            if self.fileStatusFilter.sourceModel() is None:
+                self.fileStatusFilter.setSourceModel(self.fileStatusModel)
+            self.processingListView.setModel(self.fileStatusFilter)
 
     def downsizeImageToSmallestSide(self, image):
-        width = image.width()
-        height = image.height()
-        smallest_side = min(width, height)
-        if smallest_side > self.downsizeValue:
-            scaling_factor = self.downsizeValue / smallest_side
-            new_width = int(width * scaling_factor)
-            new_height = int(height * scaling_factor)
-            return image.scaled(new_width, new_height, Qt.KeepAspectRatio, Qt.SmoothTransformation)
-        return image
-
-    def applyTextToImage(self, image):
-        pixmap = QPixmap.fromImage(image)
-        painter = QPainter(pixmap)
-
-        shortest_side = min(pixmap.width(), pixmap.height())
-        relative_font_size = int(self.fontSize * (shortest_side / 1000))
-        painter.setFont(QFont(self.fontFamily, relative_font_size))
-        painter.setPen(self.textColor)
-
-        textRect = QRect(0, int((1 - self.textYOffsetRatio) * pixmap.height()), pixmap.width(), int(self.textYOffsetRatio * pixmap.height()))
-        painter.drawText(textRect, Qt.AlignCenter, self.customText)
-        painter.end()
-
-        return pixmap.toImage()
+        return downsizeImageToSmallestSide(image, self.settings.downsizeValue)
+
+    def applyTextToImage(self, image, size=None):
+        return applyTextToImage(image, self.settings, text=self.tagTextFor(size or (image.width(), image.height())))
+
+    def tagTextFor(self, size):
+        # Clipboard images have no file, so the template is filled in with sample values; the raw text is shown
+        # while the template is still being typed
+        try:
+            return compileTemplate(self.settings.customText).render(TemplateValues.sample(*size))
+        except ValueError:
+            return self.settings.customText
 
     def pickTextColor(self):
-        color = QColorDialog.getColor(self.textColor, self)
+        color = QColorDialog.getColor(QColor(self.settings.textColor), self)
         if color.isValid():
-            self.textColor = color
+            self.settings.textColor = color.name()
             self.saveConfig()
-            self.displayImage()
+            self.schedulePreview()
 
     def loadConfig(self):
-        try:
-            with open(self.configPath, 'r') as f:
-                config = json.load(f)
-                self.fontFamily = config.get('fontFamily', 'Arial')
-                self.fontSize = config.get('fontSize', 30)
-                self.customText = config.get('customText', 'Sample Text')
-                self.textColor = QColor(config.get('textColor', '#FFFFFF'))
-                self.textYOffsetRatio = config.get('textYOffsetRatio', 0.1)
-                self.downsizeImage = config.get('downsizeImage', False)
-                self.downsizeValue = config.get('downsizeValue', 800)
-                self.threadCount = config.get('threadCount', 10)
-                self.savedFolders = config.get('selectedFolders', [])
-        except Exception:
-            self.fontFamily = 'Arial'
-            self.fontSize = 30
-            self.customText = 'Sample Text'
-            self.textColor = QColor(255, 255, 255)
-            self.textYOffsetRatio = 0.1
-            self.downsizeImage = False
-            self.downsizeValue = 800
-            self.threadCount = 10
-            self.savedFolders = []
-
-        self.threadPool.setMaxThreadCount(self.threadCount)
+        config = loadConfigFile(self.configPath)
+        self.settings = TagSettings.fromConfig(config)
+        self.savedFolders = config.get('selectedFolders', [])
 
     def saveConfig(self):
-        config = {
-            'fontFamily': self.fontFamily,
-            'fontSize': self.fontSize,
-            'customText': self.customText,
-            'textColor': self.textColor.name(),
-            'textYOffsetRatio': self.textYOffsetRatio,
-            'downsizeImage': self.downsizeImage,
-            'downsizeValue': self.downsizeValue,
-            'threadCount': self.threadCount,
-            'selectedFolders': self.selectedFolders
-        }
-        os.makedirs(os.path.dirname(self.configPath), exist_ok=True)
-        with open(self.configPath, 'w') as f:
-            json.dump(config, f)
+        config = self.settings.toConfig()
+        config['selectedFolders'] = list(self.selectedFolders)
+        self.configWriter.save(config)
 
     def saveSelectedFolders(self):
         self.saveConfig()
 
     def loadSavedFolders(self):
-        for folder in self.savedFolders:
-            if os.path.isdir(folder):
-                self.selectedFolders.append(folder)
-                item = QListWidgetItem(folder)
-                self.folderListWidget.addItem(item)
+        self.selectedFolders.extend(folder for folder in self.savedFolders if os.path.isdir(folder))
 
     def closeEvent(self, event):
+        if self.batchThread is not None:
+            if self.batchThread.isRunning():
+                self.batchEngine.cancel()
+            self.batchThread.wait()
         self.saveConfig()
+        self.configWriter.flush()
         event.accept()
 
     def displayImage(self, image=None):
@@ -592,34 +949,24 @@ class AutoTagger(QWidget):
             QTimer.singleShot(0, lambda: self.displayImage(image))
             return
 
-        if isinstance(image, QImage):
-            pixmap = QPixmap.fromImage(image)
-        else:
-            clipboard = QApplication.clipboard()
-            clipboardImage = clipboard.image()
-            if not clipboardImage.isNull():
-                pixmap = QPixmap.fromImage(clipboardImage)
-            else:
-                self.imageLabel.clear()
-                return
-
-        max_height = 500
-        if pixmap.height() > max_height:
-            pixmap = pixmap.scaledToHeight(max_height, Qt.SmoothTransformation)
-
-        self.imageLabel.setFixedHeight(pixmap.height())
-
-        painter = QPainter(pixmap)
-        shortest_side = min(pixmap.width(), pixmap.height())
-        relative_font_size = int(self.fontSize * (shortest_side / 1000))
-        painter.setFont(QFont(self.fontFamily, relative_font_size))
-        painter.setPen(self.textColor)
+        if not isinstance(image, QImage):
+            image = self.clipboardImage
+        if image.isNull():
+            self.imageLabel.clear()
+            return
 
-        textRect = QRect(0, int((1 - self.textYOffsetRatio) * pixmap.height()), pixmap.width(), int(self.textYOffsetRatio * pixmap.height()))
-        painter.drawText(textRect, Qt.AlignCenter, self.customText)
-        painter.end()
+        # Only the text layer is redrawn on the preview-sized base; the base is rescaled when the image changes
+        preview = self.applyTextToImage(self.previewBaseFor(image), (image.width(), image.height()))
+        self.imageLabel.setFixedHeight(preview.height())
+        self.imageLabel.setPixmap(QPixmap.fromImage(preview))
 
-        self.imageLabel.setPixmap(pixmap)
+    def previewBaseFor(self, image):
+        if image.cacheKey() != self.previewKey:
+            base = image
+            if base.height() > self.PREVIEW_MAX_HEIGHT:
+                base = base.scaledToHeight(self.PREVIEW_MAX_HEIGHT, Qt.SmoothTransformation)
+            self.previewKey, self.previewBase = image.cacheKey(), base
+        return self.previewBase
 
     def showMessage(self, title, message):
         QMessageBox.information(self, title, message)
@@ -637,6 +984,6 @@ class AutoTagger(QWidget):
 
 if __name__ == '__main__':
     app = QApplication(sys.argv)
-    ex = AutoTagger()
+    ex = AutoTagger(reportStartup='--startup-timing' in sys.argv)
     ex.show()
     sys.exit(app.exec_())
@@ -0,0 +1,10 @@
+from .archive import ArchiveIndex, ArchiveSink
+from .autotune import TuningStore
+from .distributed import Coordinator, runWorker
+from .engine import TagResult, TaggingEngine, findImageFiles, tagFile
+from .imaging import applyTextToImage, downsizeImageToSmallestSide, ensureGuiApplication, loadImage, processImage
+from .instrumentation import RunReport
+from .manifest import TagManifest
+from .progress import ProgressChannel, ProgressSnapshot
+from .scheduler import BatchControl, MemoryBudget
+from .settings import ConfigWriter, TagSettings, defaultConfigPath, loadConfigFile, saveConfigFile
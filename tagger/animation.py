@@ -0,0 +1,186 @@
+import multiprocessing
+import threading
+import time
+from collections import deque
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor, ThreadPoolExecutor
+
+from PyQt5.QtGui import QColor
+
+from .autotune import availableCpuCount
+from .gifwriter import GifEncoder, compressedBlock, frameParts, paletteFor, quantize
+from .imaging import FrameCounter, applyTextToImage, downsizeImageToSmallestSide, imageFormatFor
+
+_framePool = None
+_compressPool = None
+_framePoolLock = threading.Lock()
+# Smaller frames compress faster than they can be sent to another process
+MIN_PROCESS_PIXELS = 256 * 256
+
+
+def isAnimationPath(file_path):
+    # GIFs always take the frame-by-frame path: Qt has no GIF writer, and a still GIF is just one frame
+    return imageFormatFor(file_path) == 'gif'
+
+
+def framePool():
+    # One pool per process for every animation being tagged, so frame work never runs on more threads than CPUs
+    global _framePool
+    with _framePoolLock:
+        if _framePool is None:
+            _framePool = ThreadPoolExecutor(max_workers=availableCpuCount(), thread_name_prefix='AnimationFrame')
+        return _framePool
+
+
+def compressPool():
+    # LZW compression is pure Python and by far the slowest part of a GIF frame, so it runs on processes:
+    # on the frame threads it would hold the GIL and only the Qt drawing would run in parallel. None with a
+    # single CPU, and inside the engine's worker processes, which already tag one file per core.
+    global _compressPool
+    with _framePoolLock:
+        if _compressPool is None and availableCpuCount() > 1 and multiprocessing.parent_process() is None:
+            _compressPool = ProcessPoolExecutor(max_workers=availableCpuCount(),
+                                                mp_context=multiprocessing.get_context('spawn'))
+        return _compressPool
+
+
+def _compress(header, pixels, minCodeSize):
+    global _compressPool
+    pool = compressPool() if len(pixels) >= MIN_PROCESS_PIXELS else None
+    if pool is not None:
+        try:
+            # The frame thread waits without holding the GIL, so other frames are drawn meanwhile
+            return pool.submit(compressedBlock, header, pixels, minCodeSize).result()
+        except BrokenExecutor:
+            with _framePoolLock:
+                if _compressPool is pool:
+                    _compressPool = None  # a compression process died: the next frame starts a new pool
+    return compressedBlock(header, pixels, minCodeSize)
+
+
+def framesInFlight():
+    # Decoded frames one animation may hold at once: enough to keep the frame pool busy
+    return 2 * availableCpuCount()
+
+
+def _sourceRows(frame):
+    bits = frame.constBits()
+    bits.setsize(frame.bytesPerLine() * frame.height())
+    return bytes(bits)
+
+
+def changedRows(pixels, previous, stride, height):
+    # (first, last + 1) of the rows that differ between two frames of the same size; an empty range if none do
+    top = 0
+    while top < height and pixels[top * stride:(top + 1) * stride] == previous[top * stride:(top + 1) * stride]:
+        top += 1
+    bottom = height
+    while bottom > top and pixels[(bottom - 1) * stride:bottom * stride] == previous[(bottom - 1) * stride:bottom * stride]:
+        bottom -= 1
+    return top, bottom
+
+
+def _addTimings(total, timings):
+    for stage, seconds in timings.items():
+        total[stage] = total.get(stage, 0.0) + seconds
+
+
+def _renderFrame(frame, rows, delay, disposal, variants, texts):
+    # Runs on the frame pool: every profile's copy of one frame, drawn, quantized and LZW-compressed (on the
+    # compression processes when there are any)
+    counter = FrameCounter()
+    timings = {}
+    started = time.perf_counter()
+
+    def lap(stage):
+        nonlocal started
+        now = time.perf_counter()
+        timings[stage] = timings.get(stage, 0.0) + now - started
+        started = now
+
+    # GIF frames have at most 256 colours: keep them exact and add the text colours while there is room
+    palette = paletteFor(frame, [QColor(variant.textColor).rgb() for variant, _ in variants])
+    lap('encode')
+    blocks = []
+    for position, (variant, _) in enumerate(variants):
+        scaled = downsizeImageToSmallestSide(frame, variant.downsizeValue, counter) if variant.downsizeImage else frame
+        lap('scale')
+        inPlace = scaled is not frame or position == len(variants) - 1
+        tagged = applyTextToImage(scaled, variant, inPlace=inPlace, counter=counter, text=texts[position])
+        lap('draw')
+        region, top = tagged, 0
+        if scaled is frame and rows is not None and rows != (0, tagged.height()):
+            # Only the rows that changed since the previous frame; the rest of the canvas stays as it was
+            # (an unchanged frame still needs a block for its delay: one row is rewritten)
+            top, bottom = rows if rows[0] < rows[1] else (0, 1)
+            region = tagged.copy(0, top, tagged.width(), bottom - top)
+        block = _compress(*frameParts(quantize(region, palette), 0, top, delay, disposal))
+        blocks.append((block, tagged.width(), tagged.height()))
+        lap('encode')
+    return blocks, counter, timings
+
+
+def tagAnimation(reader, variants, texts, counter=None):
+    """Tags every frame of an animated (or still) GIF for each profile variant and re-encodes it as a GIF.
+
+    Frames are decoded one at a time on this thread, composited onto the canvas by Qt, and drawn and quantized
+    on the shared frame pool with the overlay sprite every frame shares; LZW compression, which takes most of
+    the time, runs on the compression processes (see compressPool). At most framesInFlight() frames are
+    decoded at once however long the animation is. Frame delays and the loop count are kept. Only the rows that changed since the previous frame are re-encoded for opaque frames
+    written at full size. Returns ([GIF bytes per variant], frame count, {stage: seconds summed over frames}).
+    """
+    pool = framePool()
+    window = framesInFlight()
+    loop_count = reader.loopCount()
+    encoders = None
+    pending = deque()
+    timings = {}
+    frames = 0
+    previous = None  # pixels of the last opaque frame, to find the rows that changed
+
+    def collect(future):
+        nonlocal encoders
+        blocks, frame_counter, frame_timings = future.result()
+        if encoders is None:
+            encoders = [GifEncoder(width, height, loop_count) for _, width, height in blocks]
+        for encoder, (block, _, _) in zip(encoders, blocks):
+            encoder.add(block)
+        _addTimings(timings, frame_timings)
+        if counter is not None:
+            counter.allocations += frame_counter.allocations
+            counter.copies += frame_counter.copies
+
+    try:
+        while reader.canRead():
+            started = time.perf_counter()
+            frame = reader.read()
+            if frame.isNull():
+                if frames == 0:
+                    raise Exception(f"Failed to load image: {reader.errorString()}")
+                break
+            delay = reader.nextImageDelay()
+            frames += 1
+            if counter is not None:
+                counter.allocations += 1
+            rows = None
+            if frame.hasAlphaChannel():
+                # Transparent pixels must not show the previous frame through: clear the canvas after each frame
+                disposal = 2
+                previous = None
+            else:
+                disposal = 1
+                pixels = _sourceRows(frame)
+                if previous is not None and len(previous) == len(pixels):
+                    rows = changedRows(pixels, previous, frame.bytesPerLine(), frame.height())
+                previous = pixels
+            timings['decode'] = timings.get('decode', 0.0) + time.perf_counter() - started
+            pending.append(pool.submit(_renderFrame, frame, rows, delay, disposal, variants, texts))
+            while len(pending) >= window:
+                collect(pending.popleft())
+        while pending:
+            collect(pending.popleft())
+    finally:
+        for future in pending:
+            future.cancel()
+    if encoders is None:
+        raise Exception(f"Failed to load image: {reader.errorString()}")
+    return [encoder.finish() for encoder in encoders], frames, timings
@@ -0,0 +1,188 @@
+import io
+import itertools
+import json
+import os
+import queue
+import shutil
+import socket
+import struct
+import tarfile
+import threading
+import time
+import zipfile
+import zlib
+
+ARCHIVE_FORMATS = ('tar', 'zip')
+INDEX_SUFFIX = '.index.json'
+PARTIAL_SUFFIX = '.partial'
+# Already compressed, so zip stores them as they are; anything else (BMP) is deflated. Tar entries are never
+# compressed: a compressed tar can't be read from the middle.
+STORED_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp')
+COPY_CHUNK = 1024 * 1024
+
+
+def entrySize(data):
+    # Bytes of one output handed to ArchiveSink.write: encoded bytes, or a spooled file (see tagLargeImage)
+    return len(data) if isinstance(data, bytes) else os.fstat(data.fileno()).st_size
+
+
+def archiveName(output_path):
+    # Entry name for an output: its path without the drive or leading separator, like tar strips it
+    _, path = os.path.splitdrive(os.path.abspath(output_path))
+    return path.replace(os.sep, '/').lstrip('/')
+
+
+class _Shard:
+    # One archive being written; only the thread holding its slot touches it
+
+    def __init__(self, path, archiveFormat):
+        self.path = path
+        self.partialPath = path + PARTIAL_SUFFIX
+        self.format = archiveFormat
+        self.entries = {}  # name -> [data offset, size, compressed size or None when stored]
+        if archiveFormat == 'tar':
+            self.archive = tarfile.open(self.partialPath, 'w', format=tarfile.PAX_FORMAT)
+        else:
+            self.archive = zipfile.ZipFile(self.partialPath, 'w')
+
+    @property
+    def size(self):
+        return self.archive.offset if self.format == 'tar' else self.archive.fp.tell()
+
+    def add(self, name, data):
+        # data is bytes or a binary file; a file is copied in chunks, so it is never held in memory whole
+        size = entrySize(data)
+        source = io.BytesIO(data) if isinstance(data, bytes) else data
+        if self.format == 'tar':
+            info = tarfile.TarInfo(name)
+            info.size = size
+            info.mtime = time.time()
+            self.archive.addfile(info, source)
+            # The data ends the entry, padded to whole 512-byte blocks
+            self.entries[name] = [self.archive.offset - (size + 511) // 512 * 512, size, None]
+            return
+        stored = os.path.splitext(name)[1].lower() in STORED_EXTENSIONS
+        info = zipfile.ZipInfo(name, time.localtime()[:6])
+        info.compress_type = zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED
+        with self.archive.open(info, 'w', force_zip64=size > zipfile.ZIP64_LIMIT) as target:
+            shutil.copyfileobj(source, target, COPY_CHUNK)
+        info = self.archive.filelist[-1]
+        self.entries[name] = [self._dataOffset(info), size, None if stored else info.compress_size]
+
+    def _dataOffset(self, info):
+        # Local header: 30 bytes, the name and the extra field (which may hold zip64 sizes info.extra doesn't
+        # list), then the data
+        f = self.archive.fp
+        end = f.tell()
+        f.seek(info.header_offset + 26)
+        name_length, extra_length = struct.unpack('<HH', f.read(4))
+        f.seek(end)
+        return info.header_offset + 30 + name_length + extra_length
+
+    def close(self):
+        # The index is written first, so a shard that exists under its final name always has one
+        self.archive.close()
+        index_path = self.path + INDEX_SUFFIX
+        with open(index_path + '.tmp', 'w') as f:
+            json.dump({'archive': os.path.basename(self.path), 'format': self.format, 'entries': self.entries}, f)
+        os.replace(index_path + '.tmp', index_path)
+        os.replace(self.partialPath, self.path)
+
+
+class ArchiveSink:
+    """Writes tagged copies into tar or zip shards in one folder instead of one file each in tagged/ folders.
+
+    Up to `writers` shards are open at once and each is written by one thread at a time; a shard is closed
+    once it reaches shardBytes and the next one started. Shards are written as <name>.partial and only get
+    their final name, with a <name>.index.json of every entry's offset and size next to them, when they are
+    closed, so a run that stops halfway leaves no archive the manifest would count as written.
+    Shard names carry the host and process, so several processes (or machines) can share the folder.
+    """
+
+    def __init__(self, folder, archiveFormat='tar', shardBytes=1024 * 1024 * 1024, writers=1):
+        if archiveFormat not in ARCHIVE_FORMATS:
+            raise ValueError(f"Unknown archive format: {archiveFormat}")
+        if not folder:
+            raise ValueError("Archive output needs an archive folder")
+        self.folder = os.path.abspath(folder)  # shard paths go into the manifest, which may be read from elsewhere
+        self.format = archiveFormat
+        self.shardBytes = shardBytes
+        self.prefix = f"{time.strftime('%Y%m%d-%H%M%S')}-{socket.gethostname()}-{os.getpid()}"
+        self._numbers = itertools.count(1)
+        self._slots = queue.Queue()
+        for _ in range(max(1, writers)):
+            self._slots.put(None)  # a slot holds its open shard, or None until it writes
+        self._closed = False
+        self._lock = threading.Lock()
+        os.makedirs(self.folder, exist_ok=True)
+
+    def write(self, outputs):
+        """Adds [(output path, bytes or file)] (one file's outputs) to one shard; returns the shard's final path.
+
+        Files (e.g. the spooled outputs of tagLargeImage) are copied from the start and closed afterwards.
+        """
+        shard = self._slots.get()
+        try:
+            if shard is None:
+                shard = _Shard(os.path.join(self.folder, f"{self.prefix}-{next(self._numbers):05d}.{self.format}"),
+                               self.format)
+            for output_path, data in outputs:
+                shard.add(archiveName(output_path), data)
+            path = shard.path
+            if shard.size >= self.shardBytes:
+                shard.close()
+                shard = None
+            return path
+        finally:
+            self._slots.put(shard)
+            for _, data in outputs:
+                if not isinstance(data, bytes):
+                    data.close()
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        while True:
+            try:
+                shard = self._slots.get_nowait()
+            except queue.Empty:
+                return
+            if shard is not None:
+                shard.close()
+
+
+def openArchiveSink(settings):
+    # The sink for settings.outputArchive, or None when outputs go to tagged/ folders
+    if not settings.outputArchive:
+        return None
+    return ArchiveSink(settings.archiveFolder, settings.outputArchive, settings.archiveShardMB * 1024 * 1024,
+                       settings.writerThreads)
+
+
+class ArchiveIndex:
+    """Random access to the outputs in an archive folder, through the shards' indexes (no archive is scanned)."""
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.entries = {}  # entry name -> (shard path, data offset, size, compressed size)
+        for name in sorted(os.listdir(folder)):
+            if not name.endswith(INDEX_SUFFIX):
+                continue
+            with open(os.path.join(folder, name)) as f:
+                index = json.load(f)
+            shard_path = os.path.join(folder, index['archive'])
+            for entry, (offset, size, compressed_size) in index['entries'].items():
+                self.entries[entry] = (shard_path, offset, size, compressed_size)
+
+    def __contains__(self, output_path):
+        return archiveName(output_path) in self.entries
+
+    def read(self, output_path):
+        shard_path, offset, size, compressed_size = self.entries[archiveName(output_path)]
+        with open(shard_path, 'rb') as f:
+            f.seek(offset)
+            if compressed_size is None:
+                return f.read(size)
+            return zlib.decompressobj(-zlib.MAX_WBITS).decompress(f.read(compressed_size))
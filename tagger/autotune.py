@@ -0,0 +1,232 @@
+import json
+import os
+import threading
+import time
+
+from .settings import _writeAtomically, defaultConfigPath
+
+TUNING_FILE_NAME = 'autotune.json'
+TUNING_VERSION = 1
+# Upper bound for the tuner; slow network storage can want far more threads than cores
+AUTO_MAX_THREADS = 64
+
+
+def availableCpuCount():
+    if hasattr(os, 'sched_getaffinity'):
+        return max(1, len(os.sched_getaffinity(0)))
+    return os.cpu_count() or 1
+
+
+def autoMaxThreads(cpuCount=None):
+    return min(AUTO_MAX_THREADS, max(20, 4 * (cpuCount or availableCpuCount())))
+
+
+def defaultTuningPath(configPath=None):
+    # Next to the config file in use, so a separate --config also keeps its own tuning
+    return os.path.join(os.path.dirname(configPath or defaultConfigPath()), TUNING_FILE_NAME)
+
+
+def _cpuTimes():
+    # (iowait, total) jiffies from the aggregate cpu line of /proc/stat; None where that is not available
+    try:
+        with open('/proc/stat') as f:
+            values = [int(value) for value in f.readline().split()[1:]]
+    except (OSError, ValueError):
+        return None
+    if len(values) < 5:
+        return None
+    return values[4], sum(values[:8])
+
+
+class ConcurrencyGate:
+    """A semaphore whose limit can be changed while workers are waiting on it.
+
+    Lowering the limit never interrupts a file; it only holds back the next ones until enough have finished.
+    """
+
+    def __init__(self, limit):
+        self.limit = max(1, limit)
+        self.active = 0
+        self._condition = threading.Condition()
+
+    def setLimit(self, limit):
+        with self._condition:
+            self.limit = max(1, limit)
+            self._condition.notify_all()
+
+    def acquire(self, control=None):
+        with self._condition:
+            while self.active >= self.limit:
+                if control is not None and control.cancelled:
+                    return False
+                self._condition.wait(0.25)
+            self.active += 1
+            return True
+
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+
+class ThroughputTuner:
+    """Hill-climbs the number of concurrently tagged files towards the highest measured files/s.
+
+    Each level is held for a measurement window (at least minSeconds and a couple of files per worker).
+    The tuner keeps stepping in one direction while throughput improves by more than `gain`, turns back once
+    it doesn't, and settles on the best level after both directions stopped paying off. Measured I/O wait picks
+    the first direction and the step size: waiting on the disk means more files in flight can hide latency,
+    while saturated CPUs with no I/O wait mean more threads than cores only add contention. If throughput
+    later drops well below the settled rate (e.g. the image mix changed) it starts exploring again.
+    """
+
+    def __init__(self, gate, start, maxLevel=None, cpuCount=None, minSeconds=1.0, gain=0.05):
+        self.gate = gate
+        self.cpuCount = cpuCount or availableCpuCount()
+        self.maxLevel = max(1, maxLevel or autoMaxThreads(self.cpuCount))
+        self.minSeconds = minSeconds
+        self.gain = gain
+        self.samples = {}  # level -> best files/s measured at it
+        self.history = []  # (level, files/s, iowait, cpu busy) per window
+        self.settled = False
+        self.direction = None
+        self._previous = None
+        self._turned = False
+        self._step = None
+        self._setLevel(start)
+
+    @property
+    def level(self):
+        return self.gate.limit
+
+    @property
+    def best(self):
+        if not self.samples:
+            return None
+        return max(self.samples, key=self.samples.get)
+
+    def describe(self):
+        state = "settled" if self.settled else "tuning"
+        return f"{self.level} threads ({state})"
+
+    def _setLevel(self, level):
+        self.gate.setLimit(min(self.maxLevel, max(1, level)))
+        self._startWindow()
+
+    def resetWindow(self):
+        self._startWindow()
+
+    def _startWindow(self):
+        self._files = 0
+        self._started = time.perf_counter()
+        self._cpuStarted = time.process_time()
+        self._ioStarted = _cpuTimes()
+
+    def observe(self, result):
+        # Called once per finished file; skipped and cancelled files did no work and are not counted
+        if result.status not in ('success', 'failed'):
+            return
+        self._files += 1
+        elapsed = time.perf_counter() - self._started
+        if elapsed < self.minSeconds or self._files < max(4, 2 * self.level):
+            return
+        rate = self._files / elapsed
+        cpu_busy = (time.process_time() - self._cpuStarted) / elapsed / self.cpuCount
+        iowait = None
+        io_now = _cpuTimes()
+        if io_now is not None and self._ioStarted is not None and io_now[1] > self._ioStarted[1]:
+            iowait = (io_now[0] - self._ioStarted[0]) / (io_now[1] - self._ioStarted[1])
+        self.history.append((self.level, rate, iowait, cpu_busy))
+        self._adjust(rate, iowait, cpu_busy)
+
+    def _adjust(self, rate, iowait, cpu_busy):
+        level = self.level
+        if self.settled:
+            if rate < self.samples[level] * 0.7:
+                # Conditions changed: forget the old measurements and explore again from here
+                self.samples = {level: rate}
+                self.settled = False
+                self._previous = None
+                self._turned = False
+                self._step = None
+                self.direction = None
+            else:
+                self.samples[level] = max(self.samples[level], rate)
+                self._startWindow()
+                return
+        self.samples[level] = max(self.samples.get(level, 0.0), rate)
+
+        io_bound = iowait is not None and iowait > 0.2
+        cpu_bound = cpu_busy > 0.9 and not io_bound
+        if self.direction is None:
+            self.direction = -1 if cpu_bound and level > self.cpuCount else 1
+        elif self._previous is not None and rate <= self.samples[self._previous] * (1 + self.gain):
+            # No worthwhile gain over the level we came from: go back the other way, or stop if we already did
+            if self._turned:
+                self._settle()
+                return
+            self._turned = True
+            self.direction = -self.direction
+            level = self.best
+
+        if self._turned and self._step is not None:
+            step = max(1, self._step // 2)  # finer steps on the way back
+        else:
+            step = max(1, level // 2 if io_bound else level // 4)
+        target = level + self.direction * step
+        if target < 1 or target > self.maxLevel or target in self.samples:
+            if self._turned:
+                self._settle()
+                return
+            self._turned = True
+            self.direction = -self.direction
+            target = level + self.direction * step
+            if target < 1 or target > self.maxLevel or target in self.samples:
+                self._settle()
+                return
+        self._previous = level
+        self._step = step
+        self._setLevel(target)
+
+    def _settle(self):
+        self.settled = True
+        self._setLevel(self.best)
+
+
+class TuningStore:
+    """Remembers the concurrency the tuner settled on for each target folder, so the next run starts there.
+
+    Kept next to the GUI config as autotune.json: {folder: {mode: {"threads": n, "filesPerSecond": r}}}.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or defaultTuningPath()
+        self._lock = threading.Lock()
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            if data.get('version') == TUNING_VERSION:
+                return data.get('folders', {})
+        except Exception:
+            pass
+        return {}
+
+    def lookup(self, folders, mode):
+        # The level recorded for the first of these folders that has one
+        recorded = self._load()
+        for folder in folders:
+            entry = recorded.get(os.path.abspath(folder), {}).get(mode)
+            if entry and entry.get('threads'):
+                return int(entry['threads'])
+        return None
+
+    def record(self, folders, mode, threads, filesPerSecond=None):
+        with self._lock:
+            recorded = self._load()
+            for folder in folders:
+                recorded.setdefault(os.path.abspath(folder), {})[mode] = {
+                    'threads': threads, 'filesPerSecond': filesPerSecond, 'updated': int(time.time())}
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            _writeAtomically(json.dumps({'version': TUNING_VERSION, 'folders': recorded}), self.path)
@@ -0,0 +1,372 @@
+"""Reproducible benchmark for the tagging pipeline.
+
+    python -m tagger.benchmark --profile quick --threads 1,2,4,8 --output results.json
+    python -m tagger.benchmark --compare results.json
+
+Generates a deterministic synthetic corpus (same seed, same images), times every stage of tagging one
+file at a time, then measures whole-batch throughput and peak RSS for each execution mode and thread
+count. Results are written as JSON; --compare flags runs that got slower than a previous result file.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+from PyQt5.QtCore import QRect, Qt, QT_VERSION_STR
+from PyQt5.QtGui import QColor, QFont, QImage, QLinearGradient, QPainter
+
+from .engine import TaggingEngine, tagFile
+from .gifwriter import GifEncoder
+from .imaging import ensureGuiApplication
+from .settings import OUTPUT_FOLDER_NAME, TagSettings
+
+RESULTS_VERSION = 1
+CORPUS_SPEC_FILE = 'corpus.json'
+STAGES = ('read', 'decode', 'scale', 'draw', 'encode', 'write')
+GIF_FRAMES = 12  # GIFs in the corpus are animations
+
+# (width, height, format, count) per profile; 'full' adds the 24 MP and 100 MP cases
+PROFILES = {
+    'quick': [
+        (640, 480, 'png', 8), (640, 480, 'jpg', 8), (640, 480, 'bmp', 4), (640, 480, 'gif', 4),
+        (1920, 1080, 'jpg', 8), (1920, 1080, 'png', 4), (4000, 3000, 'jpg', 4), (4000, 3000, 'png', 2),
+    ],
+}
+PROFILES['full'] = PROFILES['quick'] + [(6000, 4000, 'jpg', 4), (6000, 4000, 'png', 2), (12000, 8400, 'jpg', 1)]
+
+
+def writeGif(image, path, rng, frames=GIF_FRAMES):
+    # An animation over the synthetic image: a block moving across it, so most rows stay the same between frames
+    encoder = GifEncoder(image.width(), image.height(), loopCount=-1)
+    width, height = image.width(), image.height()
+    color = QColor(rng.randrange(256), rng.randrange(256), rng.randrange(256))
+    for n in range(frames):
+        frame = QImage(image)
+        painter = QPainter(frame)
+        painter.fillRect(width * n // frames, height // 3, max(1, width // 8), max(1, height // 6), color)
+        painter.end()
+        encoder.addImage(frame, delay=80)
+    with open(path, 'wb') as f:
+        f.write(encoder.finish())
+    return True
+
+
+def syntheticImage(width, height, rng):
+    # Gradient plus blocks and text: compresses like a photo-ish screenshot rather than a flat fill
+    image = QImage(width, height, QImage.Format_RGB32)
+    painter = QPainter(image)
+    gradient = QLinearGradient(0, 0, width, height)
+    gradient.setColorAt(0, QColor(rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+    gradient.setColorAt(1, QColor(rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+    painter.fillRect(image.rect(), gradient)
+    for _ in range(40):
+        painter.fillRect(rng.randrange(width), rng.randrange(height), rng.randrange(1, width // 4 + 2),
+                         rng.randrange(1, height // 4 + 2),
+                         QColor(rng.randrange(256), rng.randrange(256), rng.randrange(256), rng.randrange(64, 256)))
+    painter.setFont(QFont('Arial', max(8, height // 20)))
+    painter.setPen(QColor(rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+    painter.drawText(QRect(0, 0, width, height // 2), Qt.AlignCenter, f"{width}x{height} #{rng.randrange(10 ** 6)}")
+    painter.end()
+    return image
+
+
+def generateCorpus(folder, profile='quick', seed=1):
+    """Creates the corpus in folder, or reuses it if it was generated with the same profile and seed.
+
+    A folder holding an older corpus is emptied first; any other folder that isn't empty is left alone and
+    raises ValueError.
+    """
+    spec = {'profile': profile, 'seed': seed, 'images': PROFILES[profile], 'gifFrames': GIF_FRAMES}
+    spec_path = os.path.join(folder, CORPUS_SPEC_FILE)
+    try:
+        with open(spec_path) as f:
+            existing = json.load(f)
+        if existing.get('spec') == json.loads(json.dumps(spec)):
+            return existing
+    except (OSError, ValueError):
+        pass
+
+    if os.path.isfile(spec_path):
+        shutil.rmtree(folder)
+    elif os.path.isdir(folder) and os.listdir(folder):
+        raise ValueError(f"{folder} is not empty and holds no benchmark corpus; pick an empty or new folder")
+    ensureGuiApplication()
+    os.makedirs(folder, exist_ok=True)
+    rng = random.Random(seed)
+    files, skipped = [], []
+    for index, (width, height, image_format, count) in enumerate(PROFILES[profile]):
+        for n in range(count):
+            image = syntheticImage(width, height, rng)
+            path = os.path.join(folder, f"{index:02d}-{width}x{height}-{n}.{image_format}")
+            written = writeGif(image, path, rng) if image_format == 'gif' else image.save(path)
+            if written:
+                files.append(path)
+            elif image_format not in skipped:
+                skipped.append(image_format)
+    corpus = {
+        'spec': spec,
+        'files': len(files),
+        'bytes': sum(os.path.getsize(path) for path in files),
+        'megapixels': round(sum(w * h * c for w, h, f, c in PROFILES[profile] if f not in skipped) / 1e6, 1),
+        'skippedFormats': skipped,
+    }
+    with open(spec_path, 'w') as f:
+        json.dump(corpus, f, indent=2)
+    return corpus
+
+
+def corpusFiles(folder):
+    return sorted(os.path.join(folder, name) for name in os.listdir(folder)
+                  if name != CORPUS_SPEC_FILE and os.path.isfile(os.path.join(folder, name)))
+
+
+class PeakRssSampler:
+    """Samples this process's resident set size on a background thread; peakBytes is the maximum seen."""
+
+    def __init__(self, interval=0.02):
+        self.interval = interval
+        self.peakBytes = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='PeakRssSampler', daemon=True)
+
+    @staticmethod
+    def currentRss():
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError, AttributeError):
+            pass
+        try:
+            import psutil
+            return psutil.Process().memory_info().rss
+        except ImportError:
+            return None
+
+    def _run(self):
+        while not self._stop.is_set():
+            rss = self.currentRss()
+            if rss is not None and (self.peakBytes is None or rss > self.peakBytes):
+                self.peakBytes = rss
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def summarize(samples):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return {
+        'count': len(ordered),
+        'total': round(sum(ordered), 6),
+        'mean': round(statistics.fmean(ordered), 6),
+        'p50': round(ordered[len(ordered) // 2], 6),
+        'p95': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 6),
+        'max': round(ordered[-1], 6),
+    }
+
+
+def timeStages(files, settings):
+    """Tags each file on this thread with stage timings on; returns {stage: summary} overall and by format."""
+    ensureGuiApplication()
+    settings = settings.snapshot(collectTimings=True, incremental=False)
+    timings = {stage: [] for stage in STAGES}
+    by_format = {}
+    failed = 0
+    for file_path in files:
+        result = tagFile(file_path, settings)
+        if result.status != 'success':
+            failed += 1
+            continue
+        image_format = os.path.splitext(file_path)[1].lstrip('.').lower()
+        for stage, seconds in result.timings.items():
+            timings.setdefault(stage, []).append(seconds)
+            by_format.setdefault(image_format, {}).setdefault(stage, []).append(seconds)
+    return {
+        'stages': {stage: summarize(samples) for stage, samples in timings.items()},
+        'byFormat': {image_format: {stage: summarize(samples) for stage, samples in stages.items()}
+                     for image_format, stages in sorted(by_format.items())},
+        'failed': failed,
+    }
+
+
+def timeRun(files, settings, mode, threads):
+    source_bytes = sum(os.path.getsize(path) for path in files)
+    # threads may be 'auto': the engine tunes the level during the run and the one it settled on is reported
+    auto = threads == 'auto'
+    workers = settings.threadCount if auto else threads
+    engine = TaggingEngine(settings.snapshot(executionMode=mode, threadCount=workers, processCount=workers,
+                                             autoThreads=auto, incremental=False))
+    counts = {}
+    with PeakRssSampler() as sampler:
+        start = time.perf_counter()
+        for result in engine.run(files):
+            counts[result.status] = counts.get(result.status, 0) + 1
+        seconds = time.perf_counter() - start
+    return {
+        'mode': mode,
+        'threads': threads,
+        'files': len(files),
+        'succeeded': counts.get('success', 0),
+        'failed': counts.get('failed', 0),
+        'seconds': round(seconds, 4),
+        'filesPerSecond': round(len(files) / seconds, 2) if seconds > 0 else None,
+        'mbPerSecond': round(source_bytes / 1e6 / seconds, 2) if seconds > 0 else None,
+        # Worker processes are not included in process mode
+        'peakRssMB': round(sampler.peakBytes / 2 ** 20, 1) if sampler.peakBytes else None,
+        'tunedThreads': engine.tuner.best if engine.tuner is not None else None,
+    }
+
+
+def timeAnimations(files, settings):
+    """Tags the GIFs one file at a time, so the frame pool is all the parallelism; reports frames/s.
+
+    The rate is bound by LZW compression (pure Python, on the compression processes), not by drawing.
+    """
+    gifs = [path for path in files if path.lower().endswith('.gif')]
+    if not gifs:
+        return None
+    engine = TaggingEngine(settings.snapshot(threadCount=1, autoThreads=False, incremental=False))
+    frames = 0
+    start = time.perf_counter()
+    for result in engine.run(gifs):
+        frames += result.frames or 0
+    seconds = time.perf_counter() - start
+    return {
+        'files': len(gifs),
+        'frames': frames,
+        'seconds': round(seconds, 4),
+        'framesPerSecond': round(frames / seconds, 2) if seconds > 0 else None,
+    }
+
+
+def runBenchmark(corpusFolder, profile='quick', seed=1, threadCounts=(1, 2, 4, 8), modes=('thread',),
+                 settings=None, repeat=1):
+    settings = settings or TagSettings(incremental=False)
+    corpus = generateCorpus(corpusFolder, profile, seed)
+    files = corpusFiles(corpusFolder)
+    timeStages(files[:2], settings)  # warm up fonts, plugins and the overlay cache
+    results = {
+        'version': RESULTS_VERSION,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'environment': {
+            'python': platform.python_version(),
+            'qt': QT_VERSION_STR,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+        },
+        'corpus': corpus,
+        'settings': settings.toConfig(),
+        'stages': timeStages(files, settings),
+        'animations': timeAnimations(files, settings),
+        'runs': [],
+    }
+    for mode in modes:
+        for threads in threadCounts:
+            # Keep the fastest of the repeats: the least disturbed by whatever else the machine is doing
+            runs = [timeRun(files, settings, mode, threads) for _ in range(max(1, repeat))]
+            results['runs'].append(min(runs, key=lambda run: run['seconds']))
+    shutil.rmtree(os.path.join(corpusFolder, OUTPUT_FOLDER_NAME), ignore_errors=True)
+    return results
+
+
+def compareResults(baseline, current, tolerance=0.1):
+    """Returns a list of human-readable regressions: runs slower, or stages with a higher mean, by more than tolerance."""
+    regressions = []
+    baseline_runs = {(run['mode'], run['threads']): run for run in baseline.get('runs', [])}
+    for run in current.get('runs', []):
+        before = baseline_runs.get((run['mode'], run['threads']))
+        if before and before.get('filesPerSecond') and run.get('filesPerSecond') is not None:
+            change = run['filesPerSecond'] / before['filesPerSecond'] - 1
+            if change < -tolerance:
+                regressions.append(f"{run['mode']} x{run['threads']}: {before['filesPerSecond']} -> "
+                                   f"{run['filesPerSecond']} files/s ({change:+.0%})")
+    before, after = baseline.get('animations') or {}, current.get('animations') or {}
+    if before.get('framesPerSecond') and after.get('framesPerSecond') is not None:
+        change = after['framesPerSecond'] / before['framesPerSecond'] - 1
+        if change < -tolerance:
+            regressions.append(f"GIF animations: {before['framesPerSecond']} -> {after['framesPerSecond']} frames/s ({change:+.0%})")
+    baseline_stages = baseline.get('stages', {}).get('stages', {})
+    for stage, summary in current.get('stages', {}).get('stages', {}).items():
+        before = baseline_stages.get(stage)
+        if summary and before and before.get('mean'):
+            change = summary['mean'] / before['mean'] - 1
+            if change > tolerance:
+                regressions.append(f"{stage}: mean {before['mean'] * 1000:.2f} -> {summary['mean'] * 1000:.2f} ms ({change:+.0%})")
+    return regressions
+
+
+def formatReport(results):
+    lines = [f"{results['corpus']['files']} files, {results['corpus']['bytes'] / 1e6:.1f} MB, "
+             f"{results['corpus']['megapixels']} MP"]
+    if results['corpus']['skippedFormats']:
+        lines.append(f"skipped formats (no writer available): {', '.join(results['corpus']['skippedFormats'])}")
+    for stage, summary in results['stages']['stages'].items():
+        if summary:
+            lines.append(f"  {stage:<7} mean {summary['mean'] * 1000:8.2f} ms  p95 {summary['p95'] * 1000:8.2f} ms  "
+                         f"total {summary['total']:.2f} s")
+    animations = results.get('animations')
+    if animations:
+        lines.append(f"  GIF      {animations['frames']} frames in {animations['files']} files: "
+                     f"{animations['framesPerSecond']:.2f} frames/s (encode-bound)")
+    for run in results['runs']:
+        rss = f"{run['peakRssMB']} MB" if run['peakRssMB'] is not None else "n/a"
+        tuned = f"  settled on {run['tunedThreads']}" if run.get('tunedThreads') else ""
+        lines.append(f"  {run['mode']:<8} x{run['threads']:<4} {run['filesPerSecond']:8.2f} files/s "
+                     f"{run['mbPerSecond']:8.2f} MB/s  peak RSS {rss}  ({run['failed']} failed){tuned}")
+    return "\n".join(lines)
+
+
+def buildParser():
+    parser = argparse.ArgumentParser(prog='python -m tagger.benchmark', description="Benchmark the tagging pipeline on a synthetic corpus.")
+    parser.add_argument('--corpus', help="Folder for the generated corpus (reused when profile and seed match)")
+    parser.add_argument('--profile', choices=sorted(PROFILES), default='quick', help="'full' adds 24 MP and 100 MP images")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--threads', default='1,2,4,8', help="Comma-separated thread counts to run; 'auto' runs with autotuning")
+    parser.add_argument('--modes', default='thread', help="Comma-separated execution modes (thread, process, pipeline)")
+    parser.add_argument('--downsize', type=int, default=0, help="Also downsize to this smallest side")
+    parser.add_argument('--repeat', type=int, default=1, help="Runs per configuration; the fastest is kept")
+    parser.add_argument('--output', help="Write the results as JSON to this file")
+    parser.add_argument('--compare', help="Previous results JSON to flag regressions against")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="Slowdown ratio counted as a regression")
+    return parser
+
+
+def main(argv=None):
+    args = buildParser().parse_args(argv)
+    corpus = args.corpus or os.path.join(tempfile.gettempdir(), f"autotagger-benchmark-{args.profile}-{args.seed}")
+    settings = TagSettings(incremental=False, downsizeImage=args.downsize > 0, downsizeValue=args.downsize or 800)
+    try:
+        results = runBenchmark(corpus, args.profile, args.seed, [n if n == 'auto' else int(n) for n in args.threads.split(',')],
+                               args.modes.split(','), settings, args.repeat)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 2
+    print(formatReport(results))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compareResults(json.load(f), results, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,262 @@
+import argparse
+import json
+import signal
+import sys
+import threading
+import time
+
+from .autotune import TuningStore, defaultTuningPath
+from .engine import TaggingEngine
+from .instrumentation import RunReport
+from .progress import ProgressChannel
+from .settings import TagSettings, defaultConfigPath, loadConfigFile
+
+
+PROGRESS_INTERVAL = 1.0
+WATCH_STATUS_INTERVAL = 60.0
+
+
+def threadCountArg(value):
+    if value == 'auto':
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected a number or 'auto', got {value!r}")
+
+
+def buildParser():
+    parser = argparse.ArgumentParser(prog='autotagger', description="Tag every image in the given folders without opening the GUI.")
+    parser.add_argument('folders', nargs='*', help="Folders to process (defaults to the folders saved by the GUI)")
+    parser.add_argument('--config', default=None, help="Config file to take defaults from (default: the GUI config)")
+    parser.add_argument('--no-config', action='store_true', help="Ignore the saved config and use built-in defaults")
+    parser.add_argument('--text', dest='customText')
+    parser.add_argument('--font', dest='fontFamily')
+    parser.add_argument('--font-size', dest='fontSize', type=int)
+    parser.add_argument('--color', dest='textColor')
+    parser.add_argument('--offset', dest='textYOffsetRatio', type=float, help="Height of the text band as a ratio of the image height")
+    parser.add_argument('--downsize', dest='downsizeValue', type=int, help="Downsize so the smallest side is at most this many pixels")
+    parser.add_argument('--threads', dest='threadCount', type=threadCountArg,
+                        help="Files tagged at once, or 'auto' to tune it during the run and remember it per folder")
+    parser.add_argument('--mode', dest='executionMode', choices=('thread', 'process', 'pipeline', 'distributed'),
+                        help="Tag on a thread pool, on worker processes, in a read/render/write pipeline, or hand "
+                             "batches to --worker processes on this or other machines")
+    parser.add_argument('--workers', dest='processCount', type=int, help="Worker processes in process mode (default: one per physical core)")
+    parser.add_argument('--chunk-size', dest='chunkSize', type=int, help="Files handed to a worker process at a time")
+    parser.add_argument('--readers', dest='readerThreads', type=int, help="Pipeline mode: threads reading source files")
+    parser.add_argument('--writers', dest='writerThreads', type=int, help="Pipeline mode: threads writing tagged files")
+    parser.add_argument('--memory-budget', dest='memoryBudgetMB', type=int,
+                        help="MB of decoded image data allowed in flight at once (default: half of physical memory)")
+    parser.add_argument('--max-in-flight', dest='maxInFlight', type=int,
+                        help="Files (threads) or chunks (processes) queued ahead of the workers")
+    parser.add_argument('--format', dest='outputFormat',
+                        help="Write tagged copies in this format (jpeg, png, webp, ...) instead of the source's; GIFs stay GIFs")
+    parser.add_argument('--jpeg-quality', dest='jpegQuality', type=int, help="JPEG quality 0-100 (default: Qt's, 75)")
+    parser.add_argument('--jpeg-optimize', dest='jpegOptimize', action='store_const', const=True,
+                        help="Optimise JPEG Huffman tables: a few percent smaller, slower to encode")
+    parser.add_argument('--webp-quality', dest='webpQuality', type=int, help="WebP quality 0-100 (100 = lossless)")
+    parser.add_argument('--png-compression', dest='pngCompression', type=int, choices=range(10), metavar='0-9',
+                        help="PNG zlib level: 0 is fastest and largest, 9 smallest and slowest (default 6)")
+    parser.add_argument('--strip-metadata', dest='keepMetadata', action='store_const', const=False,
+                        help="Leave text metadata (PNG text chunks, JPEG comments) out of the tagged copies")
+    parser.add_argument('--large-image-mp', dest='largeImageMegapixels', type=int,
+                        help="Tag images of at least this many megapixels band-only, without decoding the whole frame (0 = never)")
+    parser.add_argument('--archive', dest='outputArchive', choices=('tar', 'zip'),
+                        help="Write tagged copies into tar or zip shards in --archive-folder instead of tagged/ folders")
+    parser.add_argument('--archive-folder', dest='archiveFolder', help="Folder for the archive shards and their indexes")
+    parser.add_argument('--archive-shard-mb', dest='archiveShardMB', type=int,
+                        help="Start a new archive shard once the current one reaches this many MB (default 1024)")
+    parser.add_argument('--profile', dest='activeProfiles', action='append', metavar='NAME',
+                        help="Write the variant of this profile from the config (repeat for several; each file is decoded once)")
+    parser.add_argument('--listen', dest='coordinatorAddress', metavar='ADDRESS',
+                        help="Distributed mode: host:port or unix:/path to accept workers on (default 127.0.0.1:47800)")
+    parser.add_argument('--lease', dest='leaseSeconds', type=float,
+                        help="Distributed mode: seconds a silent worker keeps its batch before it goes to another worker")
+    parser.add_argument('--worker', metavar='ADDRESS',
+                        help="Work for the coordinator at ADDRESS instead of tagging folders: tag the batches it hands "
+                             "out with its settings (--mode, --threads etc. still apply here) until it is done")
+    parser.add_argument('--all-profiles', action='store_true', help="Write the variants of every profile in the config")
+    parser.add_argument('-r', '--subfolders', action='store_true', help="Include subfolders")
+    parser.add_argument('--force', action='store_true', help="Re-tag every file, even if the manifest says it is up to date")
+    parser.add_argument('--hash', action='store_true', help="Compare source contents, not just size and mtime, when deciding what changed")
+    parser.add_argument('--timings', action='store_true', help="Time each stage of every file and print p50/p95/p99 per stage")
+    parser.add_argument('--report', help="Write a run report (stage histograms, slowest files, error reasons) to this .json or .csv file")
+    parser.add_argument('--watch', action='store_true',
+                        help="Keep running and tag images as they land in the folders (Ctrl+C stops)")
+    parser.add_argument('--poll', action='store_true',
+                        help="Watch by rescanning instead of inotify (automatic on network mounts)")
+    parser.add_argument('--settle', type=float, default=2.0,
+                        help="Watch mode: seconds a file must stop changing before it is tagged")
+    parser.add_argument('--json', action='store_true', help="Print one JSON object per file instead of plain text")
+    parser.add_argument('-q', '--quiet', action='store_true', help="Only print failures and the summary")
+    parser.add_argument('--progress', action='store_true',
+                        help="Print throughput and ETA (and pipeline queue depths) to stderr every second")
+    return parser
+
+
+def argOverrides(args):
+    # Settings given on the command line, apart from profiles
+    overrides = {key: value for key, value in vars(args).items()
+                 if key in ('customText', 'fontFamily', 'fontSize', 'textColor', 'textYOffsetRatio', 'downsizeValue', 'threadCount',
+                            'executionMode', 'processCount', 'chunkSize', 'memoryBudgetMB', 'maxInFlight',
+                            'readerThreads', 'writerThreads', 'largeImageMegapixels', 'coordinatorAddress', 'leaseSeconds',
+                            'outputArchive', 'archiveFolder', 'archiveShardMB', 'outputFormat', 'jpegQuality',
+                            'jpegOptimize', 'webpQuality', 'pngCompression', 'keepMetadata')
+                 and value is not None}
+    if args.downsizeValue is not None:
+        overrides['downsizeImage'] = args.downsizeValue > 0
+    if args.threadCount == 'auto':
+        overrides.pop('threadCount')
+        overrides['autoThreads'] = True
+    elif args.threadCount is not None:
+        overrides['autoThreads'] = False
+    if args.force:
+        overrides['incremental'] = False
+    if args.hash:
+        overrides['manifestContentHash'] = True
+    if args.timings or args.report:
+        overrides['collectTimings'] = True
+    return overrides
+
+
+def settingsFromArgs(args):
+    config = {} if args.no_config else loadConfigFile(args.config or defaultConfigPath())
+    settings = TagSettings.fromConfig(config)
+    overrides = argOverrides(args)
+    if args.all_profiles:
+        overrides['activeProfiles'] = [profile.get('name') for profile in settings.profiles]
+    elif args.activeProfiles:
+        overrides['activeProfiles'] = args.activeProfiles
+    return settings.snapshot(**overrides), config.get('selectedFolders', [])
+
+
+def installSignalHandlers(engine):
+    # Ctrl+C cancels files that have not started yet (a second one aborts); SIGUSR1 toggles pause
+    def interrupted(signum, frame):
+        if engine.control.cancelled:
+            raise KeyboardInterrupt
+        print("Cancelling, waiting for files in progress...", file=sys.stderr, flush=True)
+        engine.cancel()
+
+    def togglePause(signum, frame):
+        if engine.control.paused:
+            engine.resume()
+        else:
+            engine.pause()
+        print("Paused" if engine.control.paused else "Resumed", file=sys.stderr, flush=True)
+
+    signal.signal(signal.SIGINT, interrupted)
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, togglePause)
+
+
+def describeProgress(engine, progress):
+    text = progress.snapshot().describe()
+    if engine.pipeline is not None:
+        text += f"  [{engine.pipeline.describe()}]"
+    if engine.tuner is not None:
+        text += f"  [{engine.tuner.describe()}]"
+    if engine.coordinator is not None:
+        text += f"  [{engine.coordinator.describe()}]"
+    return text
+
+
+def reportWatchStatus(engine, progress, interval, stopped):
+    # A watch can sit idle for hours without results, so its status comes from a timer rather than the result loop
+    while not stopped.wait(interval):
+        progress.drain()
+        snapshot = progress.snapshot()
+        watcher = engine.discovery
+        backlog = max(0, snapshot.total - snapshot.completed) + watcher.settling
+        print(f"{describeProgress(engine, progress)}  backlog {backlog} ({watcher.settling} still being written)",
+              file=sys.stderr, flush=True)
+
+
+def printResult(result, args):
+    if args.json:
+        print(json.dumps(vars(result)), flush=True)
+    elif not args.quiet or result.status == 'failed':
+        suffix = f" ({result.error})" if result.error else ""
+        print(f"{result.file_path} - {result.status.capitalize()}{suffix}", flush=True)
+
+
+def workForCoordinator(args):
+    # The coordinator decides what to tag and how; only how this machine runs it comes from the arguments
+    from .distributed import runWorker as workFor
+    try:
+        tagged = workFor(args.worker, argOverrides(args), onResult=lambda result: printResult(result, args))
+    except (OSError, ValueError) as e:
+        print(f"Could not work for the coordinator at {args.worker}: {e}", file=sys.stderr)
+        return 2
+    print(f"{tagged} files tagged for the coordinator at {args.worker}", file=sys.stderr)
+    return 0
+
+
+def main(argv=None):
+    args = buildParser().parse_args(argv)
+    if args.worker:
+        return workForCoordinator(args)
+    settings, savedFolders = settingsFromArgs(args)
+    folders = args.folders or savedFolders
+    if not folders:
+        print("No folders given and none saved in the config.", file=sys.stderr)
+        return 2
+
+    progress = ProgressChannel()
+    report = RunReport()
+    tuningStore = TuningStore(defaultTuningPath(args.config))
+    try:
+        engine = TaggingEngine(settings, progress=progress, report=report, tuningStore=tuningStore)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 2
+    installSignalHandlers(engine)
+    last_report = time.monotonic()
+    stopped = threading.Event()
+    if args.watch:
+        results = engine.watchFolders(folders, args.subfolders, settle=args.settle, usePolling=args.poll or None)
+        reporter = threading.Thread(target=reportWatchStatus, name='WatchStatus', daemon=True,
+                                    args=(engine, progress, PROGRESS_INTERVAL if args.progress else WATCH_STATUS_INTERVAL,
+                                          stopped))
+        reporter.start()
+    else:
+        results = engine.processFolders(folders, args.subfolders)
+    if engine.mode == 'distributed':
+        print(f"Waiting for workers on {settings.coordinatorAddress} (start them with: python -m tagger --worker ADDRESS)",
+              file=sys.stderr, flush=True)
+    for result in results:
+        printResult(result, args)
+        if not args.watch and time.monotonic() - last_report >= PROGRESS_INTERVAL:
+            last_report = time.monotonic()
+            progress.drain()
+            if args.progress:
+                print(describeProgress(engine, progress), file=sys.stderr, flush=True)
+    stopped.set()
+    if args.watch:
+        reporter.join()
+
+    progress.drain()
+    summary = progress.snapshot()
+    elapsed = summary.elapsed
+    rate = summary.completed / elapsed if elapsed > 0 else 0.0
+    cancelled = f", {summary.cancelled} cancelled" if summary.cancelled else ""
+    tuned = ", auto-tuned" if engine.tuner is not None else ""
+    workers = len(engine.coordinator.workers) if engine.coordinator is not None else engine.workerCount
+    print(f"{summary.completed} files, {summary.skipped} up to date, {summary.failed} failed{cancelled} in {elapsed:.2f}s "
+          f"({rate:.1f} files/s, {workers} {engine.mode} workers{tuned})", file=sys.stderr)
+    if report.frames:
+        print(f"{report.frames} GIF frames ({report.frames / elapsed if elapsed > 0 else 0.0:.1f} frames/s)", file=sys.stderr)
+    if settings.collectTimings:
+        for line in report.describeStages() + report.describeEncodings():
+            print(line, file=sys.stderr)
+    for error in report.summary()['errors']:
+        print(f"{error['count']} failed in {error['stage']}: {error['reason']}", file=sys.stderr)
+    if args.report:
+        report.write(args.report)
+    if summary.cancelled:
+        return 130
+    return 1 if summary.failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,111 @@
+import os
+import queue
+import threading
+
+from .settings import IMAGE_EXTENSIONS, OUTPUT_FOLDER_NAME
+
+_DONE = object()
+# Yielded by live sources (FolderWatcher) while nothing new is ready, so the engine can hand out finished results
+IDLE = object()
+
+
+def isImageName(name):
+    return name.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def scanImageEntries(folders, includeSubfolders=False):
+    # os.scandir keeps the DirEntry type (and on Windows the stat) from the directory listing itself,
+    # so classifying entries needs no extra syscalls; output folders are never walked into
+    for folder in folders:
+        if os.path.basename(os.path.normpath(folder)) == OUTPUT_FOLDER_NAME:
+            continue
+        stack = [folder]
+        while stack:
+            try:
+                with os.scandir(stack.pop()) as entries:
+                    subfolders = []
+                    for entry in entries:
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                if includeSubfolders and entry.name != OUTPUT_FOLDER_NAME:
+                                    subfolders.append(entry.path)
+                            elif isImageName(entry.name) and entry.is_file():
+                                yield entry
+                        except OSError:
+                            continue
+            except OSError:
+                continue
+            stack.extend(reversed(subfolders))
+
+
+def scanSubfolders(folder):
+    try:
+        with os.scandir(folder) as entries:
+            return sorted(entry.path for entry in entries
+                          if entry.name != OUTPUT_FOLDER_NAME and entry.is_dir())
+    except OSError:
+        return []
+
+
+class FileDiscovery:
+    """Walks folders on a background thread and streams DirEntries through a bounded queue.
+
+    Iterate over it to consume files as they are found; `discovered` keeps growing until `finished` is set,
+    and a full queue blocks the walk so a slow consumer never makes it buffer the whole tree.
+    """
+
+    def __init__(self, folders, includeSubfolders=False, maxQueued=10000):
+        self.folders = list(folders)
+        self.includeSubfolders = includeSubfolders
+        self.discovered = 0
+        self.finished = False
+        self._queue = queue.Queue(maxQueued)
+        self._cancelled = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._walk, name='FileDiscovery', daemon=True)
+            self._thread.start()
+        return self
+
+    def cancel(self):
+        self._cancelled.set()
+        # Unblock a walk stuck on a full queue
+        try:
+            while True:
+                self._queue.get_nowait()
+        except queue.Empty:
+            pass
+
+    def _put(self, item):
+        while not self._cancelled.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _walk(self):
+        try:
+            for entry in scanImageEntries(self.folders, self.includeSubfolders):
+                self.discovered += 1
+                if not self._put(entry):
+                    return
+        finally:
+            self.finished = True
+            self._put(_DONE)
+
+    def __iter__(self):
+        self.start()
+        while True:
+            try:
+                item = self._queue.get(timeout=0.1)
+            except queue.Empty:
+                if self._cancelled.is_set():
+                    return
+                continue
+            if item is _DONE:
+                return
+            yield item
@@ -0,0 +1,474 @@
+import itertools
+import json
+import os
+import queue
+import socket
+import threading
+import time
+from collections import deque
+
+from .archive import openArchiveSink
+from .discovery import IDLE
+from .engine import IndexedPath, TagResult, TaggingEngine, chunked
+from .settings import TagSettings
+
+PROTOCOL_VERSION = 1
+DEFAULT_PORT = 47800
+MAX_MESSAGE_BYTES = 16 * 1024 * 1024
+MAX_ATTEMPTS = 3  # times a batch is handed out before its files are reported as failed
+WAIT_SECONDS = 0.5  # how long a worker waits before asking again when there is no batch for it yet
+PREFETCH_LEASES = 1  # leases a worker takes on top of the one it is tagging
+# Settings a worker may set for its own machine; everything else comes from the coordinator
+LOCAL_FIELDS = ('threadCount', 'autoThreads', 'executionMode', 'processCount', 'chunkSize', 'memoryBudgetMB',
+                'maxInFlight', 'readerThreads', 'writerThreads', 'largeImageMegapixels', 'archiveFolder', 'archiveShardMB')
+
+# Protocol: one JSON object per line over a TCP or Unix stream socket.
+#   worker -> coordinator  hello {worker, version}, lease, result {lease, result}, renew
+#   coordinator -> worker  welcome {settings, leaseSeconds}, then per lease: batch {lease, paths, firstIndex},
+#                          wait {seconds} or done
+# A worker may hold a few leases at once (see runWorker), sends a result as each file finishes and renews its
+# leases while it works; a lease that is not renewed for leaseSeconds, or whose worker disconnects, goes back to
+# the queue and is handed out again.
+
+
+def parseAddress(address):
+    # (family, socket address) for 'host:port', ':port', 'port' or 'unix:/path/to/socket'
+    if address.startswith('unix:'):
+        return socket.AF_UNIX, address[len('unix:'):]
+    host, _, port = address.rpartition(':')
+    host = host.strip('[]') or '0.0.0.0'
+    return socket.AF_INET6 if ':' in host else socket.AF_INET, (host, int(port or DEFAULT_PORT))
+
+
+class _Connection:
+    # Newline-delimited JSON messages; send() may be called from several threads
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.reader = sock.makefile('rb')
+        self.lock = threading.Lock()
+        self.peer = sock.getpeername() if sock.family != socket.AF_UNIX else 'local'
+
+    def send(self, message):
+        data = json.dumps(message).encode('utf-8') + b'\n'
+        with self.lock:
+            self.sock.sendall(data)
+
+    def receive(self):
+        line = self.reader.readline(MAX_MESSAGE_BYTES)
+        if not line:
+            raise ConnectionError("Connection closed")
+        if not line.endswith(b'\n'):
+            raise ConnectionError("Message too long")
+        return json.loads(line)
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.reader.close()
+        self.sock.close()
+
+
+class _Lease:
+    # One batch of paths; keeps its identity when it is handed out again after its worker was lost
+    __slots__ = ('paths', 'firstIndex', 'ids', 'worker', 'deadline', 'attempts', 'reported')
+
+    def __init__(self, paths, firstIndex):
+        self.paths = paths
+        self.firstIndex = firstIndex
+        self.ids = []  # every lease id it was handed out under; results for any of them count
+        self.worker = None
+        self.deadline = 0.0
+        self.attempts = 0
+        self.reported = set()  # paths with a result
+
+
+class Coordinator:
+    """Owns discovery, the manifest and the job queue of a distributed run; workers (runWorker) do the tagging.
+
+    Paths are grouped into batches of batchSize and leased to whichever worker asks next, together with the
+    settings snapshot. A lease that is not renewed within leaseSeconds, or whose worker disconnects, is handed
+    to another worker; a batch that lost MAX_ATTEMPTS workers has its remaining files reported as failed.
+    Every worker must see the files under the same paths (e.g. the same mount of the shared storage).
+    """
+
+    def __init__(self, settings, address, batchSize=8, leaseSeconds=120.0, maxQueued=64, control=None, onStart=None):
+        self.settings = settings
+        self.address = address
+        self.batchSize = max(1, batchSize)
+        self.leaseSeconds = leaseSeconds
+        self.maxQueued = max(1, maxQueued)
+        self.control = control
+        self.onStart = onStart
+        self.workers = {}  # worker name -> files it reported
+        self.results = queue.Queue()
+        self._lock = threading.Condition()
+        self._ready = deque()  # batches waiting for a worker, lost ones first
+        self._leased = {}  # lease id -> batch out with a worker
+        self._byId = {}  # every id of a batch that is not finished yet
+        self._fed = False  # every path is in a batch
+        self._ids = itertools.count(1)
+        self._stopped = threading.Event()
+        self._server = None
+        self._connections = set()
+
+    @property
+    def workerCount(self):
+        return len(self._connections)
+
+    def describe(self):
+        with self._lock:
+            return (f"{self.workerCount} workers on {self.address}, {len(self._leased)} batches leased, "
+                    f"{len(self._ready)} queued")
+
+    def listen(self):
+        family, address = parseAddress(self.address)
+        if family == socket.AF_UNIX:
+            if os.path.exists(address):
+                os.unlink(address)  # left over from a coordinator that did not shut down
+            self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._server.bind(address)
+            self._server.listen()
+        else:
+            self._server = socket.create_server(address, family=family, backlog=64)
+            if address[1] == 0:
+                self.address = f"{address[0]}:{self._server.getsockname()[1]}"
+        return self
+
+    def run(self, paths):
+        # paths may contain ready TagResults (e.g. skipped files); they are passed straight through
+        if self._server is None:
+            self.listen()
+        threads = [threading.Thread(target=self._feed, args=(paths,), name='Coordinator-feed', daemon=True),
+                   threading.Thread(target=self._accept, name='Coordinator-accept', daemon=True)]
+        for thread in threads:
+            thread.start()
+        next_check = 0.0
+        try:
+            while True:
+                try:
+                    yield self.results.get(timeout=0.2)
+                except queue.Empty:
+                    pass
+                if time.monotonic() >= next_check:
+                    self._expireLeases()
+                    next_check = time.monotonic() + min(1.0, self.leaseSeconds / 4)
+                with self._lock:
+                    if self._fed and not self._byId and self.results.empty():
+                        return
+        finally:
+            self.close()
+            for thread in threads:
+                thread.join()
+
+    def close(self):
+        self._stopped.set()
+        with self._lock:
+            self._lock.notify_all()
+        if self._server is not None:
+            family = self._server.family
+            try:
+                self._server.close()
+            finally:
+                if family == socket.AF_UNIX:
+                    try:
+                        os.unlink(parseAddress(self.address)[1])
+                    except OSError:
+                        pass
+        for connection in list(self._connections):
+            connection.close()
+
+    def _feed(self, paths):
+        index = 1
+        try:
+            for chunk in chunked(paths, self.batchSize):
+                if self._stopped.is_set() or self._cancelled:
+                    return
+                if chunk is IDLE:
+                    continue
+                for item in chunk:
+                    if isinstance(item, TagResult):
+                        self.results.put(item)
+                chunk = [item for item in chunk if not isinstance(item, TagResult)]
+                if not chunk:
+                    continue
+                with self._lock:
+                    while len(self._ready) >= self.maxQueued and not self._stopped.is_set() and not self._cancelled:
+                        self._lock.wait(0.5)
+                    if self._stopped.is_set() or self._cancelled:
+                        return
+                    batch = _Lease(chunk, index)
+                    batch.ids.append(next(self._ids))
+                    self._byId[batch.ids[-1]] = batch
+                    self._ready.append(batch)
+                index += len(chunk)
+        finally:
+            with self._lock:
+                self._fed = True
+
+    @property
+    def _cancelled(self):
+        return self.control is not None and self.control.cancelled
+
+    def _accept(self):
+        # Polls so close() stops it: closing a socket does not wake a thread blocked in accept() everywhere
+        self._server.settimeout(0.5)
+        while not self._stopped.is_set():
+            try:
+                sock, _ = self._server.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                return  # closed
+            sock.settimeout(None)
+            connection = _Connection(sock)
+            self._connections.add(connection)
+            threading.Thread(target=self._serve, args=(connection,), name='Coordinator-worker', daemon=True).start()
+
+    def _serve(self, connection):
+        worker = None
+        try:
+            hello = connection.receive()
+            if hello.get('type') != 'hello' or hello.get('version') != PROTOCOL_VERSION:
+                connection.send({'type': 'error', 'error': f"Expected protocol version {PROTOCOL_VERSION}"})
+                return
+            worker = f"{hello.get('worker') or 'worker'}@{connection.peer}"
+            with self._lock:
+                self.workers.setdefault(worker, 0)
+            connection.send({'type': 'welcome', 'settings': self.settings.toConfig(), 'leaseSeconds': self.leaseSeconds})
+            while not self._stopped.is_set():
+                message = connection.receive()
+                kind = message.get('type')
+                if kind == 'lease':
+                    connection.send(self._lease(worker))
+                elif kind == 'result':
+                    self._report(worker, message.get('lease'), message.get('result'))
+                elif kind == 'renew':
+                    self._renew(worker)
+        except (OSError, ValueError, TypeError, KeyError):
+            pass  # gone, or not speaking the protocol: its batches are handed out again below
+        finally:
+            self._connections.discard(connection)
+            connection.close()
+            if worker is not None:
+                self._release(worker)
+
+    def _lease(self, worker):
+        with self._lock:
+            if self._cancelled:
+                return {'type': 'done'}
+            if self.control is not None and self.control.paused:
+                return {'type': 'wait', 'seconds': WAIT_SECONDS}
+            if not self._ready:
+                if self._fed and not self._byId:
+                    return {'type': 'done'}
+                return {'type': 'wait', 'seconds': WAIT_SECONDS}
+            batch = self._ready.popleft()
+            self._lock.notify_all()  # room for the feeder
+            lease_id = batch.ids[-1] if batch.attempts == 0 else next(self._ids)
+            if lease_id not in self._byId:
+                batch.ids.append(lease_id)
+                self._byId[lease_id] = batch
+            batch.worker = worker
+            batch.deadline = time.monotonic() + self.leaseSeconds
+            batch.attempts += 1
+            self._leased[lease_id] = batch
+        if self.onStart is not None and batch.attempts == 1:
+            for file_path in batch.paths:
+                self.onStart(file_path)
+        return {'type': 'batch', 'lease': lease_id, 'paths': batch.paths, 'firstIndex': batch.firstIndex}
+
+    def _report(self, worker, lease_id, result):
+        result = TagResult(**result)
+        with self._lock:
+            batch = self._byId.get(lease_id)
+            # Late results of a lease that expired still count, unless another worker already sent them
+            if batch is None or result.file_path not in batch.paths or result.file_path in batch.reported:
+                return
+            batch.reported.add(result.file_path)
+            self.workers[worker] = self.workers.get(worker, 0) + 1
+            self.results.put(result)
+            if batch.worker == worker:
+                batch.deadline = time.monotonic() + self.leaseSeconds
+            if len(batch.reported) == len(batch.paths):
+                self._finishBatch(batch)
+
+    def _finishBatch(self, batch):
+        for lease_id in batch.ids:
+            self._byId.pop(lease_id, None)
+            self._leased.pop(lease_id, None)
+        if batch in self._ready:
+            self._ready.remove(batch)
+
+    def _renew(self, worker):
+        deadline = time.monotonic() + self.leaseSeconds
+        with self._lock:
+            for batch in self._leased.values():
+                if batch.worker == worker:
+                    batch.deadline = deadline
+
+    def _release(self, worker):
+        # The worker is gone: its batches go back to the front of the queue
+        with self._lock:
+            for lease_id, batch in list(self._leased.items()):
+                if batch.worker == worker:
+                    self._requeue(lease_id, batch, "Worker disconnected")
+
+    def _expireLeases(self):
+        now = time.monotonic()
+        with self._lock:
+            for lease_id, batch in list(self._leased.items()):
+                if batch.deadline < now:
+                    self._requeue(lease_id, batch, f"Worker stopped responding for {self.leaseSeconds:g}s")
+            if self._cancelled:
+                # Batches nobody started are not handed out any more
+                while self._ready:
+                    batch = self._ready.popleft()
+                    for file_path in batch.paths:
+                        if file_path not in batch.reported:
+                            self.results.put(TagResult(file_path, 'cancelled'))
+                    self._finishBatch(batch)
+
+    def _requeue(self, lease_id, batch, reason):
+        del self._leased[lease_id]
+        batch.worker = None
+        if batch.attempts < MAX_ATTEMPTS:
+            self._ready.appendleft(batch)
+            return
+        for file_path in batch.paths:
+            if file_path not in batch.reported:
+                self.results.put(TagResult(file_path, 'failed', error=f"{reason} ({batch.attempts} attempts)",
+                                           failed_stage='worker'))
+        self._finishBatch(batch)
+
+
+def _connect(address, timeout):
+    # Retries until the coordinator is up, so workers can be started first
+    family, target = parseAddress(address)
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            if family == socket.AF_UNIX:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                try:
+                    sock.connect(target)
+                except OSError:
+                    sock.close()
+                    raise
+            else:
+                sock = socket.create_connection(target, timeout=10)
+                sock.settimeout(None)
+            return _Connection(sock)
+        except OSError:
+            if time.monotonic() >= deadline:
+                raise
+            time.sleep(0.5)
+
+
+def runWorker(address, localSettings=None, name=None, connectTimeout=30.0, onResult=None, prefetch=PREFETCH_LEASES):
+    """Tags the batches a Coordinator at address hands out until it has none left; returns the files tagged.
+
+    Every batch goes through one local TaggingEngine run built from the coordinator's settings, with the
+    LOCAL_FIELDS in localSettings (e.g. threadCount, executionMode) applied on top. Up to prefetch further
+    leases are taken while a batch is still being tagged, so the engine never runs dry between batches.
+    Results go back as each file finishes. The coordinator keeps the manifest, so the worker never skips or
+    records anything itself.
+    """
+    connection = _connect(address, connectTimeout)
+    name = name or f"{socket.gethostname()}-{os.getpid()}"
+    stopped = threading.Event()
+    engine = None
+    tagged = 0
+    try:
+        connection.send({'type': 'hello', 'worker': name, 'version': PROTOCOL_VERSION})
+        welcome = connection.receive()
+        if welcome.get('type') != 'welcome':
+            raise ValueError(welcome.get('error', "Unexpected reply from the coordinator"))
+        settings = TagSettings.fromConfig(welcome['settings'])
+        if settings.executionMode == 'distributed':
+            settings = settings.snapshot(executionMode='thread')
+        settings = settings.snapshot(**{key: value for key, value in (localSettings or {}).items()
+                                        if key in LOCAL_FIELDS and value is not None})
+        engine = TaggingEngine(settings)
+        engine.manifest = None
+        if engine.mode != 'process':
+            engine.sink = openArchiveSink(settings)  # one set of shards for every batch, not one per batch
+
+        def heartbeat():
+            while not stopped.wait(welcome['leaseSeconds'] / 3):
+                try:
+                    connection.send({'type': 'renew'})
+                except OSError:
+                    return
+        threading.Thread(target=heartbeat, name='Worker-heartbeat', daemon=True).start()
+
+        held = threading.Condition()
+        leases = {}  # lease id -> files of it without a result yet
+        leaseOf = {}  # path -> ids of the leases it came with, oldest first
+        paths = queue.Queue()
+
+        def fetch():
+            # Only this thread receives: the coordinator replies to lease requests and nothing else
+            try:
+                while not stopped.is_set():
+                    with held:
+                        while len(leases) > prefetch and not stopped.is_set():
+                            held.wait(0.5)
+                    if stopped.is_set():
+                        return
+                    connection.send({'type': 'lease'})
+                    reply = connection.receive()
+                    if reply['type'] == 'wait':
+                        stopped.wait(reply['seconds'])
+                        continue
+                    if reply['type'] != 'batch':
+                        return
+                    with held:
+                        leases[reply['lease']] = len(reply['paths'])
+                        for file_path in reply['paths']:
+                            leaseOf.setdefault(file_path, deque()).append(reply['lease'])
+                    for index, file_path in enumerate(reply['paths'], reply['firstIndex']):
+                        paths.put(IndexedPath(file_path, index))
+            except (OSError, ValueError):
+                pass  # the coordinator finished or went away
+            finally:
+                paths.put(None)
+
+        def source():
+            while True:
+                try:
+                    file_path = paths.get(timeout=0.1)
+                except queue.Empty:
+                    yield IDLE  # lets the engine hand out what finished while no new batch is in
+                    continue
+                if file_path is None:
+                    return
+                yield file_path
+
+        threading.Thread(target=fetch, name='Worker-lease', daemon=True).start()
+        for result in engine.run(source()):
+            with held:
+                lease_ids = leaseOf.get(result.file_path)
+                if not lease_ids:
+                    continue
+                lease_id = lease_ids.popleft()
+                if not lease_ids:
+                    del leaseOf[result.file_path]
+                leases[lease_id] -= 1
+                if not leases[lease_id]:
+                    del leases[lease_id]
+                    held.notify_all()
+            connection.send({'type': 'result', 'lease': lease_id, 'result': vars(result)})
+            tagged += 1
+            if onResult is not None:
+                onResult(result)
+        return tagged
+    except ConnectionError:
+        return tagged  # the coordinator finished or went away
+    finally:
+        stopped.set()
+        connection.close()
+        if engine is not None and engine.sink is not None:
+            engine.sink.close()
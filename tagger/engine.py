@@ -0,0 +1,592 @@
+import multiprocessing
+import multiprocessing.util
+import os
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, BrokenExecutor, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Optional
+
+from .archive import ARCHIVE_FORMATS, entrySize, openArchiveSink
+from .animation import isAnimationPath, tagAnimation
+from .autotune import ConcurrencyGate, ThroughputTuner, autoMaxThreads, availableCpuCount
+from .discovery import IDLE, FileDiscovery, scanImageEntries
+from .imaging import (FrameCounter, applyTextToImage, canEncode, downsizeImageToSmallestSide, encodeImage, encoderLabel,
+                      ensureGuiApplication, imageLoadError, imageReaderFor, loadImage, normalFormat, outputPathFor)
+from .instrumentation import stageClock
+from .largeimage import largeImageFormat, tagLargeImage
+from .manifest import TagManifest, contentHash
+from .scheduler import BatchControl, MemoryBudget, defaultMemoryBudget, estimateDecodedBytes
+from .template import TemplateValues, compileTemplate
+
+
+@dataclass
+class TagResult:
+    file_path: str
+    status: str  # 'success', 'failed', 'skipped' or 'cancelled'
+    output_path: Optional[str] = None  # the first output when several profiles are written
+    output_paths: Optional[list] = None  # every output, with active profiles
+    error: Optional[str] = None
+    source_size: Optional[int] = None
+    source_mtime_ns: Optional[int] = None
+    content_hash: Optional[str] = None
+    frame_allocations: Optional[int] = None  # full-frame pixel buffers decoded or resampled (see FrameCounter)
+    frame_copies: Optional[int] = None  # full-frame buffers that only copied or format-converted a frame
+    failed_stage: Optional[str] = None  # stage a failed file stopped in ('stat', 'decode', ..., 'write')
+    timings: Optional[dict] = None  # seconds per stage, only with settings.collectTimings
+    frames: Optional[int] = None  # frames tagged, for GIFs
+    archive: Optional[str] = None  # shard holding the outputs, with settings.outputArchive (see ArchiveSink)
+    encodings: Optional[list] = None  # [encoder label, bytes, encode seconds or None] per output (see encoderLabel)
+
+
+class IndexedPath(str):
+    # A path that brings its own {index} (e.g. from a distributed batch); plain paths count on from the one before
+
+    def __new__(cls, path, tagIndex):
+        self = super().__new__(cls, path)
+        self.tagIndex = tagIndex
+        return self
+
+    def __reduce__(self):
+        return IndexedPath, (str(self), self.tagIndex)
+
+
+def findImageFiles(folders, includeSubfolders=False):
+    for entry in scanImageEntries(folders, includeSubfolders):
+        yield entry.path
+
+
+def errorReason(error):
+    # OSErrors carry the file name; leave it out so the same cause groups together in reports
+    if isinstance(error, OSError) and error.strerror:
+        return error.strerror
+    return str(error)
+
+
+def tagFile(file_path, settings, index=0, sink=None):
+    # index is the file's position in the batch, for {index} in the tag text; with a sink (an ArchiveSink)
+    # the outputs go into its shards under their tagged/ paths instead of into files
+    source_size = source_mtime_ns = content_hash = None
+    clock = stageClock(settings.collectTimings)
+    stage = 'stat'
+    try:
+        # Stat before reading so a file that changes while it is being tagged is picked up next run
+        stat = os.stat(file_path)
+        source_size, source_mtime_ns = stat.st_size, stat.st_mtime_ns
+        if settings.incremental and settings.manifestContentHash:
+            content_hash = contentHash(file_path)
+
+        # Every profile's output is made from the same decode
+        stage = 'decode'
+        clock.reset()
+        counter = FrameCounter()
+        variants = settings.profileVariants()
+        values = TemplateValues(file_path, index)
+        texts = [compileTemplate(variant.customText).render(values) for variant, _ in variants]
+        frames = None
+        output_paths = []
+        encode_seconds = [None] * len(variants)  # only measured where each output is encoded on its own
+        large_format = None if isAnimationPath(file_path) else largeImageFormat(file_path, settings)
+        if large_format is not None:
+            # Streamed from the source file to the outputs; only the text band is decoded and encoded
+            if sink is None:
+                output_paths = tagLargeImage(file_path, large_format, variants, texts, counter, clock)
+                encoded = []
+            else:
+                encoded = tagLargeImage(file_path, large_format, variants, texts, counter, clock, spoolFolder=sink.folder)
+        elif isAnimationPath(file_path):
+            # Decoded frame by frame; the stage times are summed over frames that were tagged in parallel
+            encoded, frames, frame_timings = tagAnimation(imageReaderFor(file_path), variants, texts, counter)
+            for frame_stage, seconds in frame_timings.items():
+                clock.add(frame_stage, seconds)
+            clock.reset()
+        else:
+            image = loadImage(file_path, settings.decodeSettings(variants), counter=counter)
+            if image.isNull():
+                raise Exception(f"Failed to load image: {imageLoadError(file_path)}")
+            clock.lap(stage)
+            encoded = []
+            for position, (variant, profile) in enumerate(variants):
+                stage = 'scale'
+                scaled = downsizeImageToSmallestSide(image, variant.downsizeValue, counter) if variant.downsizeImage else image
+                clock.lap(stage)
+                stage = 'draw'
+                # Only a scaled copy or the last variant may draw on the decoded frame itself
+                inPlace = scaled is not image or position == len(variants) - 1
+                modifiedImage = applyTextToImage(scaled, variant, inPlace=inPlace, counter=counter, text=texts[position])
+                clock.lap(stage)
+
+                stage = 'encode'
+                started = time.perf_counter()
+                data = encodeImage(modifiedImage, outputPathFor(file_path, profile, variant.outputFormat), variant)
+                if data is None:
+                    raise Exception("Failed to save image: no encoder for this format")
+                encoded.append(data)
+                encode_seconds[position] = time.perf_counter() - started
+                clock.lap(stage)
+
+        stage = 'write'
+        archive = None
+        sizes = [entrySize(data) for data in encoded]
+        if sink is not None:
+            output_paths = [outputPathFor(file_path, profile, variant.outputFormat) for variant, profile in variants]
+            archive = sink.write(list(zip(output_paths, encoded)))
+            clock.lap(stage)
+        else:
+            for (variant, profile), data in zip(variants, encoded):
+                output_path = outputPathFor(file_path, profile, variant.outputFormat)
+                os.makedirs(os.path.dirname(output_path), exist_ok=True)
+                with open(output_path, 'wb') as f:
+                    f.write(data)
+                clock.lap(stage)
+                output_paths.append(output_path)
+        sizes = sizes or [os.path.getsize(path) for path in output_paths]
+        encodings = [[encoderLabel(path, variant), size, seconds]
+                     for path, (variant, _), size, seconds in zip(output_paths, variants, sizes, encode_seconds)]
+        return TagResult(file_path, 'success', output_paths[0], output_paths if len(output_paths) > 1 else None,
+                         source_size=source_size, source_mtime_ns=source_mtime_ns, content_hash=content_hash,
+                         frame_allocations=counter.allocations, frame_copies=counter.copies, timings=clock.timings,
+                         frames=frames, archive=archive, encodings=encodings)
+    except Exception as e:
+        return TagResult(file_path, 'failed', error=errorReason(e), source_size=source_size,
+                         source_mtime_ns=source_mtime_ns, failed_stage=stage, timings=clock.timings)
+
+
+def physicalCoreCount():
+    try:
+        import psutil
+        count = psutil.cpu_count(logical=False)
+        if count:
+            return count
+    except ImportError:
+        pass
+
+    logical = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+    try:
+        cores = set()
+        physical_id = None
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                key = key.strip()
+                if key == 'physical id':
+                    physical_id = value.strip()
+                elif key == 'core id':
+                    cores.add((physical_id, value.strip()))
+        if cores:
+            return max(1, min(len(cores), logical))
+    except OSError:
+        pass
+    return max(1, logical)
+
+
+def tagAdmitted(file_path, settings, budget=None, control=None, onStart=None, gate=None, index=0, sink=None):
+    # Waits while the batch is paused, for a slot under the (auto-tuned) concurrency limit and until the
+    # memory budget has room for this file, then tags it
+    if control is not None:
+        control.waitWhilePaused()
+        if control.cancelled:
+            return TagResult(file_path, 'cancelled')
+    if gate is not None and not gate.acquire(control):
+        return TagResult(file_path, 'cancelled')
+    try:
+        cost = estimateDecodedBytes(file_path, settings) if budget is not None else 0
+        if budget is not None and not budget.acquire(cost, control):
+            return TagResult(file_path, 'cancelled')
+        try:
+            if onStart is not None:
+                onStart(file_path)
+            return tagFile(file_path, settings, index, sink)
+        finally:
+            if budget is not None:
+                budget.release(cost)
+    finally:
+        if gate is not None:
+            gate.release()
+
+
+# Per-process state for the process pool: each worker owns its own QGuiApplication, settings copy and
+# archive shards, and shares the batch's memory budget and pause/cancel switches with the other workers
+_workerSettings = None
+_workerBudget = None
+_workerControl = None
+_workerSink = None
+
+
+def _initWorkerProcess(settings, budget=None, control=None):
+    global _workerSettings, _workerBudget, _workerControl, _workerSink
+    os.environ['QT_QPA_PLATFORM'] = 'offscreen'
+    ensureGuiApplication()
+    _workerSettings = settings
+    _workerBudget = budget
+    _workerControl = control
+    _workerSink = openArchiveSink(settings)
+    if _workerSink is not None:
+        # Closes the open shards when the pool shuts the worker down
+        multiprocessing.util.Finalize(None, _workerSink.close, exitpriority=10)
+
+
+def _tagChunk(paths, firstIndex=1):
+    results = []
+    index = firstIndex - 1
+    for file_path in paths:
+        index = getattr(file_path, 'tagIndex', index + 1)
+        results.append(tagAdmitted(file_path, _workerSettings, _workerBudget, _workerControl, index=index, sink=_workerSink))
+    return results
+
+
+def chunked(paths, size):
+    # An IDLE from a live source sends the partial chunk right away instead of waiting for it to fill up
+    chunk = []
+    for file_path in paths:
+        if file_path is IDLE:
+            if chunk:
+                yield chunk
+                chunk = []
+            yield IDLE
+            continue
+        chunk.append(file_path)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class TaggingEngine:
+    """Headless batch tagger: feed it paths, iterate over TagResults as files finish.
+
+    mode 'thread' tags on a thread pool inside this process; mode 'process' spreads chunks of
+    files over worker processes so decoding and painting are not serialised by the GIL; mode 'pipeline'
+    splits reading, rendering and writing into separately sized thread pools (see StagedPipeline); mode
+    'distributed' leases batches to worker processes on this or other machines over a socket (see Coordinator)
+    and tags nothing itself.
+
+    With settings.autoThreads (and no explicit threadCount) the thread and pipeline modes tune how many files
+    are tagged at once while they run (see ThroughputTuner); given a TuningStore, the level they settle on is
+    recorded per folder and processFolders starts the next run there.
+    """
+
+    def __init__(self, settings, threadCount=None, mode=None, processCount=None, chunkSize=None, manifest=None,
+                 progress=None, control=None, report=None, tuningStore=None):
+        self.settings = settings
+        self.progress = progress  # optional ProgressChannel that gets a record per status change
+        self.report = report  # optional RunReport that aggregates every result
+        self.mode = mode or settings.executionMode
+        if self.mode not in ('thread', 'process', 'pipeline', 'distributed'):
+            raise ValueError(f"Unknown execution mode: {self.mode}")
+        self.autoThreads = settings.autoThreads and not threadCount and self.mode in ('thread', 'pipeline')
+        # In auto mode the pool is sized for the tuner's upper bound and a ConcurrencyGate sets the actual level
+        self.threadCount = autoMaxThreads() if self.autoThreads else max(1, threadCount or settings.threadCount)
+        self.processCount = max(1, processCount or settings.processCount or physicalCoreCount())
+        self.chunkSize = max(1, chunkSize or settings.chunkSize)
+        self.readerThreads = max(1, settings.readerThreads)
+        self.writerThreads = max(1, settings.writerThreads)
+        # Work is submitted at most maxInFlight files (threads; per stage queue in the pipeline) or chunks
+        # (processes) ahead of the workers, and only starts once its estimated decoded size fits in the memory budget
+        default_window = self.processCount * 2 if self.mode == 'process' else self.threadCount * (2 if self.autoThreads else 4)
+        self.maxInFlight = max(1, settings.maxInFlight or default_window)
+        if settings.memoryBudgetMB > 0:
+            self.memoryBudgetBytes = settings.memoryBudgetMB * 1024 * 1024
+        else:
+            self.memoryBudgetBytes = defaultMemoryBudget()
+        self.variants = settings.profileVariants()  # raises ValueError for unknown or clashing profiles
+        for variant, _ in self.variants:
+            compileTemplate(variant.customText)  # raises ValueError for a bad tag text template
+            if variant.outputFormat and not canEncode(normalFormat(variant.outputFormat)):
+                raise ValueError(f"Can't write {variant.outputFormat} images (no Qt image plugin for it)")
+        if settings.outputArchive:
+            if settings.outputArchive not in ARCHIVE_FORMATS:
+                raise ValueError(f"Unknown archive format: {settings.outputArchive}")
+            if not settings.archiveFolder:
+                raise ValueError("Archive output needs an archive folder")
+        self.control = control or BatchControl(self._processContext() if self.mode == 'process' else None)
+        if manifest is None and settings.incremental:
+            manifest = TagManifest(settings.fingerprint(), settings.manifestContentHash)
+        self.manifest = manifest
+        self.tuningStore = tuningStore
+        self.tuningFolders = ()
+        self.tuner = None
+        self.discovery = None
+        self.pipeline = None
+        self.coordinator = None
+        self.sink = None  # an ArchiveSink kept open across runs (thread and pipeline modes); else one per run
+        self.firstIndex = 1  # {index} of the first file run() tags (IndexedPaths bring their own)
+
+    @property
+    def workerCount(self):
+        if self.tuner is not None:
+            return self.tuner.level
+        if self.mode == 'distributed':
+            return self.coordinator.workerCount if self.coordinator is not None else 0
+        return self.processCount if self.mode == 'process' else self.threadCount
+
+    def stageDepths(self):
+        # Items queued in front of each pipeline stage ({} outside pipeline mode)
+        return self.pipeline.depths() if self.pipeline is not None else {}
+
+    @staticmethod
+    def _processContext():
+        # spawn rather than fork: forking a process that already holds Qt state is not safe
+        return multiprocessing.get_context('spawn')
+
+    def pause(self):
+        self.control.pause()
+
+    def resume(self):
+        self.control.resume()
+        if self.tuner is not None:
+            self.tuner.resetWindow()  # a window that spans the pause would look like a slowdown
+
+    def cancel(self):
+        # Files not yet started come back as 'cancelled'; files already being tagged are finished
+        self.control.cancel()
+
+    def run(self, paths):
+        # paths may be plain paths or os.DirEntry objects (e.g. from FileDiscovery), whose cached stat is reused
+        runner = {'thread': self._runThreads, 'process': self._runProcesses, 'pipeline': self._runPipeline,
+                  'distributed': self._runDistributed}[self.mode]
+        if self.autoThreads:
+            runner = self._tuned(runner)
+        if self.progress is not None and hasattr(paths, '__len__'):
+            self.progress.setTotal(len(paths))
+        if self.manifest is None:
+            results = runner(item if item is IDLE else os.fspath(item) for item in paths)
+        else:
+            results = self._recordResults(runner(self._skipUpToDate(paths)))
+        if self.report is not None:
+            results = self._reportResults(results)
+        return results if self.progress is None else self._publishResults(results)
+
+    def _tuned(self, runner):
+        start = None
+        if self.tuningStore is not None and self.tuningFolders:
+            start = self.tuningStore.lookup(self.tuningFolders, self.mode)
+        self.tuner = ThroughputTuner(ConcurrencyGate(1), start or availableCpuCount(), self.threadCount)
+
+        def source(paths):
+            for item in paths:
+                if item is IDLE and not self.tuner.gate.active:
+                    # A watch waiting for new files: don't count the idle time against the current level
+                    self.tuner.resetWindow()
+                yield item
+
+        def run(paths):
+            try:
+                for result in runner(source(paths)):
+                    self.tuner.observe(result)
+                    yield result
+            finally:
+                best = self.tuner.best
+                if best is not None and self.tuningStore is not None and self.tuningFolders:
+                    try:
+                        self.tuningStore.record(self.tuningFolders, self.mode, best, self.tuner.samples[best])
+                    except OSError:
+                        pass
+        return run
+
+    def _reportResults(self, results):
+        try:
+            for result in results:
+                self.report.add(result)
+                yield result
+        finally:
+            self.report.finish()
+
+    def _publishResults(self, results):
+        try:
+            for result in results:
+                self.progress.push(result.file_path, result.status)
+                yield result
+        finally:
+            self.progress.close()
+
+    def _skipUpToDate(self, paths):
+        # Up-to-date files turn into 'skipped' results here; the runners pass them straight through
+        for item in paths:
+            if item is IDLE:
+                yield item
+                continue
+            file_path = os.fspath(item)
+            try:
+                stat = item.stat() if isinstance(item, os.DirEntry) else None
+            except OSError:
+                stat = None
+            if self.manifest.isUpToDate(file_path, stat):
+                variant, profile = self.variants[0]
+                yield TagResult(file_path, 'skipped', outputPathFor(file_path, profile, variant.outputFormat))
+            else:
+                yield file_path
+
+    def _recordResults(self, results):
+        try:
+            for result in results:
+                self.manifest.record(result)
+                yield result
+        finally:
+            self.manifest.save()
+
+    def _runThreads(self, paths):
+        ensureGuiApplication()
+        settings = self.settings.snapshot()
+        budget = MemoryBudget(self.memoryBudgetBytes)
+        sink = self.sink or openArchiveSink(settings)
+        pending = deque()
+        index = self.firstIndex - 1
+        with ThreadPoolExecutor(max_workers=self.threadCount) as executor:
+            try:
+                for file_path in paths:
+                    if isinstance(file_path, TagResult):
+                        yield file_path
+                        continue
+                    yield from self._waitWhilePaused(pending)
+                    if self.control.cancelled:
+                        break
+                    if file_path is IDLE:
+                        # Nothing new from a live source: hand out whatever finished in the meantime
+                        yield from self._drain(pending, timeout=0)
+                        continue
+                    index = getattr(file_path, 'tagIndex', index + 1)
+                    future = executor.submit(tagAdmitted, file_path, settings, budget, self.control, self._fileStarted,
+                                             self.tuner.gate if self.tuner is not None else None, index, sink)
+                    future.paths = (file_path,)
+                    pending.append(future)
+                    while len(pending) >= self.maxInFlight:
+                        yield from self._drain(pending)
+                yield from self._finish(pending)
+            finally:
+                for future in pending:
+                    future.cancel()
+                if sink is not None and sink is not self.sink:
+                    # Shards in use by still-running files are closed once those are done
+                    executor.shutdown()
+                    sink.close()
+
+    def _processPool(self, context):
+        # Each pool gets its own budget: a worker that died never gives back what it held
+        budget = MemoryBudget(self.memoryBudgetBytes, context)
+        return ProcessPoolExecutor(max_workers=self.processCount, mp_context=context, initializer=_initWorkerProcess,
+                                   initargs=(self.settings.snapshot(), budget, self.control))
+
+    def _runProcesses(self, paths):
+        context = self._processContext()
+        pending = deque()
+        index = self.firstIndex
+        executor = self._processPool(context)
+        try:
+            for chunk in chunked(paths, self.chunkSize):
+                if chunk is IDLE:
+                    yield from self._drain(pending, timeout=0)
+                    if self.control.cancelled:
+                        break
+                    continue
+                yield from (item for item in chunk if isinstance(item, TagResult))
+                chunk = [item for item in chunk if not isinstance(item, TagResult)]
+                if not chunk:
+                    continue
+                yield from self._waitWhilePaused(pending)
+                if self.control.cancelled:
+                    break
+                try:
+                    future = executor.submit(_tagChunk, chunk, index)
+                except BrokenExecutor:
+                    # A worker process died (a crashing image plugin, the OOM killer): the chunks that were in the
+                    # pool come back failed from _drain, and the rest of the batch goes to a new pool
+                    executor.shutdown(wait=False)
+                    executor = self._processPool(context)
+                    future = executor.submit(_tagChunk, chunk, index)
+                index += len(chunk)
+                future.paths = chunk
+                pending.append(future)
+                while len(pending) >= self.maxInFlight:
+                    yield from self._drain(pending)
+            yield from self._finish(pending)
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown()
+
+    def _runPipeline(self, paths):
+        from .pipeline import StagedPipeline  # imports TagResult from this module
+        ensureGuiApplication()
+        sink = self.sink or openArchiveSink(self.settings)
+        self.pipeline = StagedPipeline(self.settings.snapshot(), self.readerThreads, self.threadCount, self.writerThreads,
+                                       self.maxInFlight, MemoryBudget(self.memoryBudgetBytes), self.control,
+                                       self._fileStarted, self.tuner.gate if self.tuner is not None else None, sink)
+        try:
+            yield from self.pipeline.run(paths, self.firstIndex)
+        finally:
+            if sink is not None and sink is not self.sink:
+                sink.close()
+
+    def _runDistributed(self, paths):
+        from .distributed import Coordinator  # imports TaggingEngine from this module
+        if self.coordinator is None:
+            self.coordinator = Coordinator(self.settings.snapshot(), self.settings.coordinatorAddress, self.chunkSize,
+                                           self.settings.leaseSeconds, self.maxInFlight, self.control, self._fileStarted)
+        yield from self.coordinator.run(paths)
+
+    def _fileStarted(self, file_path):
+        if self.progress is not None:
+            self.progress.push(file_path, 'processing')
+
+    def _waitWhilePaused(self, pending):
+        # Keep handing out results of files that were already running while the batch is paused
+        while self.control.paused:
+            if pending:
+                yield from self._drain(pending, timeout=0.1)
+            else:
+                self.control.waitWhilePaused(0.1)
+
+    def _finish(self, pending):
+        if self.control.cancelled:
+            for future in list(pending):
+                if future.cancel():
+                    pending.remove(future)
+                    yield from (TagResult(file_path, 'cancelled') for file_path in future.paths)
+        while pending:
+            yield from self._drain(pending)
+
+    def processFolders(self, folders, includeSubfolders=False):
+        # Tagging starts with the first file found; the walk continues on a background thread and
+        # self.discovery.discovered is the running total while it does
+        self.tuningFolders = list(folders)
+        self.discovery = FileDiscovery(folders, includeSubfolders)
+        if self.progress is not None:
+            self.progress.trackDiscovery(self.discovery)
+        try:
+            yield from self.run(self.discovery)
+        finally:
+            self.discovery.cancel()
+
+    def watchFolders(self, folders, includeSubfolders=False, **options):
+        # Tags images as they land in the folders until cancel(); options go to FolderWatcher, which is
+        # self.discovery while it runs (discovered = files handed out, settling = files still being written)
+        from .watch import FolderWatcher
+        self.tuningFolders = list(folders)
+        self.discovery = FolderWatcher(folders, includeSubfolders, **options)
+        if self.progress is not None:
+            self.progress.trackDiscovery(self.discovery)
+        try:
+            yield from self.run(self.discovery)
+        finally:
+            self.discovery.cancel()
+
+    @staticmethod
+    def _drain(pending, timeout=None):
+        done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+            pending.remove(future)
+            if future.cancelled():
+                yield from (TagResult(file_path, 'cancelled') for file_path in future.paths)
+                continue
+            try:
+                result = future.result()
+            except BrokenExecutor:
+                yield from (TagResult(file_path, 'failed', error="Worker process stopped unexpectedly",
+                                      failed_stage='worker') for file_path in future.paths)
+                continue
+            if isinstance(result, list):
+                yield from result
+            else:
+                yield result
@@ -0,0 +1,155 @@
+import struct
+
+from PyQt5.QtCore import Qt
+from PyQt5.QtGui import QImage, qAlpha
+
+# Qt reads GIFs but has no GIF writer, so frames are quantized with Qt and LZW-compressed here (GIF89a)
+MAX_CODE_BITS = 12
+QUANTIZE_FLAGS = Qt.ThresholdDither | Qt.AvoidDither
+
+
+def paletteFor(image, extraColors=()):
+    """Colour table for an Indexed8 conversion of image: exact when the image has at most 256 colours (GIF frames
+    do, before anything is drawn on them), Qt's fallback cube otherwise; extraColors are added while there is room."""
+    palette = list(image.convertToFormat(QImage.Format_Indexed8, QUANTIZE_FLAGS).colorTable())
+    for color in extraColors:
+        if len(palette) >= 256:
+            break
+        if color not in palette:
+            palette.append(color)
+    return palette
+
+
+def quantize(image, palette=None):
+    # Indexed8 copy of image, mapping every pixel to the nearest palette entry
+    if image.format() == QImage.Format_Indexed8:
+        return image
+    if palette is None:
+        return image.convertToFormat(QImage.Format_Indexed8, QUANTIZE_FLAGS)
+    return image.convertToFormat(QImage.Format_Indexed8, palette, QUANTIZE_FLAGS)
+
+
+def indexedPixels(image):
+    # The palette indices of an Indexed8 image, row by row without the scanline padding
+    width, height, stride = image.width(), image.height(), image.bytesPerLine()
+    bits = image.constBits()
+    bits.setsize(stride * height)
+    data = bytes(bits)
+    if stride == width:
+        return data
+    return b''.join(data[row * stride:row * stride + width] for row in range(height))
+
+
+def lzwCompress(pixels, minCodeSize):
+    """GIF-flavoured variable-width LZW: codes grow from minCodeSize + 1 bits up to 12, then the table is reset."""
+    clear = 1 << minCodeSize
+    end = clear + 1
+    code_size = minCodeSize + 1
+    next_code = end + 1
+    table = {}
+    out = bytearray()
+    accumulator, bit_count = clear, code_size
+    prefix = pixels[0]
+    for pixel in pixels[1:]:
+        key = (prefix << 8) | pixel
+        code = table.get(key)
+        if code is not None:
+            prefix = code
+            continue
+        accumulator |= prefix << bit_count
+        bit_count += code_size
+        while bit_count >= 8:
+            out.append(accumulator & 0xFF)
+            accumulator >>= 8
+            bit_count -= 8
+        if next_code < 4096:
+            table[key] = next_code
+            if next_code == 1 << code_size and code_size < MAX_CODE_BITS:
+                code_size += 1
+            next_code += 1
+        else:
+            # Table full: start over so the codes keep adapting to the image
+            accumulator |= clear << bit_count
+            bit_count += code_size
+            table.clear()
+            code_size = minCodeSize + 1
+            next_code = end + 1
+        prefix = pixel
+    for code in (prefix, end):
+        accumulator |= code << bit_count
+        bit_count += code_size
+        if code == prefix and next_code == 1 << code_size and code_size < MAX_CODE_BITS:
+            # The decoder adds one more entry after reading the last code and widens to match
+            code_size += 1
+    while bit_count > 0:
+        out.append(accumulator & 0xFF)
+        accumulator >>= 8
+        bit_count -= 8
+    return bytes(out)
+
+
+def _subBlocks(data):
+    blocks = [bytes((len(data[offset:offset + 255]),)) + data[offset:offset + 255] for offset in range(0, len(data), 255)]
+    return b''.join(blocks) + b'\0'
+
+
+def frameBlock(indexed, x=0, y=0, delay=0, disposal=1):
+    """One frame of an animation: graphic control extension, image descriptor, local colour table and pixels.
+
+    indexed is an Indexed8 QImage placed at (x, y) on the canvas; delay is in milliseconds. Pixels in a fully
+    transparent palette entry are written as transparent. Thread-safe, so frames can be encoded in parallel.
+    """
+    return compressedBlock(*frameParts(indexed, x, y, delay, disposal))
+
+
+def frameParts(indexed, x=0, y=0, delay=0, disposal=1):
+    # (headers and colour table, palette indices, LZW code size) of frameBlock, before the pure-Python
+    # compression: plain bytes, so compressedBlock can run in another process
+    palette = list(indexed.colorTable()) or [0xFF000000]
+    table_bits = max(1, (len(palette) - 1).bit_length())
+    transparent = next((index for index, color in enumerate(palette) if qAlpha(color) == 0), None)
+    control = struct.pack('<3sBHBB', b'\x21\xf9\x04', (disposal << 2) | (transparent is not None),
+                          round(delay / 10), transparent or 0, 0)
+    descriptor = struct.pack('<BHHHHB', 0x2C, x, y, indexed.width(), indexed.height(), 0x80 | (table_bits - 1))
+    colors = b''.join(struct.pack('BBB', (color >> 16) & 0xFF, (color >> 8) & 0xFF, color & 0xFF) for color in palette)
+    colors += b'\0' * (3 * (1 << table_bits) - len(colors))
+    return control + descriptor + colors, indexedPixels(indexed), max(2, table_bits)
+
+
+def compressedBlock(header, pixels, minCodeSize):
+    return header + bytes((minCodeSize,)) + _subBlocks(lzwCompress(pixels, minCodeSize))
+
+
+class GifEncoder:
+    """Assembles a GIF89a in memory from frame blocks added in display order.
+
+    loopCount follows QImageReader.loopCount(): -1 loops forever, 0 plays once, n repeats n more times.
+    """
+
+    def __init__(self, width, height, loopCount=0):
+        self.width = width
+        self.height = height
+        self.frames = 0
+        self._chunks = [b'GIF89a', struct.pack('<HHBBB', width, height, 0, 0, 0)]
+        if loopCount != 0:
+            self._chunks.append(b'\x21\xff\x0bNETSCAPE2.0' + struct.pack('<BBHB', 3, 1, max(0, loopCount), 0))
+
+    def add(self, block):
+        self._chunks.append(block)
+        self.frames += 1
+
+    def addImage(self, image, x=0, y=0, delay=0, disposal=1):
+        self.add(frameBlock(quantize(image), x, y, delay, disposal))
+
+    def finish(self):
+        self._chunks.append(b'\x3b')
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def encodeGif(image):
+    # A still image as a single-frame GIF
+    encoder = GifEncoder(image.width(), image.height())
+    encoder.addImage(image)
+    return encoder.finish()
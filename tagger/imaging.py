@@ -0,0 +1,254 @@
+import math
+import os
+import sys
+
+from PyQt5.QtCore import QBuffer, QByteArray, QCoreApplication, QIODevice, QRect, QSize, Qt
+from PyQt5.QtGui import QColor, QGuiApplication, QImage, QImageIOHandler, QImageReader, QImageWriter
+
+from .gifwriter import encodeGif
+from .overlay import COMPOSITE_FORMATS, cachedFont, compositeOverlay, defaultOverlayCache, relativeFontSize
+from .settings import OUTPUT_FOLDER_NAME
+
+_guiApplication = None
+
+# When downsizing, decoders that can scale while decoding (JPEG: 1/8 steps in the DCT domain) are asked for
+# at least this multiple of the target size, and a final SmoothTransformation pass does the rest. Measured on
+# a 35 MP test JPEG downsized to 800 px, the output differs from a full decode followed by
+# downsizeImageToSmallestSide by a mean of 0.55/255 per channel (99th percentile 9/255, only on sharp edges).
+DECODE_OVERSAMPLE = 2
+
+
+class FrameCounter:
+    """Counts the full-frame pixel buffers one file goes through.
+
+    allocations: buffers produced by decoding or resampling; copies: buffers that only duplicate or
+    format-convert an existing frame. A JPEG tagged without downsizing needs one allocation and no copies.
+    """
+
+    def __init__(self):
+        self.allocations = 0
+        self.copies = 0
+
+
+def _countAllocation(counter, image):
+    if counter is not None and not image.isNull():
+        counter.allocations += 1
+
+
+def ensureGuiApplication():
+    # Fonts and painting need a QGuiApplication; without a display fall back to the offscreen platform
+    global _guiApplication
+    app = QCoreApplication.instance()
+    if app is not None:
+        return app
+    if sys.platform.startswith('linux') and not (os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY')):
+        os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    _guiApplication = QGuiApplication(sys.argv[:1])
+    return _guiApplication
+
+
+# Extensions for converted outputs where the format name is not the usual one
+FORMAT_EXTENSIONS = {'jpeg': '.jpg', 'tiff': '.tif'}
+
+
+def outputPathFor(file_path, profile=None, outputFormat=''):
+    folder, name = os.path.split(file_path)
+    stem, extension = os.path.splitext(name)
+    output_format = normalFormat(outputFormat)
+    if output_format and imageFormatFor(file_path) not in (output_format, 'gif'):
+        # Converted copies keep the source's extension in front of their own (photo.png -> photo.png.jpg), so
+        # photo.png and photo.jpg don't end up in the same file; GIFs are animations and stay GIFs
+        extension += FORMAT_EXTENSIONS.get(output_format, '.' + output_format)
+    if profile is None:
+        return os.path.join(folder, OUTPUT_FOLDER_NAME, stem + extension)
+    return os.path.join(folder, OUTPUT_FOLDER_NAME, profile.outputFolder, stem + profile.suffix + extension)
+
+
+def normalFormat(image_format):
+    image_format = image_format.lower().lstrip('.')
+    return {'jpg': 'jpeg', 'tif': 'tiff'}.get(image_format, image_format)
+
+
+def canEncode(image_format):
+    return image_format == 'gif' or image_format.encode() in [bytes(name) for name in QImageWriter.supportedImageFormats()]
+
+
+def downsizedSize(width, height, downsizeValue):
+    smallest_side = min(width, height)
+    if smallest_side > downsizeValue:
+        scaling_factor = downsizeValue / smallest_side
+        return int(width * scaling_factor), int(height * scaling_factor)
+    return None
+
+
+def downsizeImageToSmallestSide(image, downsizeValue, counter=None):
+    new_size = downsizedSize(image.width(), image.height(), downsizeValue)
+    if new_size is not None:
+        image = image.scaled(new_size[0], new_size[1], Qt.KeepAspectRatio, Qt.SmoothTransformation)
+        _countAllocation(counter, image)
+    return image
+
+
+def reducedDecodeSize(width, height, target_width, target_height):
+    # Smallest M/8 decode (libjpeg's scaling steps) that still covers DECODE_OVERSAMPLE times the target;
+    # sizes are rounded down so the handler picks exactly that M and not the next step up
+    for eighths in range(1, 8):
+        decode_width, decode_height = width * eighths // 8, height * eighths // 8
+        if decode_width >= DECODE_OVERSAMPLE * target_width and decode_height >= DECODE_OVERSAMPLE * target_height:
+            return QSize(decode_width, decode_height)
+    return None
+
+
+def imageReaderFor(file_path, data=None):
+    # With data (the file's bytes, already read) decode from memory instead of opening the file again
+    if data is None:
+        return QImageReader(file_path)
+    buffer = QBuffer()
+    buffer.setData(QByteArray(data))
+    buffer.open(QIODevice.ReadOnly)
+    reader = QImageReader(buffer)
+    reader.buffer = buffer  # the reader does not own its device
+    # Pick the format handler now, while this thread holds the GIL: when read() does it with the GIL released,
+    # Qt probes the Python-owned buffer under its plugin loader lock and deadlocks against header reads elsewhere
+    reader.canRead()
+    return reader
+
+
+def imageFormatFor(file_path):
+    return normalFormat(os.path.splitext(file_path)[1])
+
+
+def encoderQuality(image_format, settings):
+    # QImageWriter quality for the encoder settings; -1 = Qt's default
+    if image_format == 'jpeg':
+        return settings.jpegQuality
+    if image_format == 'webp':
+        return settings.webpQuality
+    if image_format == 'png' and settings.pngCompression >= 0:
+        # Qt's PNG writer takes no zlib level, it turns quality q into level (100 - q) * 9 / 91
+        return 100 - math.ceil(min(settings.pngCompression, 9) * 91 / 9)
+    return -1
+
+
+def encoderLabel(file_path, settings):
+    # The format and encoder settings of an output, which the run report groups encode times and sizes by
+    image_format = imageFormatFor(file_path)
+    label = image_format
+    if image_format in ('jpeg', 'webp') and encoderQuality(image_format, settings) >= 0:
+        label += f" q{encoderQuality(image_format, settings)}"
+    if image_format == 'jpeg' and settings.jpegOptimize:
+        label += " optimized"
+    if image_format == 'png' and settings.pngCompression >= 0:
+        label += f" level {min(settings.pngCompression, 9)}"
+    return label
+
+
+def _withoutText(image):
+    # The same pixels (not copied) without the text metadata the encoders would write out; image must outlive it
+    bare = QImage(image.constBits(), image.width(), image.height(), image.bytesPerLine(), image.format())
+    bare.setColorTable(image.colorTable())
+    bare.setDotsPerMeterX(image.dotsPerMeterX())
+    bare.setDotsPerMeterY(image.dotsPerMeterY())
+    return bare
+
+
+def encodeImage(image, file_path, settings=None):
+    # Encode in memory in the format QImage.save would pick for file_path, with the encoder settings of
+    # settings (jpegQuality, pngCompression, ...; Qt's defaults without); None if Qt can't write it
+    image_format = imageFormatFor(file_path)
+    if image_format == 'gif':
+        return encodeGif(image)  # Qt has no GIF writer
+    source = image  # keeps the pixels of a _withoutText copy alive
+    if settings is not None and not settings.keepMetadata and image.textKeys():
+        image = _withoutText(source)
+    data = QByteArray()
+    buffer = QBuffer(data)
+    buffer.open(QIODevice.WriteOnly)
+    writer = QImageWriter(buffer, image_format.encode())
+    if settings is not None:
+        writer.setQuality(encoderQuality(image_format, settings))
+        writer.setOptimizedWrite(image_format == 'jpeg' and settings.jpegOptimize)
+    if not writer.write(image):
+        return None
+    buffer.close()
+    return bytes(data)
+
+
+def loadImage(file_path, settings, data=None, counter=None):
+    reader = imageReaderFor(file_path, data)
+    if not settings.downsizeImage or not reader.supportsOption(QImageIOHandler.ScaledSize):
+        image = reader.read()
+        _countAllocation(counter, image)
+        return image
+
+    # Read the header first and only decode as many pixels as the downsized output needs
+    size = reader.size()
+    target = downsizedSize(size.width(), size.height(), settings.downsizeValue) if size.isValid() else None
+    decode_size = reducedDecodeSize(size.width(), size.height(), *target) if target else None
+    if decode_size is not None:
+        reader.setScaledSize(decode_size)
+    image = reader.read()
+    _countAllocation(counter, image)
+    if decode_size is None or image.isNull() or (image.width(), image.height()) == target:
+        return image
+    # Resample to the exact size a full decode would have produced
+    image = image.scaled(target[0], target[1], Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+    _countAllocation(counter, image)
+    return image
+
+
+def imageLoadError(file_path, data=None):
+    # Only called after a failed load, so reading the file once more to get Qt's reason is fine
+    reader = imageReaderFor(file_path, data)
+    reader.read()
+    return reader.errorString()
+
+
+def textRectFor(width, height, settings):
+    return QRect(0, int((1 - settings.textYOffsetRatio) * height), width, int(settings.textYOffsetRatio * height))
+
+
+def drawText(painter, width, height, settings):
+    painter.setFont(cachedFont(settings.fontFamily, relativeFontSize(width, height, settings)))
+    painter.setPen(QColor(settings.textColor))
+    painter.drawText(textRectFor(width, height, settings), Qt.AlignCenter, settings.customText)
+
+
+def applyTextToImage(image, settings, overlayCache=None, inPlace=False, counter=None, text=None):
+    # The text only depends on the band geometry, so it is rendered once per batch and alpha-composited
+    # straight into the frame; the format is only converted when the source is not 32-bit already.
+    # With inPlace the caller gives up image, so an RGB32/ARGB32 premultiplied frame is drawn on without a copy.
+    # text is the rendered template for this file (see tagger.template); without it customText is drawn as is.
+    return applyTextToRows(image, 0, image.width(), image.height(), settings, overlayCache, inPlace, counter, text)
+
+
+def applyTextToRows(image, top, width, height, settings, overlayCache=None, inPlace=False, counter=None, text=None):
+    # applyTextToImage for image holding only the rows from top down of a width x height image, e.g. its text
+    # band or one strip of it (see tagger.largeimage); the text lands exactly where it would on the whole image
+    text = settings.customText if text is None else text
+    if image.format() not in COMPOSITE_FORMATS:
+        image = image.convertToFormat(QImage.Format_ARGB32_Premultiplied if image.hasAlphaChannel() else QImage.Format_RGB32)
+        if counter is not None:
+            counter.copies += 1
+    elif not inPlace:
+        image = QImage(image)  # shared copy; writing the band detaches it so the caller's image is left alone
+    textRect = textRectFor(width, height, settings)
+    if textRect.isEmpty() or not text:
+        return image
+
+    sprite = (overlayCache or defaultOverlayCache).sprite(
+        text, settings.fontFamily, relativeFontSize(width, height, settings),
+        settings.textColor, textRect.width(), textRect.height())
+    source_bits = int(image.constBits())
+    image = compositeOverlay(image, sprite, textRect.x(), textRect.y() - top)
+    if counter is not None and int(image.constBits()) != source_bits:
+        counter.copies += 1  # the frame was shared and writing the band detached it
+    return image
+
+
+def processImage(image, settings, inPlace=False, counter=None, text=None):
+    if settings.downsizeImage:
+        scaled = downsizeImageToSmallestSide(image, settings.downsizeValue, counter)
+        inPlace = inPlace or scaled is not image
+        image = scaled
+    return applyTextToImage(image, settings, inPlace=inPlace, counter=counter, text=text)
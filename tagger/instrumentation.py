@@ -0,0 +1,226 @@
+import csv
+import heapq
+import json
+import math
+import time
+from collections import Counter
+
+# Per-file stages in the order they run; 'read' is only separate in pipeline mode, elsewhere it is part of decode
+STAGES = ('read', 'decode', 'scale', 'draw', 'encode', 'write')
+
+
+class StageClock:
+    """Splits the time between laps into named stages (seconds, accumulated per stage)."""
+
+    def __init__(self):
+        self.timings = {}
+        self._last = time.perf_counter()
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        self.timings[stage] = self.timings.get(stage, 0.0) + now - self._last
+        self._last = now
+
+    def reset(self):
+        # Start the next stage from now, e.g. so time spent waiting in a pipeline queue is not counted
+        self._last = time.perf_counter()
+
+    def add(self, stage, seconds):
+        # Time measured elsewhere, e.g. summed over the frames of an animation
+        self.timings[stage] = self.timings.get(stage, 0.0) + seconds
+
+
+class _NullClock:
+    timings = None
+
+    def lap(self, stage):
+        pass
+
+    def reset(self):
+        pass
+
+    def add(self, stage, seconds):
+        pass
+
+
+NULL_CLOCK = _NullClock()
+
+
+def stageClock(enabled):
+    return StageClock() if enabled else NULL_CLOCK
+
+
+class LatencyHistogram:
+    """Fixed-memory histogram with log-spaced buckets (8 per doubling from 1 µs), so percentiles stay within
+    ~5% however many files are recorded."""
+    BUCKETS_PER_DOUBLING = 8
+    MIN_SECONDS = 1e-6
+
+    def __init__(self):
+        self.buckets = Counter()
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, seconds):
+        bucket = 0
+        if seconds > self.MIN_SECONDS:
+            bucket = int(math.log2(seconds / self.MIN_SECONDS) * self.BUCKETS_PER_DOUBLING)
+        self.buckets[bucket] += 1
+        self.count += 1
+        self.total += seconds
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = seconds if self.max is None else max(self.max, seconds)
+
+    def percentile(self, q):
+        if not self.count:
+            return None
+        rank = q / 100 * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                middle = self.MIN_SECONDS * 2 ** ((bucket + 0.5) / self.BUCKETS_PER_DOUBLING)
+                return min(max(middle, self.min), self.max)
+        return self.max
+
+    def summary(self):
+        if not self.count:
+            return None
+        return {
+            'count': self.count,
+            'mean': self.total / self.count,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+            'max': self.max,
+            'total': self.total,
+        }
+
+
+class RunReport:
+    """Aggregates the TagResults of a run: per-stage histograms, the slowest files and failure reasons.
+
+    Stage timings are only there when the run had settings.collectTimings on; statuses and errors always are, and
+    so are output sizes and encode times per encoder (format and settings, see encoderLabel).
+    """
+
+    def __init__(self, outliers=20, examplesPerError=5):
+        self.outliers = outliers
+        self.examplesPerError = examplesPerError
+        self.started = time.time()
+        self.elapsed = None
+        self.statuses = Counter()
+        self.frames = 0  # animation frames tagged
+        self.stages = {}
+        self.totals = LatencyHistogram()
+        self.errors = {}
+        self.encodings = {}  # encoder label -> {'outputs', 'bytes', 'encode': LatencyHistogram}
+        self._slowest = []
+        self._start = time.perf_counter()
+        self._sequence = 0
+
+    def add(self, result):
+        self.statuses[result.status] += 1
+        if result.frames and result.status == 'success':
+            self.frames += result.frames
+        if result.status == 'failed':
+            key = (result.failed_stage, result.error)
+            entry = self.errors.get(key)
+            if entry is None:
+                entry = self.errors[key] = {'stage': result.failed_stage, 'reason': result.error, 'count': 0, 'examples': []}
+            entry['count'] += 1
+            if len(entry['examples']) < self.examplesPerError:
+                entry['examples'].append(result.file_path)
+        if result.encodings and result.status == 'success':
+            for label, size, seconds in result.encodings:
+                entry = self.encodings.get(label)
+                if entry is None:
+                    entry = self.encodings[label] = {'outputs': 0, 'bytes': 0, 'encode': LatencyHistogram()}
+                entry['outputs'] += 1
+                entry['bytes'] += size
+                if seconds is not None:  # not measured for animations and band-only large images
+                    entry['encode'].add(seconds)
+        if result.timings and result.status == 'success':
+            total = 0.0
+            for stage, seconds in result.timings.items():
+                histogram = self.stages.get(stage)
+                if histogram is None:
+                    histogram = self.stages[stage] = LatencyHistogram()
+                histogram.add(seconds)
+                total += seconds
+            self.totals.add(total)
+            # Min-heap of the slowest files; the sequence number keeps ties from comparing dicts
+            self._sequence += 1
+            entry = (total, self._sequence, result.file_path, result.timings)
+            if len(self._slowest) < self.outliers:
+                heapq.heappush(self._slowest, entry)
+            elif total > self._slowest[0][0]:
+                heapq.heapreplace(self._slowest, entry)
+
+    def finish(self):
+        self.elapsed = time.perf_counter() - self._start
+
+    def summary(self):
+        elapsed = self.elapsed if self.elapsed is not None else time.perf_counter() - self._start
+        files = sum(self.statuses.values())
+        ordered = sorted(self.stages, key=lambda stage: STAGES.index(stage) if stage in STAGES else len(STAGES))
+        return {
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S%z', time.localtime(self.started)),
+            'elapsed': elapsed,
+            'files': files,
+            'filesPerSecond': files / elapsed if elapsed > 0 else None,
+            'frames': self.frames,
+            'framesPerSecond': self.frames / elapsed if elapsed > 0 and self.frames else None,
+            'statuses': dict(self.statuses),
+            'stages': {stage: self.stages[stage].summary() for stage in ordered},
+            'perFile': self.totals.summary(),
+            'slowest': [{'file': file_path, 'seconds': total, 'stages': timings}
+                        for total, _, file_path, timings in sorted(self._slowest, reverse=True)],
+            'errors': sorted(self.errors.values(), key=lambda entry: -entry['count']),
+            'encodings': {label: {'outputs': entry['outputs'], 'bytes': entry['bytes'],
+                                  'meanBytes': entry['bytes'] / entry['outputs'], 'encode': entry['encode'].summary()}
+                          for label, entry in sorted(self.encodings.items())},
+        }
+
+    def describeStages(self):
+        lines = []
+        for stage, summary in self.summary()['stages'].items():
+            lines.append(f"{stage:<7} p50 {summary['p50'] * 1000:8.2f} ms  p95 {summary['p95'] * 1000:8.2f} ms  "
+                         f"p99 {summary['p99'] * 1000:8.2f} ms  total {summary['total']:.2f} s")
+        return lines
+
+    def describeEncodings(self):
+        lines = []
+        for label, summary in self.summary()['encodings'].items():
+            line = f"{label:<18} {summary['outputs']:6d} outputs  mean {summary['meanBytes'] / 1024:9.1f} KB"
+            encode = summary['encode']
+            if encode:
+                line += (f"  encode p50 {encode['p50'] * 1000:8.2f} ms  p95 {encode['p95'] * 1000:8.2f} ms  "
+                         f"total {encode['total']:.2f} s")
+            lines.append(line)
+        return lines
+
+    def writeJson(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def writeCsv(self, path):
+        # One row per stage plus the per-file total; errors, outliers and encoder stats only fit the JSON report
+        summary = self.summary()
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['stage', 'count', 'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms', 'total_s'])
+            rows = list(summary['stages'].items()) + [('per_file', summary['perFile'])]
+            for stage, stats in rows:
+                if stats:
+                    writer.writerow([stage, stats['count']] +
+                                    [f"{stats[key] * 1000:.3f}" for key in ('mean', 'p50', 'p95', 'p99', 'max')] +
+                                    [f"{stats['total']:.3f}"])
+
+    def write(self, path):
+        if path.lower().endswith('.csv'):
+            self.writeCsv(path)
+        else:
+            self.writeJson(path)
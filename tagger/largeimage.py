@@ -0,0 +1,364 @@
+import os
+import struct
+import tempfile
+import zlib
+
+from PyQt5.QtGui import QImage
+
+from .imaging import applyTextToRows, imageFormatFor, imageReaderFor, outputPathFor, textRectFor
+from .instrumentation import NULL_CLOCK
+
+# Images of at least settings.largeImageMegapixels are tagged band-only: only the text band at the bottom is
+# decoded, drawn on and encoded again, and every other row goes from the source file to the output as it is
+HEADER_BYTES = 256 * 1024
+STREAM_CHUNK = 1024 * 1024
+# PNG rows above the band that are decoded at a time, when their filters don't let them be skipped
+PNG_STRIP_BYTES = 32 * 1024 * 1024
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# Chunks left out with keepMetadata off
+PNG_METADATA_CHUNKS = (b'tEXt', b'zTXt', b'iTXt', b'eXIf', b'tIME')
+
+
+def _bmpLayout(header):
+    # (pixel data offset, width, height, top-down, stride, row format) of an uncompressed 24- or 32-bit BMP;
+    # None for anything else (palettes, RLE, odd bit masks), which then takes the normal path
+    if len(header) < 70 or header[:2] != b'BM':
+        return None
+    offset, dib_size = struct.unpack_from('<II', header, 10)
+    if dib_size < 40:
+        return None
+    width, height, _, bits, compression = struct.unpack_from('<iiHHI', header, 18)
+    if width <= 0 or height == 0:
+        return None
+    if bits == 24 and compression == 0:
+        row_format = 'bgr'
+    elif bits == 32 and compression == 0:
+        row_format = 'bgrx'
+    elif bits == 32 and compression == 3 and struct.unpack_from('<III', header, 54) == (0xFF0000, 0xFF00, 0xFF):
+        alpha_mask = struct.unpack_from('<I', header, 66)[0] if dib_size >= 56 else 0
+        if alpha_mask not in (0, 0xFF000000):
+            return None
+        row_format = 'bgra' if alpha_mask else 'bgrx'
+    else:
+        return None
+    return offset, width, abs(height), height < 0, (width * bits + 31) // 32 * 4, row_format
+
+
+def _pngLayout(header):
+    # (width, height, bytes per pixel, colour type) of a non-interlaced 8-bit RGB or RGBA PNG, else None
+    if not header.startswith(PNG_SIGNATURE) or header[12:16] != b'IHDR':
+        return None
+    width, height, depth, color_type, _, _, interlace = struct.unpack_from('>IIBBBBB', header, 16)
+    if depth != 8 or color_type not in (2, 6) or interlace:
+        return None
+    return width, height, 3 if color_type == 2 else 4, color_type
+
+
+def _readHeader(file_path):
+    with open(file_path, 'rb') as f:
+        return f.read(HEADER_BYTES)
+
+
+def largeImageFormat(file_path, settings, data=None, size=None):
+    """'bmp' or 'png' if file_path is large enough to be tagged band-only (see tagLargeImage), else None.
+
+    Only reads the header (from data when given, which may be just the start of the file). Profiles that
+    downsize need the whole frame anyway, so with one of those active it is always None; so do images
+    converted to another format. JPEGs can't be spliced row by row and always take the normal path: their
+    output has to be encoded from the whole frame anyway, so decoding it in parts saves nothing.
+    """
+    if settings.largeImageMegapixels <= 0:
+        return None
+    if size is None:
+        size = imageReaderFor(file_path, data).size()
+    # abs(): Qt reports top-down BMPs with a negative height
+    if abs(size.width() * size.height()) < settings.largeImageMegapixels * 1000000:
+        return None
+    if any(variant.downsizeImage for variant, _ in settings.profileVariants()):
+        return None
+    header = data[:HEADER_BYTES] if data is not None else _readHeader(file_path)
+    image_format = None
+    if _bmpLayout(header) is not None:
+        image_format = 'bmp'
+    elif _pngLayout(header) is not None:
+        image_format = 'png'
+    if image_format is None or any(imageFormatFor(outputPathFor(file_path, profile, variant.outputFormat)) != image_format
+                                   for variant, profile in settings.profileVariants()):
+        return None
+    return image_format
+
+
+def estimateLargeImageBytes(width, height, settings, image_format):
+    # Peak memory of tagLargeImage, for the memory budget: the decoded band, its encoded rows and, for PNG,
+    # the filtered rows kept to decode it
+    return (height - textRectFor(width, height, settings).y()) * width * 4 * 3
+
+
+def _copyRange(source, target, start, end):
+    source.seek(start)
+    while start < end:
+        data = source.read(min(STREAM_CHUNK, end - start))
+        if not data:
+            raise Exception("Failed to read image: file is truncated")
+        target.write(data)
+        start += len(data)
+
+
+def _rowBytes(image, width, stride):
+    # image's rows trimmed to width bytes and padded with zeros to stride
+    bits = image.constBits()
+    bits.setsize(image.bytesPerLine() * image.height())
+    data = bytes(bits)
+    padding = b'\0' * (stride - width)
+    line = image.bytesPerLine()
+    return b''.join(data[row * line:row * line + width] + padding for row in range(image.height()))
+
+
+def _tagBmp(source, target, variant, text, counter, clock):
+    header = source.read(HEADER_BYTES)
+    offset, width, height, top_down, stride, row_format = _bmpLayout(header)
+    top = textRectFor(width, height, variant).y()
+    rows = height - top
+    # Bottom-up BMPs store the last rows first, so the band is right at the start of the pixel data
+    band_start = offset + (top * stride if top_down else 0)
+    pixel_end = offset + height * stride
+
+    # Let Qt decode a BMP holding only the band's rows, so it reads them exactly like the whole file
+    source.seek(band_start)
+    band_data = source.read(rows * stride)
+    if len(band_data) < rows * stride:
+        raise Exception("Failed to load image: file is truncated")
+    band_header = bytearray(header[:offset])
+    struct.pack_into('<I', band_header, 2, offset + len(band_data))
+    struct.pack_into('<i', band_header, 22, -rows if top_down else rows)
+    struct.pack_into('<I', band_header, 34, len(band_data))
+    band = QImage.fromData(bytes(band_header) + band_data, 'BMP')
+    if band.isNull():
+        raise Exception("Failed to load image: the text band could not be decoded")
+    if counter is not None:
+        counter.allocations += 1
+    del band_data
+    clock.lap('decode')
+
+    band = applyTextToRows(band, top, width, height, variant, inPlace=True, counter=counter, text=text)
+    clock.lap('draw')
+
+    if row_format == 'bgr':
+        band = band.convertToFormat(QImage.Format_RGB888).rgbSwapped()
+    else:
+        # Swapping red and blue, then storing bytewise as RGBA, gives BMP's B, G, R, A order on any platform
+        alpha = row_format == 'bgra'
+        band = band.convertToFormat(QImage.Format_ARGB32 if alpha else QImage.Format_RGB32).rgbSwapped()
+        band = band.convertToFormat(QImage.Format_RGBA8888 if alpha else QImage.Format_RGBX8888)
+    if not top_down:
+        band = band.mirrored(False, True)
+    encoded = _rowBytes(band, width * (3 if row_format == 'bgr' else 4), stride)
+    del band
+    clock.lap('encode')
+
+    # Header, palette and gaps as they are; then the pixel rows with the band swapped in; then whatever follows
+    _copyRange(source, target, 0, offset)
+    if top_down:
+        _copyRange(source, target, offset, band_start)
+        target.write(encoded)
+    else:
+        target.write(encoded)
+        _copyRange(source, target, offset + len(encoded), pixel_end)
+    source.seek(0, os.SEEK_END)
+    _copyRange(source, target, pixel_end, source.tell())
+    clock.lap('write')
+
+
+def _pngChunks(source):
+    # [(type, data offset, length)] of every chunk, without reading the data
+    chunks = []
+    source.seek(len(PNG_SIGNATURE))
+    while True:
+        head = source.read(8)
+        if len(head) < 8:
+            return chunks
+        length, kind = struct.unpack('>I4s', head)
+        chunks.append((kind, source.tell(), length))
+        source.seek(length + 4, os.SEEK_CUR)
+
+
+def _copyChunks(source, target, chunks, start, end, keepMetadata):
+    # The bytes from start to end as they are, or without the metadata chunks in that range
+    if keepMetadata:
+        _copyRange(source, target, start, end)
+        return
+    if start == 0:
+        target.write(PNG_SIGNATURE)
+    for kind, data_offset, length in chunks:
+        if start <= data_offset - 8 < end and kind not in PNG_METADATA_CHUNKS:
+            _copyRange(source, target, data_offset - 8, data_offset + length + 4)
+
+
+def _pngChunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+
+def _decodePngRows(header_chunks, width, color_type, previous, rows):
+    # Qt decodes filtered rows through a PNG made of just them; previous is the unfiltered row above them (or
+    # None when the first row does not refer to it), put in front as an unfiltered row and dropped again
+    row_length = 1 + width * (3 if color_type == 2 else 4)
+    data = (b'\0' + previous + rows) if previous is not None else bytes(rows)
+    count = len(data) // row_length
+    png = (PNG_SIGNATURE + _pngChunk(b'IHDR', struct.pack('>IIBBBBB', width, count, 8, color_type, 0, 0, 0)) +
+           header_chunks + _pngChunk(b'IDAT', zlib.compress(data, 0)) + _pngChunk(b'IEND', b''))
+    del data
+    image = QImage.fromData(png, 'PNG')
+    if image.isNull():
+        raise Exception("Failed to load image: the text band could not be decoded")
+    if previous is not None:
+        image = image.copy(0, 1, width, count - 1)
+    return image
+
+
+def _lastRow(image, color_type):
+    # The bottom row of a decoded PNG strip as PNG stores it unfiltered
+    row = image.copy(0, image.height() - 1, image.width(), 1)
+    row = row.convertToFormat(QImage.Format_RGB888 if color_type == 2 else QImage.Format_RGBA8888)
+    bits = row.constBits()
+    bits.setsize(row.width() * (3 if color_type == 2 else 4))
+    return bytes(bits)
+
+
+def _tagPng(source, target, variant, text, counter, clock):
+    width, height, channels, color_type = _pngLayout(source.read(HEADER_BYTES))
+    top = textRectFor(width, height, variant).y()
+    row_length = 1 + width * channels  # the filter type byte, then the pixels
+    chunks = _pngChunks(source)
+    idats = [chunk for chunk in chunks if chunk[0] == b'IDAT']
+    if not idats:
+        raise Exception("Failed to load image: no image data")
+    first_idat = idats[0][1] - 8
+    after_idats = idats[-1][1] + idats[-1][2] + 4
+    # Chunks that change how Qt reads the pixels (tRNS, gAMA, ...) go into every PNG made of part of the rows
+    header_chunks = b''
+    for kind, data_offset, length in chunks:
+        if data_offset >= first_idat:
+            break
+        if kind != b'IHDR':
+            source.seek(data_offset - 8)
+            header_chunks += source.read(length + 12)
+
+    compressor = zlib.compressobj(min(variant.pngCompression, 9))  # -1: zlib's default, as Qt's PNG writer uses
+    pending = bytearray()
+
+    def emit(data, final=False):
+        # Compressed data goes out in IDAT chunks of about STREAM_CHUNK bytes as it is produced
+        pending.extend(data)
+        while len(pending) >= STREAM_CHUNK or (final and pending):
+            target.write(_pngChunk(b'IDAT', bytes(pending[:STREAM_CHUNK])))
+            del pending[:STREAM_CHUNK]
+
+    _copyChunks(source, target, chunks, 0, first_idat, variant.keepMetadata)
+    # The rows above the band are passed on still filtered: each only refers to the rows above it, which don't
+    # change. Filters can refer to the row above, though, so to decode the band the filtered rows above it are
+    # kept from the last row that does not (filter None or Sub), or else decoded every PNG_STRIP_BYTES to carry
+    # just the last unfiltered row along.
+    decompressor = zlib.decompressobj()
+    buffer = bytearray()
+    kept = bytearray()
+    previous = None  # unfiltered row above kept, if its first row needs it
+    row = 0
+    for _, data_offset, length in idats:
+        source.seek(data_offset)
+        remaining = length
+        while remaining:
+            data = source.read(min(STREAM_CHUNK, remaining))
+            if not data:
+                raise Exception("Failed to load image: file is truncated")
+            remaining -= len(data)
+            while data:
+                buffer += decompressor.decompress(data, STREAM_CHUNK)
+                data = decompressor.unconsumed_tail
+                complete = min(len(buffer) // row_length, height - row)
+                if row < top:
+                    emit(compressor.compress(buffer[:min(complete, top - row) * row_length]))
+                for offset in range(0, complete * row_length, row_length):
+                    if row <= top and (row == 0 or buffer[offset] in (0, 1)):
+                        kept.clear()
+                        previous = None
+                    elif row < top and len(kept) >= PNG_STRIP_BYTES:
+                        previous = _lastRow(_decodePngRows(header_chunks, width, color_type, previous, kept), color_type)
+                        kept.clear()
+                        if counter is not None:
+                            counter.allocations += 1
+                    kept += buffer[offset:offset + row_length]
+                    row += 1
+                del buffer[:complete * row_length]
+    if row < height:
+        raise Exception("Failed to load image: image data is truncated")
+    clock.lap('read')
+
+    decoded = _decodePngRows(header_chunks, width, color_type, previous, kept)
+    kept.clear()
+    rows_above = decoded.height() - (height - top)
+    band = decoded if rows_above == 0 else decoded.copy(0, rows_above, width, height - top)
+    del decoded
+    if counter is not None:
+        counter.allocations += 1
+    clock.lap('decode')
+
+    band = applyTextToRows(band, top, width, height, variant, inPlace=True, counter=counter, text=text)
+    clock.lap('draw')
+
+    band = band.convertToFormat(QImage.Format_RGB888 if color_type == 2 else QImage.Format_RGBA8888)
+    line = band.bytesPerLine()
+    bits = band.constBits()
+    bits.setsize(line * band.height())
+    data = bytes(bits)
+    del band
+    # Band rows are stored unfiltered, so the first one does not depend on the (unchanged) row above it
+    for row in range(height - top):
+        emit(compressor.compress(b'\0' + data[row * line:row * line + width * channels]))
+    emit(compressor.flush(), final=True)
+    clock.lap('encode')
+    source.seek(0, os.SEEK_END)
+    _copyChunks(source, target, chunks, after_idats, source.tell(), variant.keepMetadata)
+    clock.lap('write')
+
+
+def _tagInto(file_path, image_format, output_path, target, variant, text, counter, clock):
+    with open(file_path, 'rb') as source:
+        (_tagBmp if image_format == 'bmp' else _tagPng)(source, target, variant, text, counter, clock)
+
+
+def tagLargeImage(file_path, image_format, variants, texts, counter=None, clock=NULL_CLOCK, spoolFolder=None):
+    """Tags a very large BMP or PNG without ever decoding the whole frame; returns the output paths.
+
+    BMP and PNG rows above the text band are streamed from the source to the output unchanged (PNG rows
+    still compressed, filters and all; the deflate stream is redone) and only the band is decoded, drawn on
+    and encoded, so memory use follows the size of the band. Ancillary data (BMP colour profiles, PNG
+    chunks) is kept as it is.
+
+    With spoolFolder nothing goes to the tagged/ folders: every variant is written to an anonymous temporary
+    file in spoolFolder and the open files, rewound, are returned instead, for ArchiveSink.write to copy into
+    a shard. The encoded images are never held in memory either way.
+    """
+    outputs = []
+    for (variant, profile), text in zip(variants, texts):
+        output_path = outputPathFor(file_path, profile, variant.outputFormat)
+        if spoolFolder is not None:
+            target = tempfile.TemporaryFile(dir=spoolFolder)
+            try:
+                _tagInto(file_path, image_format, output_path, target, variant, text, counter, clock)
+            except BaseException:
+                target.close()
+                raise
+            target.seek(0)
+            outputs.append(target)
+            continue
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        try:
+            with open(output_path, 'wb') as target:
+                _tagInto(file_path, image_format, output_path, target, variant, text, counter, clock)
+        except BaseException:
+            # Don't leave half an image behind: the output is written while the source is still being read
+            if os.path.exists(output_path):
+                os.remove(output_path)
+            raise
+        outputs.append(output_path)
+    return outputs
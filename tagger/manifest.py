@@ -0,0 +1,176 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+from .settings import OUTPUT_FOLDER_NAME
+
+MANIFEST_FILE_NAME = '.autotagger-manifest.json'
+MANIFEST_VERSION = 1
+
+
+def contentHash(file_path, data=None):
+    digest = hashlib.blake2b(digest_size=20)
+    if data is not None:
+        digest.update(data)
+        return digest.hexdigest()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class FolderManifest:
+    # Entries for every source file in one folder, stored next to the tagged copies in <folder>/tagged/
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.outputFolder = os.path.join(folder, OUTPUT_FOLDER_NAME)
+        self.path = os.path.join(self.outputFolder, MANIFEST_FILE_NAME)
+        self.entries = {}
+        self.dirty = False
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            if data.get('version') == MANIFEST_VERSION:
+                self.entries = data.get('files', {})
+        except Exception:
+            pass
+        # One listdir per output folder instead of a stat per output file when checking that tagged copies
+        # still exist; profiles write into subfolders of tagged/, listed the first time they are needed
+        self._listings = {}
+
+    def _listing(self, subfolder):
+        listing = self._listings.get(subfolder)
+        if listing is None:
+            try:
+                listing = set(os.listdir(os.path.join(self.outputFolder, subfolder)))
+            except OSError:
+                listing = set()
+            self._listings[subfolder] = listing
+        return listing
+
+    def hasOutput(self, relative_path):
+        subfolder, name = os.path.split(relative_path)
+        return name in self._listing(subfolder)
+
+    def addOutput(self, relative_path):
+        subfolder, name = os.path.split(relative_path)
+        self._listing(subfolder).add(name)
+
+    def save(self):
+        if not self.dirty:
+            return
+        os.makedirs(self.outputFolder, exist_ok=True)
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({'version': MANIFEST_VERSION, 'files': self.entries}, f)
+        os.replace(temp_path, self.path)
+        self.dirty = False
+
+
+class TagManifest:
+    """Remembers which sources were tagged with which settings so re-runs only process new or changed files.
+
+    A file is up to date when its size and mtime (or, with useContentHash, its contents) match the manifest
+    entry, it was tagged with the same settings fingerprint, and the tagged copy (or the archive shard holding
+    it) still exists.
+    """
+
+    def __init__(self, fingerprint, useContentHash=False, saveEvery=1000, saveInterval=30.0):
+        self.fingerprint = fingerprint
+        self.useContentHash = useContentHash
+        self.saveEvery = saveEvery
+        self.saveInterval = saveInterval  # also save this many seconds after the last save, for long-running watches
+        self._lastSave = time.monotonic()
+        self._folders = {}
+        self._shards = {}  # archive shard path -> exists
+        self._lock = threading.Lock()
+        self._unsaved = 0
+
+    def _folder(self, folder):
+        manifest = self._folders.get(folder)
+        if manifest is None:
+            manifest = self._folders[folder] = FolderManifest(folder)
+        return manifest
+
+    def isUpToDate(self, file_path, stat=None):
+        folder, name = os.path.split(file_path)
+        with self._lock:
+            manifest = self._folder(folder)
+            entry = manifest.entries.get(name)
+            if entry is None or entry.get('settings') != self.fingerprint:
+                return False
+            if 'archive' in entry:
+                if not self._shardExists(entry['archive']):
+                    return False
+            elif not all(manifest.hasOutput(output) for output in entry.get('outputs') or [entry.get('output', name)]):
+                return False
+        try:
+            stat = stat or os.stat(file_path)
+        except OSError:
+            return False
+        if entry.get('size') == stat.st_size and entry.get('mtime_ns') == stat.st_mtime_ns:
+            return True
+        if not (self.useContentHash and entry.get('hash') and entry.get('size') == stat.st_size):
+            return False
+        try:
+            unchanged = contentHash(file_path) == entry['hash']
+        except OSError:
+            return False
+        if unchanged:
+            with self._lock:
+                entry['mtime_ns'] = stat.st_mtime_ns
+                manifest.dirty = True
+        return unchanged
+
+    def _shardExists(self, path):
+        exists = self._shards.get(path)
+        if exists is None:
+            exists = self._shards[path] = os.path.exists(path)
+        return exists
+
+    def record(self, result):
+        if result.status != 'success' or result.source_size is None:
+            return
+        folder, name = os.path.split(result.file_path)
+        entry = {
+            'size': result.source_size,
+            'mtime_ns': result.source_mtime_ns,
+            'settings': self.fingerprint,
+        }
+        if result.content_hash:
+            entry['hash'] = result.content_hash
+        with self._lock:
+            manifest = self._folder(folder)
+            # Outputs are stored relative to tagged/; profiles write one per variant, possibly into subfolders
+            outputs = [os.path.relpath(path, manifest.outputFolder) for path in result.output_paths or [result.output_path]]
+            if len(outputs) == 1:
+                entry['output'] = outputs[0]
+            else:
+                entry['outputs'] = outputs
+            manifest.entries[name] = entry
+            if result.archive:
+                # Archived under the same names; the shard only gets this path once it is complete
+                # Absolute, so the next run finds it from whatever directory it starts in
+                entry['archive'] = os.path.abspath(result.archive)
+                self._shards.setdefault(entry['archive'], True)
+            else:
+                for output in outputs:
+                    manifest.addOutput(output)
+            manifest.dirty = True
+            self._unsaved += 1
+            save_now = self._unsaved >= self.saveEvery or time.monotonic() - self._lastSave >= self.saveInterval
+        if save_now:
+            self.save()
+
+    def save(self):
+        with self._lock:
+            self._unsaved = 0
+            self._lastSave = time.monotonic()
+            for manifest in self._folders.values():
+                try:
+                    manifest.save()
+                except OSError:
+                    pass
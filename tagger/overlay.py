@@ -0,0 +1,192 @@
+import threading
+from collections import OrderedDict
+
+from PyQt5.QtCore import QPointF, QRect, Qt
+from PyQt5.QtGui import QColor, QFont, QFontMetricsF, QImage, QPainter, QStaticText
+
+try:
+    import numpy as np
+except ImportError:  # compositing falls back to QPainter.drawImage
+    np = None
+
+# Formats whose pixels are 32-bit premultiplied BGRA in memory, so one "over" formula covers both
+COMPOSITE_FORMATS = (QImage.Format_RGB32, QImage.Format_ARGB32_Premultiplied)
+
+
+_fonts = threading.local()
+MAX_CACHED_FONTS = 64
+
+
+def cachedFont(fontFamily, fontSize):
+    # A QFont keeps what it resolved against the font database (family match, font engine), so reusing one
+    # saves the lookup on every draw; kept per thread, like the text layouts, as QFont is not thread-safe
+    fonts = _fonts.__dict__.setdefault('fonts', {})
+    font = fonts.get((fontFamily, fontSize))
+    if font is None:
+        if len(fonts) >= MAX_CACHED_FONTS:
+            fonts.clear()
+        font = fonts[(fontFamily, fontSize)] = QFont(fontFamily, fontSize)
+    return font
+
+
+def relativeFontSize(width, height, settings):
+    shortest_side = min(width, height)
+    return int(settings.fontSize * (shortest_side / 1000))
+
+
+class OverlaySprite:
+    """The tag text rendered once into a transparent ARGB32 premultiplied image the size of the text band.
+
+    Only the bounding box of the visible glyphs is kept for compositing; (left, top) is its offset in the band.
+    """
+
+    def __init__(self, image):
+        self.image = image
+        self.left = self.top = 0
+        self.pixels = None
+        self.inverseAlpha = None
+        if np is not None:
+            self._prepareArrays()
+
+    def _prepareArrays(self):
+        pixels = imageArray(self.image)
+        alpha = pixels[:, :, 3]
+        rows = np.flatnonzero(alpha.any(axis=1))
+        cols = np.flatnonzero(alpha.any(axis=0))
+        if rows.size == 0:
+            self.pixels = pixels[:0, :0]
+            self.inverseAlpha = self.pixels[:, :, 3].astype(np.uint16)
+            return
+        self.top, self.left = int(rows[0]), int(cols[0])
+        self.pixels = pixels[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1].astype(np.uint16)
+        self.inverseAlpha = (255 - self.pixels[:, :, 3])[:, :, None]
+
+    @property
+    def isEmpty(self):
+        return self.pixels is not None and self.pixels.size == 0
+
+
+class TextLayout:
+    """One string laid out in one font (a prepared QStaticText), drawn centred exactly like drawText(AlignCenter)."""
+
+    def __init__(self, text, fontFamily, fontSize):
+        self.font = cachedFont(fontFamily, fontSize)
+        self.staticText = QStaticText(text)
+        self.staticText.setTextFormat(Qt.PlainText)
+        self.staticText.prepare(font=self.font)
+        metrics = QFontMetricsF(self.font)
+        self.width = metrics.horizontalAdvance(text)
+        self.height = metrics.height()
+
+    def draw(self, painter, width, height):
+        painter.setFont(self.font)
+        painter.drawStaticText(QPointF((width - self.width) / 2, (height - self.height) / 2), self.staticText)
+
+
+class OverlayCache:
+    """LRU cache of rendered text sprites keyed by (text, font family, pixel size, colour, band size).
+
+    Underneath it keeps the text layouts keyed by (text, font family, pixel size), so a string that comes back
+    in another colour or band size, or after its sprite was evicted, is not laid out again. Layouts are kept per
+    thread: a QStaticText holds on to the font engines of the thread that prepared it and crashes elsewhere.
+    """
+
+    def __init__(self, maxEntries=32, maxLayouts=256):
+        self.maxEntries = maxEntries
+        self.maxLayouts = maxLayouts
+        self._sprites = OrderedDict()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.layoutHits = 0
+        self.layoutMisses = 0
+
+    def _layout(self, text, fontFamily, fontSize):
+        layouts = self._local.__dict__.setdefault('layouts', OrderedDict())
+        key = (text, fontFamily, fontSize)
+        layout = layouts.get(key)
+        if layout is not None:
+            layouts.move_to_end(key)
+            self.layoutHits += 1
+            return layout
+        self.layoutMisses += 1
+        layout = layouts[key] = TextLayout(text, fontFamily, fontSize)
+        if len(layouts) > self.maxLayouts:
+            layouts.popitem(last=False)
+        return layout
+
+    def sprite(self, text, fontFamily, fontSize, color, width, height):
+        key = (text, fontFamily, fontSize, color, width, height)
+        with self._lock:
+            sprite = self._sprites.get(key)
+            if sprite is not None:
+                self._sprites.move_to_end(key)
+                self.hits += 1
+                return sprite
+            self.misses += 1
+        # Rendered without the lock, so threads tagging different texts (a per-file template) don't wait on
+        # each other; layouts are per thread anyway. Two threads missing the same key keep the first sprite.
+        layout = self._layout(text, fontFamily, fontSize) if '\n' not in text else None
+        rendered = OverlaySprite(renderText(text, fontFamily, fontSize, color, width, height, layout))
+        with self._lock:
+            sprite = self._sprites.setdefault(key, rendered)
+            self._sprites.move_to_end(key)
+            if len(self._sprites) > self.maxEntries:
+                self._sprites.popitem(last=False)
+            return sprite
+
+    def clear(self):
+        with self._lock:
+            self._sprites.clear()
+        self._local.__dict__.pop('layouts', None)  # only this thread's; the others age out
+
+
+defaultOverlayCache = OverlayCache()
+
+
+def renderText(text, fontFamily, fontSize, color, width, height, layout=None):
+    sprite = QImage(width, height, QImage.Format_ARGB32_Premultiplied)
+    sprite.fill(Qt.transparent)
+    painter = QPainter(sprite)
+    painter.setPen(QColor(color))
+    if layout is not None:
+        layout.draw(painter, width, height)
+    else:
+        painter.setFont(cachedFont(fontFamily, fontSize))
+        painter.drawText(QRect(0, 0, width, height), Qt.AlignCenter, text)
+    painter.end()
+    return sprite
+
+
+def imageArray(image):
+    # Writable (height, width, 4) view onto the QImage's pixel buffer; detaches the image if it is shared
+    ptr = image.bits()
+    ptr.setsize(image.bytesPerLine() * image.height())
+    rows = np.ndarray((image.height(), image.bytesPerLine()), dtype=np.uint8, buffer=ptr)
+    return rows[:, :image.width() * 4].reshape(image.height(), image.width(), 4)
+
+
+def compositeOverlay(image, sprite, x, y):
+    if np is None or image.format() not in COMPOSITE_FORMATS:
+        painter = QPainter(image)
+        painter.drawImage(x, y, sprite.image)
+        painter.end()
+        return image
+    if sprite.isEmpty:
+        return image
+
+    # Clip the glyph box against the image (which may be a strip of a larger one, so x and y can be negative),
+    # then premultiplied "over": dst = src + dst * (255 - a) / 255
+    top, left = y + sprite.top, x + sprite.left
+    skip_rows, skip_cols = max(0, -top), max(0, -left)
+    top, left = top + skip_rows, left + skip_cols
+    height = min(sprite.pixels.shape[0] - skip_rows, image.height() - top)
+    width = min(sprite.pixels.shape[1] - skip_cols, image.width() - left)
+    if height <= 0 or width <= 0:
+        return image
+    dst = imageArray(image)[top:top + height, left:left + width]
+    blended = dst * sprite.inverseAlpha[skip_rows:skip_rows + height, skip_cols:skip_cols + width] + 128
+    blended = (blended + (blended >> 8)) >> 8
+    dst[...] = sprite.pixels[skip_rows:skip_rows + height, skip_cols:skip_cols + width] + blended
+    return image
@@ -0,0 +1,366 @@
+import os
+import queue
+import threading
+import time
+
+from .animation import isAnimationPath, tagAnimation
+from .archive import entrySize
+from .discovery import IDLE
+from .engine import TagResult, errorReason
+from .imaging import (FrameCounter, applyTextToImage, downsizeImageToSmallestSide, encodeImage, encoderLabel,
+                      imageLoadError, imageReaderFor, loadImage, outputPathFor)
+from .instrumentation import stageClock
+from .largeimage import HEADER_BYTES, largeImageFormat, tagLargeImage
+from .manifest import contentHash
+from .scheduler import estimateDecodedBytes
+from .template import TemplateValues, compileTemplate
+
+_DONE = object()
+_STOPPED = object()
+
+
+class _Stage:
+    # A pool of threads reading from one bounded queue; the last thread to finish closes the next stage
+    def __init__(self, name, threadCount, depth, work, downstream):
+        self.name = name
+        self.threadCount = max(1, threadCount)
+        self.queue = queue.Queue(max(1, depth))
+        self.work = work
+        self.downstream = downstream
+        self.gate = None  # optional ConcurrencyGate limiting how many of the threads work at once
+        self.busy = 0
+        self.running = self.threadCount
+        self.lock = threading.Lock()
+
+
+class _FileWork:
+    # One file's state as it moves from stage to stage
+    __slots__ = ('file_path', 'index', 'clock', 'counter', 'stat', 'data', 'cost', 'content_hash', 'outputs', 'frames',
+                 'large', 'encodeSeconds')
+
+    def __init__(self, file_path, index, clock):
+        self.file_path = file_path
+        self.index = index  # position in the batch, for {index} in the tag text
+        self.clock = clock
+        self.counter = FrameCounter()
+        self.stat = None
+        self.data = None  # source bytes until decoded
+        self.cost = 0
+        self.content_hash = None
+        self.outputs = []  # (output path, encoded bytes) per profile variant
+        self.frames = None  # frames tagged, for GIFs
+        self.large = None  # image format, for images tagged band-only (see tagger.largeimage)
+        self.encodeSeconds = None  # per output, where each is encoded on its own
+
+
+class StagedPipeline:
+    """Tags files in three stages connected by bounded queues, each with its own thread pool:
+
+    read    reader threads load each file's bytes (the only blocking reads from the source disk)
+    render  CPU workers decode from memory, draw the text and encode back to bytes
+    write   writer threads write batches of outputs, creating each output folder once (or add them to the
+            shards of an ArchiveSink)
+
+    depths() reports how many items wait in front of each stage: the stage with a full queue is the bottleneck.
+    """
+    WRITE_BATCH = 16
+
+    def __init__(self, settings, readerThreads, renderThreads, writerThreads, queueDepth, budget=None,
+                 control=None, onStart=None, gate=None, sink=None):
+        self.settings = settings
+        self.sink = sink
+        self.variants = settings.profileVariants()
+        self.decodeSettings = settings.decodeSettings(self.variants)
+        self.budget = budget
+        self.control = control
+        self.onStart = onStart
+        self.results = queue.Queue()
+        self.write = _Stage('write', writerThreads, queueDepth, self._writeBatch, None)
+        self.render = _Stage('render', renderThreads, queueDepth, self._render, self.write)
+        self.read = _Stage('read', readerThreads, queueDepth, self._read, self.render)
+        self.render.gate = gate
+        self._stages = (self.read, self.render, self.write)
+        self._createdFolders = set()
+        self._folderLock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def depths(self):
+        return {stage.name: stage.queue.qsize() for stage in self._stages}
+
+    def busy(self):
+        return {stage.name: stage.busy for stage in self._stages}
+
+    def describe(self):
+        return "  ".join(f"{stage.name} {stage.queue.qsize()}/{stage.queue.maxsize} queued, "
+                         f"{stage.busy}/{stage.threadCount} busy" for stage in self._stages)
+
+    def run(self, paths, firstIndex=1):
+        # paths may contain ready TagResults (e.g. skipped files); they are passed straight through
+        threads = [threading.Thread(target=self._feed, args=(paths, firstIndex), name='Pipeline-feed', daemon=True)]
+        for stage in self._stages:
+            threads += [threading.Thread(target=self._stageLoop, args=(stage,), name=f'Pipeline-{stage.name}-{i}',
+                                         daemon=True) for i in range(stage.threadCount)]
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                result = self.results.get()
+                if result is _DONE:
+                    return
+                yield result
+        finally:
+            self._stopped.set()
+            for thread in threads:
+                thread.join()
+
+    def _put(self, q, item):
+        while not self._stopped.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, q):
+        while not self._stopped.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _STOPPED
+
+    def _feed(self, paths, firstIndex):
+        index = firstIndex - 1
+        try:
+            for item in paths:
+                if self._stopped.is_set():
+                    return
+                if isinstance(item, TagResult):
+                    self.results.put(item)
+                    continue
+                if item is IDLE:
+                    continue
+                if self.control is not None:
+                    while not self.control.waitWhilePaused(0.1):
+                        if self._stopped.is_set():
+                            return
+                    if self.control.cancelled:
+                        return
+                index = getattr(item, 'tagIndex', index + 1)
+                if not self._put(self.read.queue, (index, item)):
+                    return
+        finally:
+            for _ in range(self.read.threadCount):
+                self._put(self.read.queue, _DONE)
+
+    def _stageLoop(self, stage):
+        try:
+            while True:
+                item = self._get(stage.queue)
+                if item is _DONE or item is _STOPPED:
+                    return
+                batch = [item]
+                if stage.downstream is None:
+                    # Writers take whatever else is already queued, up to WRITE_BATCH, in one go
+                    while len(batch) < self.WRITE_BATCH:
+                        try:
+                            item = stage.queue.get_nowait()
+                        except queue.Empty:
+                            break
+                        if item is _DONE:
+                            stage.queue.put(item)
+                            break
+                        batch.append(item)
+                # busy counts threads doing work, not threads blocked on a full downstream queue or the gate
+                if stage.gate is not None:
+                    stage.gate.acquire()
+                with stage.lock:
+                    stage.busy += 1
+                try:
+                    output = stage.work(batch) if stage.downstream is None else stage.work(batch[0])
+                except Exception as e:
+                    # A bug or an odd file fails the file at hand, not the thread: the stage keeps all its workers
+                    output = None
+                    for item in batch:
+                        self._failItem(item, e, stage.name)
+                finally:
+                    with stage.lock:
+                        stage.busy -= 1
+                    if stage.gate is not None:
+                        stage.gate.release()
+                if output is not None:
+                    self._put(stage.downstream.queue, output)
+        finally:
+            with stage.lock:
+                stage.running -= 1
+                last = stage.running == 0
+            if last:
+                if stage.downstream is None:
+                    self.results.put(_DONE)
+                else:
+                    for _ in range(stage.downstream.threadCount):
+                        self._put(stage.downstream.queue, _DONE)
+
+    def _fail(self, work, error, stage):
+        result = TagResult(work.file_path, 'failed', error=errorReason(error), failed_stage=stage,
+                           timings=work.clock.timings)
+        if work.stat is not None:
+            result.source_size, result.source_mtime_ns = work.stat.st_size, work.stat.st_mtime_ns
+        self.results.put(result)
+
+    def _failItem(self, item, error, stage):
+        # item as queued for the stage: a _FileWork, or (index, path) in front of the readers
+        if isinstance(item, _FileWork):
+            self._fail(item, error, stage)
+        else:
+            self.results.put(TagResult(item[1], 'failed', error=errorReason(error), failed_stage=stage))
+
+    def _proceed(self, file_path):
+        # Holds work already inside the pipeline while the batch is paused; False (and reported) once cancelled
+        if self.control is None:
+            return True
+        while not self.control.waitWhilePaused(0.1):
+            if self._stopped.is_set():
+                return False
+        if self.control.cancelled:
+            self.results.put(TagResult(file_path, 'cancelled'))
+            return False
+        return True
+
+    def _read(self, item):
+        index, file_path = item
+        if not self._proceed(file_path):
+            return None
+        work = _FileWork(file_path, index, stageClock(self.settings.collectTimings))
+        try:
+            with open(file_path, 'rb') as f:
+                work.stat = os.fstat(f.fileno())
+                if self.settings.largeImageMegapixels > 0 and not isAnimationPath(file_path):
+                    # Large images are streamed from the file by the render stage: only their header is read here
+                    work.data = f.read(HEADER_BYTES)
+                    work.large = largeImageFormat(file_path, self.settings, work.data)
+                    if work.large is None:
+                        f.seek(0)
+                        work.data = f.read()
+                else:
+                    work.data = f.read()
+        except OSError as e:
+            self._fail(work, e, 'read')
+            return None
+        work.clock.lap('read')
+        if self.budget is not None:
+            work.cost = estimateDecodedBytes(file_path, self.settings, work.data)
+            if not self.budget.acquire(work.cost, self.control):
+                self.results.put(TagResult(file_path, 'cancelled'))
+                return None
+        return work
+
+    def _render(self, work):
+        stage = 'decode'
+        try:
+            if not self._proceed(work.file_path):
+                return None
+            if self.onStart is not None:
+                self.onStart(work.file_path)
+            work.clock.reset()
+            if self.settings.incremental and self.settings.manifestContentHash:
+                work.content_hash = contentHash(work.file_path, None if work.large else work.data)
+            # Fill in the tag text while the source bytes (EXIF, header) are still in memory
+            values = TemplateValues(work.file_path, work.index, work.data)
+            texts = [compileTemplate(variant.customText).render(values) for variant, _ in self.variants]
+            if work.large is not None and self.sink is not None:
+                encoded = tagLargeImage(work.file_path, work.large, self.variants, texts, work.counter, work.clock,
+                                        spoolFolder=self.sink.folder)
+                work.data = values.data = None
+                work.outputs = [(outputPathFor(work.file_path, profile, variant.outputFormat), data)
+                                for (variant, profile), data in zip(self.variants, encoded)]
+                return work
+            if work.large is not None:
+                # Written by this stage as it is streamed from the source, so the writers have nothing left to do
+                output_paths = tagLargeImage(work.file_path, work.large, self.variants, texts, work.counter, work.clock)
+                work.data = values.data = None
+                work.outputs = [(output_path, None) for output_path in output_paths]
+                return work
+            if isAnimationPath(work.file_path):
+                encoded, work.frames, frame_timings = tagAnimation(imageReaderFor(work.file_path, work.data),
+                                                                   self.variants, texts, work.counter)
+                work.data = values.data = None
+                for frame_stage, seconds in frame_timings.items():
+                    work.clock.add(frame_stage, seconds)
+                work.outputs = [(outputPathFor(work.file_path, profile, variant.outputFormat), data)
+                                for (variant, profile), data in zip(self.variants, encoded)]
+                return work
+            image = loadImage(work.file_path, self.decodeSettings, work.data, work.counter)
+            if image.isNull():
+                raise Exception(f"Failed to load image: {imageLoadError(work.file_path, work.data)}")
+            work.data = values.data = None
+            work.clock.lap(stage)
+
+            work.encodeSeconds = [None] * len(self.variants)
+            for index, (variant, profile) in enumerate(self.variants):
+                stage = 'scale'
+                scaled = downsizeImageToSmallestSide(image, variant.downsizeValue, work.counter) if variant.downsizeImage else image
+                work.clock.lap(stage)
+                stage = 'draw'
+                inPlace = scaled is not image or index == len(self.variants) - 1
+                scaled = applyTextToImage(scaled, variant, inPlace=inPlace, counter=work.counter, text=texts[index])
+                work.clock.lap(stage)
+
+                stage = 'encode'
+                output_path = outputPathFor(work.file_path, profile, variant.outputFormat)
+                started = time.perf_counter()
+                data = encodeImage(scaled, output_path, variant)
+                if data is None:
+                    raise Exception("Failed to save image: no encoder for this format")
+                work.outputs.append((output_path, data))
+                work.encodeSeconds[index] = time.perf_counter() - started
+                work.clock.lap(stage)
+            return work
+        except Exception as e:
+            self._fail(work, e, stage)
+            return None
+        finally:
+            if self.budget is not None:
+                self.budget.release(work.cost)
+
+    def _writeOutputs(self, outputs):
+        for output_path, data in outputs:
+            if data is None:
+                continue  # already written (large images)
+            folder = os.path.dirname(output_path)
+            if folder not in self._createdFolders:
+                os.makedirs(folder, exist_ok=True)
+                with self._folderLock:
+                    self._createdFolders.add(folder)
+            with open(output_path, 'wb') as f:
+                f.write(data)
+
+    def _writeBatch(self, batch):
+        # Each file succeeds or fails on its own, so one bad file doesn't take the rest of the batch with it
+        for work in batch:
+            try:
+                result = self._writeWork(work)
+            except Exception as e:
+                self._fail(work, e, 'write')
+                continue
+            self.results.put(result)
+
+    def _writeWork(self, work):
+        work.clock.reset()
+        archive = None
+        sizes = [entrySize(data) if data is not None else os.path.getsize(output_path) for output_path, data in work.outputs]
+        if self.sink is not None:
+            archive = self.sink.write(work.outputs)
+        else:
+            self._writeOutputs(work.outputs)
+        work.clock.lap('write')
+        output_paths = [output_path for output_path, _ in work.outputs]
+        work.outputs = []
+        encodings = [[encoderLabel(output_path, variant), size, seconds] for output_path, (variant, _), size, seconds
+                     in zip(output_paths, self.variants, sizes, work.encodeSeconds or [None] * len(sizes))]
+        return TagResult(work.file_path, 'success', output_paths[0], output_paths if len(output_paths) > 1 else None,
+                         source_size=work.stat.st_size, source_mtime_ns=work.stat.st_mtime_ns,
+                         content_hash=work.content_hash, frame_allocations=work.counter.allocations,
+                         frame_copies=work.counter.copies, timings=work.clock.timings, frames=work.frames,
+                         archive=archive, encodings=encodings)
@@ -0,0 +1,112 @@
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Optional
+
+FINISHED_STATUSES = ('success', 'failed', 'skipped', 'cancelled')
+
+
+@dataclass
+class ProgressSnapshot:
+    completed: int
+    total: int
+    totalFinal: bool  # False while discovery is still finding files
+    succeeded: int
+    failed: int
+    skipped: int
+    cancelled: int
+    inFlight: int
+    elapsed: float
+    filesPerSecond: float
+    eta: Optional[float]  # seconds, None until the total is known and there is a rate
+
+    def describe(self):
+        total = f"{self.total}" if self.totalFinal else f"{self.total}+"
+        text = f"{self.completed}/{total}  {self.filesPerSecond:.1f} files/s"
+        if self.eta is not None:
+            minutes, seconds = divmod(int(self.eta + 0.5), 60)
+            text += f"  ETA {minutes}:{seconds:02d}"
+        if self.failed:
+            text += f"  {self.failed} failed"
+        if self.cancelled:
+            text += f"  {self.cancelled} cancelled"
+        return text
+
+
+class ProgressChannel:
+    """Batched status reporting shared by all workers of a run.
+
+    Workers call push(file_path, status) from any thread; that is a single deque.append, which needs no
+    lock. One consumer (a GUI timer, the CLI loop) calls drain() periodically to get the records since
+    the last drain and keeps the aggregate counters, so workers never contend on them.
+    """
+
+    def __init__(self, rateWindow=5.0):
+        self._records = deque()
+        self.rateWindow = rateWindow
+        self.started = time.monotonic()
+        self.total = 0
+        self.totalFinal = False
+        self.discovery = None
+        self.counts = dict.fromkeys(FINISHED_STATUSES, 0)
+        self.inFlight = 0
+        self.closed = False
+        self._recent = deque()  # (timestamp, completed) samples for the throughput window
+
+    def push(self, file_path, status):
+        self._records.append((file_path, status))
+
+    def setTotal(self, total, final=True):
+        self.total = total
+        self.totalFinal = final
+
+    def trackDiscovery(self, discovery):
+        self.discovery = discovery
+
+    def close(self):
+        # Called by the producer when the run is over (finished or cancelled): once the remaining records
+        # are drained, the total is whatever actually completed
+        self.closed = True
+
+    @property
+    def completed(self):
+        return sum(self.counts.values())
+
+    def drain(self, limit=None):
+        records = []
+        pop = self._records.popleft
+        while self._records and (limit is None or len(records) < limit):
+            records.append(pop())
+        for _, status in records:
+            if status == 'processing':
+                self.inFlight += 1
+            elif status in self.counts:
+                self.counts[status] += 1
+                if status not in ('skipped', 'cancelled'):
+                    self.inFlight = max(0, self.inFlight - 1)
+        return records
+
+    def snapshot(self):
+        now = time.monotonic()
+        completed = self.completed
+        if self.discovery is not None:
+            self.total = max(self.discovery.discovered, completed)
+            self.totalFinal = self.discovery.finished
+        total = max(self.total, completed)
+        if self.closed and not self._records:
+            self.total = total = completed
+            self.totalFinal = True
+
+        self._recent.append((now, completed))
+        while len(self._recent) > 2 and now - self._recent[0][0] > self.rateWindow:
+            self._recent.popleft()
+        window_start, window_completed = self._recent[0]
+        if now - window_start > 0.5:
+            rate = (completed - window_completed) / (now - window_start)
+        else:
+            rate = completed / (now - self.started) if now > self.started else 0.0
+        eta = (total - completed) / rate if self.totalFinal and not self.closed and rate > 0 else None
+
+        return ProgressSnapshot(completed, total, self.totalFinal, self.counts['success'], self.counts['failed'],
+                                self.counts['skipped'], self.counts['cancelled'], self.inFlight, now - self.started,
+                                rate, eta)
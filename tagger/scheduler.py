@@ -0,0 +1,129 @@
+import os
+import threading
+
+from PyQt5.QtGui import QImageIOHandler
+
+from .animation import framesInFlight, isAnimationPath
+from .imaging import downsizedSize, imageReaderFor, reducedDecodeSize
+from .largeimage import estimateLargeImageBytes, largeImageFormat
+
+# A file is charged for its decoded frame plus one full-size working copy (scaled or format-converted)
+PEAK_COPIES = 2
+BYTES_PER_PIXEL = 4
+# Charged when the header can't tell us the dimensions
+UNKNOWN_IMAGE_BYTES = 64 * 1024 * 1024
+
+
+def physicalMemoryBytes():
+    try:
+        import psutil
+        return psutil.virtual_memory().total
+    except ImportError:
+        pass
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return 8 * 1024 ** 3
+
+
+def defaultMemoryBudget():
+    return physicalMemoryBytes() // 2
+
+
+def estimateDecodedBytes(file_path, settings, data=None):
+    # Header-only read: QImageReader.size() does not decode any pixels
+    settings = settings.decodeSettings()
+    reader = imageReaderFor(file_path, data)
+    size = reader.size()
+    if not size.isValid():
+        return UNKNOWN_IMAGE_BYTES
+    width, height = size.width(), size.height()
+    if settings.downsizeImage and reader.supportsOption(QImageIOHandler.ScaledSize):
+        target = downsizedSize(width, height, settings.downsizeValue)
+        decode_size = reducedDecodeSize(width, height, *target) if target else None
+        if decode_size is not None:
+            width, height = decode_size.width(), decode_size.height()
+    large_format = None if isAnimationPath(file_path) else largeImageFormat(file_path, settings, data, size)
+    if large_format is not None:
+        return estimateLargeImageBytes(width, height, settings, large_format)
+    if isAnimationPath(file_path):
+        # Up to framesInFlight() frames are decoded at once, plus the last one to find the rows that changed
+        return width * height * BYTES_PER_PIXEL * PEAK_COPIES * (framesInFlight() + 1)
+    return width * height * BYTES_PER_PIXEL * PEAK_COPIES
+
+
+class BatchControl:
+    """Pause/resume/cancel switches for a running batch.
+
+    Pass a multiprocessing context to get primitives that worker processes can share.
+    """
+
+    def __init__(self, context=None):
+        factory = context or threading
+        self._running = factory.Event()
+        self._running.set()
+        self._cancelled = factory.Event()
+
+    @property
+    def paused(self):
+        return not self._running.is_set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def pause(self):
+        self._running.clear()
+
+    def resume(self):
+        self._running.set()
+
+    def cancel(self):
+        self._cancelled.set()
+        self._running.set()  # wake anything waiting on a pause so it can see the cancel
+
+    def waitWhilePaused(self, timeout=None):
+        # True once running (or cancelled); False if still paused after timeout
+        return self._running.wait(timeout)
+
+
+class MemoryBudget:
+    """Admits work while the estimated bytes of everything in flight stay under the budget.
+
+    A file larger than the whole budget is still admitted once nothing else is running, so a single
+    huge image can never stall the batch. Pass a multiprocessing context to share it between processes.
+    """
+
+    def __init__(self, budgetBytes, context=None):
+        self.budgetBytes = max(1, int(budgetBytes))
+        if context is None:
+            self._condition = threading.Condition()
+            self._state = [0, 0]
+        else:
+            self._condition = context.Condition()
+            self._state = context.Array('q', 2, lock=False)
+
+    @property
+    def usedBytes(self):
+        return self._state[0]
+
+    @property
+    def active(self):
+        return self._state[1]
+
+    def acquire(self, cost, control=None):
+        with self._condition:
+            while self._state[1] and self._state[0] + cost > self.budgetBytes:
+                if control is not None and control.cancelled:
+                    return False
+                self._condition.wait(0.25)
+            self._state[0] += cost
+            self._state[1] += 1
+            return True
+
+    def release(self, cost):
+        with self._condition:
+            self._state[0] -= cost
+            self._state[1] -= 1
+            self._condition.notify_all()
+
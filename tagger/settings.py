@@ -0,0 +1,276 @@
+import hashlib
+import json
+import os
+import platform
+import threading
+import time
+from dataclasses import asdict, dataclass, field, fields, replace
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif')
+OUTPUT_FOLDER_NAME = "tagged"
+
+# Settings that change how a batch runs but not what ends up in the output files
+EXECUTION_FIELDS = frozenset((
+    'threadCount', 'executionMode', 'processCount', 'chunkSize', 'incremental', 'manifestContentHash',
+    'memoryBudgetMB', 'maxInFlight', 'readerThreads', 'writerThreads', 'collectTimings', 'autoThreads',
+    'largeImageMegapixels', 'coordinatorAddress', 'leaseSeconds', 'archiveShardMB',
+))
+
+# Settings a profile can override; execution settings always come from the batch
+PROFILE_FIELDS = ('fontFamily', 'fontSize', 'customText', 'textColor', 'textYOffsetRatio', 'downsizeImage', 'downsizeValue',
+                  'outputFormat', 'jpegQuality', 'jpegOptimize', 'webpQuality', 'pngCompression', 'keepMetadata')
+
+# Encoder settings only count towards the fingerprint once they are changed, so manifests written before they
+# existed stay valid
+ENCODER_FIELDS = ('outputFormat', 'jpegQuality', 'jpegOptimize', 'webpQuality', 'pngCompression', 'keepMetadata')
+
+
+def defaultConfigPath():
+    # Determine config path based on platform
+    if platform.system() == 'Windows':
+        return os.path.join(os.getenv('APPDATA'), 'AutoTagger', 'config.json')
+    return os.path.join(os.path.expanduser('~'), '.config', 'AutoTagger', 'config.json')
+
+
+@dataclass
+class TagSettings:
+    """Everything a worker needs to tag one image; plain data so it can be copied into threads and processes."""
+    fontFamily: str = 'Arial'
+    fontSize: int = 30
+    customText: str = 'Sample Text'
+    textColor: str = '#FFFFFF'
+    textYOffsetRatio: float = 0.1
+    downsizeImage: bool = False
+    downsizeValue: int = 800
+    outputFormat: str = ''  # 'jpeg', 'png', 'webp', ...: write this format instead of the source's (GIFs stay GIFs)
+    jpegQuality: int = -1  # 0-100; -1 = Qt's default (75)
+    jpegOptimize: bool = False  # optimised Huffman tables: a few percent smaller, slower to encode
+    webpQuality: int = -1  # 0-100 (100 = lossless); -1 = Qt's default
+    pngCompression: int = -1  # zlib level 0-9 (0 = fastest, largest); -1 = Qt's default (6)
+    keepMetadata: bool = True  # carry text metadata (PNG text chunks, JPEG comments) over to the tagged copies
+    threadCount: int = 10
+    autoThreads: bool = True  # tune the thread count while a batch runs; off = use threadCount as set
+    executionMode: str = 'thread'  # 'thread', 'process', 'pipeline' or 'distributed'
+    processCount: int = 0  # 0 = one worker process per physical core
+    chunkSize: int = 8
+    incremental: bool = True  # skip files whose manifest entry says the output is up to date
+    manifestContentHash: bool = False  # also hash source contents so touched-but-unchanged files are skipped
+    memoryBudgetMB: int = 0  # estimated decoded bytes allowed in flight; 0 = half the physical memory
+    maxInFlight: int = 0  # files (threads) or chunks (processes) submitted ahead; 0 = 4 per worker
+    readerThreads: int = 4  # pipeline mode: threads reading source files; threadCount renders
+    writerThreads: int = 2  # pipeline mode: threads writing tagged files; with outputArchive, shards written at once
+    outputArchive: str = ''  # 'tar' or 'zip': write tagged copies into shards in archiveFolder instead of tagged/ folders
+    archiveFolder: str = ''
+    archiveShardMB: int = 1024  # a shard is closed and the next one started at this size
+    coordinatorAddress: str = '127.0.0.1:47800'  # distributed mode: where to listen for workers ('host:port' or 'unix:/path')
+    leaseSeconds: float = 120.0  # distributed mode: a batch whose worker is silent this long goes to another worker
+    collectTimings: bool = False  # time each stage of every file (TagResult.timings, RunReport)
+    largeImageMegapixels: int = 100  # tag images this large band-only (see tagger.largeimage); 0 = never
+    profiles: list = field(default_factory=list)  # named output variants as config dicts (see TagProfile)
+    activeProfiles: list = field(default_factory=list)  # profiles a batch writes; empty = the single tagged/ copy
+
+    @classmethod
+    def fromConfig(cls, config):
+        known = {f.name for f in fields(cls)}
+        return cls(**{key: value for key, value in config.items() if key in known})
+
+    def toConfig(self):
+        return asdict(self)
+
+    def snapshot(self, **changes):
+        return replace(self, **changes)
+
+    def profileVariants(self):
+        # (settings, profile) for every output of a file: each active profile applied on top of these settings,
+        # or just (self, None) without active profiles
+        if not self.activeProfiles:
+            return [(self, None)]
+        known = {config.get('name'): config for config in self.profiles}
+        variants = []
+        destinations = {}
+        for name in self.activeProfiles:
+            if name not in known:
+                raise ValueError(f"Unknown profile: {name}")
+            profile = TagProfile.fromConfig(known[name])
+            destination = (profile.outputFolder, profile.suffix)
+            if destination in destinations:
+                raise ValueError(f"Profiles {destinations[destination]} and {name} write to the same files")
+            destinations[destination] = name
+            variants.append((self.snapshot(**profile.overrides), profile))
+        return variants
+
+    def decodeSettings(self, variants=None):
+        # One decode serves every variant, so it is only reduced as far as the largest of them allows
+        variants = variants or self.profileVariants()
+        if variants[0][1] is None:
+            return self
+        if not all(variant.downsizeImage for variant, _ in variants):
+            return self.snapshot(downsizeImage=False)
+        return self.snapshot(downsizeImage=True, downsizeValue=max(variant.downsizeValue for variant, _ in variants))
+
+    def fingerprint(self):
+        defaults = TagSettings()
+        output_settings = {key: value for key, value in asdict(self).items()
+                           if key not in EXECUTION_FIELDS and key not in ('profiles', 'activeProfiles')
+                           and not (key in ENCODER_FIELDS and value == getattr(defaults, key))}
+        if output_settings.get('archiveFolder'):
+            # The same folder reached from another directory is the same output
+            output_settings['archiveFolder'] = os.path.abspath(output_settings['archiveFolder'])
+        if self.activeProfiles:
+            # Only the profiles being written count, so editing an unused one leaves the manifest valid
+            output_settings['profiles'] = [profile.toConfig() for _, profile in self.profileVariants()]
+        return hashlib.sha1(json.dumps(output_settings, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+@dataclass
+class TagProfile:
+    """A named output variant: overrides of PROFILE_FIELDS plus where its copies go.
+
+    Copies are written to <source folder>/tagged/<outputFolder>/<name><suffix><ext>, <ext> being that of an
+    outputFormat override if there is one; outputFolder defaults to the profile name and always stays inside
+    tagged/, so discovery and watches never pick the copies up again.
+    """
+    name: str
+    overrides: dict = field(default_factory=dict)
+    outputFolder: str = ''
+    suffix: str = ''
+
+    @classmethod
+    def fromConfig(cls, config):
+        name = config.get('name')
+        if not name:
+            raise ValueError("Profiles need a name")
+        output_folder = os.path.normpath(config.get('outputFolder') or name)
+        if os.path.isabs(output_folder) or output_folder.split(os.sep)[0] == os.pardir:
+            raise ValueError(f"Profile {name}: outputFolder must stay inside {OUTPUT_FOLDER_NAME}/")
+        overrides = {key: config[key] for key in PROFILE_FIELDS if key in config}
+        return cls(name, overrides, '' if output_folder == os.curdir else output_folder, config.get('suffix', ''))
+
+    def toConfig(self):
+        return {'name': self.name, **self.overrides, 'outputFolder': self.outputFolder, 'suffix': self.suffix}
+
+
+def backupConfigPath(path):
+    return path + '.bak'
+
+
+def _readConfig(path):
+    with open(path, 'r') as f:
+        config = json.load(f)
+    if not isinstance(config, dict):
+        raise ValueError(f"{path} does not hold a JSON object")
+    return config
+
+
+def loadConfigFile(path=None):
+    # A missing config means defaults; an unreadable or corrupt one falls back to the last-known-good copy
+    path = path or defaultConfigPath()
+    try:
+        return _readConfig(path)
+    except FileNotFoundError:
+        return {}
+    except Exception:
+        pass
+    try:
+        return _readConfig(backupConfigPath(path))
+    except Exception:
+        return {}
+
+
+def _writeAtomically(data, path):
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(temp_path, 'w') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+def saveConfigFile(config, path=None):
+    # Readers only ever see the old or the new file; once the new one is in place it also becomes the
+    # last-known-good copy that loadConfigFile falls back to
+    path = path or defaultConfigPath()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    data = json.dumps(config)
+    _writeAtomically(data, path)
+    _writeAtomically(data, backupConfigPath(path))
+
+
+class ConfigWriter:
+    """Coalesces config saves and writes them on a background thread once changes pause for `delay` seconds.
+
+    save() only stores the latest config, so it is cheap enough to call on every slider tick; flush() writes
+    anything still pending right away (call it before exiting).
+    """
+
+    def __init__(self, path=None, delay=0.5):
+        self.path = path
+        self.delay = delay
+        self.writes = 0
+        self.lastError = None
+        self._pending = None
+        self._due = 0.0
+        self._saved = 0  # sequence numbers, so an older config never overwrites a newer one
+        self._written = 0
+        self._finished = 0  # highest sequence whose write is over, whether it worked or not
+        self._condition = threading.Condition()
+        self._writeLock = threading.Lock()
+        self._thread = None
+
+    def save(self, config):
+        with self._condition:
+            self._saved += 1
+            self._pending = (self._saved, config)
+            self._due = time.monotonic() + self.delay
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='ConfigWriter', daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    def flush(self):
+        with self._condition:
+            pending, self._pending = self._pending, None
+            latest = self._saved
+        if pending is not None:
+            self._write(*pending)
+        # The background thread may have taken the latest config just before: wait for its write to end too
+        with self._condition:
+            while self._finished < latest:
+                self._condition.wait()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._pending is None:
+                    self._condition.wait()
+                remaining = self._due - time.monotonic()
+                if remaining > 0:
+                    self._condition.wait(remaining)
+                    continue
+                pending, self._pending = self._pending, None
+            self._write(*pending)
+
+    def _write(self, sequence, config):
+        try:
+            with self._writeLock:
+                if sequence <= self._written:
+                    return
+                try:
+                    saveConfigFile(config, self.path)
+                    self.lastError = None
+                except (OSError, TypeError, ValueError) as e:
+                    self.lastError = e
+                    return
+                self._written = sequence
+                self.writes += 1
+        finally:
+            with self._condition:
+                self._finished = max(self._finished, sequence)
+                self._condition.notify_all()
@@ -0,0 +1,201 @@
+import datetime
+import os
+import string
+import struct
+from functools import lru_cache
+
+from .imaging import imageReaderFor
+
+# Fields the tag text can use as {field} or {field:format}; dates take strftime formats, e.g. {date:%Y-%m-%d}
+TEMPLATE_FIELDS = {
+    'name': "file name without the extension",
+    'filename': "file name with the extension",
+    'ext': "extension without the dot",
+    'folder': "name of the folder the file is in",
+    'index': "position of the file in the batch, from 1",
+    'width': "image width in pixels",
+    'height': "image height in pixels",
+    'date': "capture date from EXIF, or the modification time",
+    'mtime': "file modification time",
+}
+
+# EXIF lives in the first APP1 segment (at most 64 KB) or, in PNGs, a chunk before the pixel data
+EXIF_HEADER_BYTES = 256 * 1024
+_EXIF_DATE_TAGS = (0x9003, 0x9004)  # DateTimeOriginal, DateTimeDigitized (Exif IFD)
+_TIFF_DATE_TAG = 0x0132  # DateTime (IFD0)
+_EXIF_IFD_TAG = 0x8769
+
+
+def _tiffDate(tiff):
+    # Capture date from a TIFF-structured EXIF block, or None
+    byte_order = {b'II': '<', b'MM': '>'}.get(tiff[:2])
+    if byte_order is None or struct.unpack_from(byte_order + 'H', tiff, 2)[0] != 42:
+        return None
+
+    def entries(offset):
+        count = struct.unpack_from(byte_order + 'H', tiff, offset)[0]
+        for index in range(count):
+            tag, kind, length, value = struct.unpack_from(byte_order + 'HHII', tiff, offset + 2 + index * 12)
+            yield tag, kind, length, value, offset + 2 + index * 12 + 8
+
+    def ascii(kind, length, value, value_offset):
+        if kind != 2:
+            return None
+        start = value_offset if length <= 4 else value
+        raw = tiff[start:start + length].split(b'\0')[0].decode('ascii', 'replace').strip()
+        try:
+            return datetime.datetime.strptime(raw, '%Y:%m:%d %H:%M:%S')
+        except ValueError:
+            return None
+
+    ifd0 = struct.unpack_from(byte_order + 'I', tiff, 4)[0]
+    fallback = None
+    for tag, kind, length, value, value_offset in entries(ifd0):
+        if tag == _TIFF_DATE_TAG:
+            fallback = ascii(kind, length, value, value_offset)
+        elif tag == _EXIF_IFD_TAG:
+            found = {}
+            for exif_tag, *entry in entries(value):
+                if exif_tag in _EXIF_DATE_TAGS:
+                    found[exif_tag] = ascii(*entry)
+            for date_tag in _EXIF_DATE_TAGS:
+                if found.get(date_tag):
+                    return found[date_tag]
+    return fallback
+
+
+def _exifBlock(header):
+    if header[:2] == b'\xff\xd8':
+        offset = 2
+        while offset + 4 <= len(header) and header[offset] == 0xFF:
+            marker = header[offset + 1]
+            length = struct.unpack_from('>H', header, offset + 2)[0]
+            if marker == 0xE1 and header[offset + 4:offset + 10] == b'Exif\0\0':
+                return header[offset + 10:offset + 2 + length]
+            if marker == 0xDA:  # start of scan: the pixel data follows
+                return None
+            offset += 2 + length
+    elif header[:8] == b'\x89PNG\r\n\x1a\n':
+        offset = 8
+        while offset + 8 <= len(header):
+            length, kind = struct.unpack_from('>I4s', header, offset)
+            if kind == b'eXIf':
+                return header[offset + 8:offset + 8 + length]
+            if kind == b'IDAT':
+                return None
+            offset += 12 + length
+    return None
+
+
+def exifCaptureDate(file_path, data=None):
+    """Capture date from a JPEG's or PNG's EXIF, reading only the file header; None if there is none."""
+    try:
+        if data is None:
+            with open(file_path, 'rb') as f:
+                header = f.read(EXIF_HEADER_BYTES)
+        else:
+            header = data[:EXIF_HEADER_BYTES]
+        block = _exifBlock(header)
+        return _tiffDate(block) if block else None
+    except (OSError, struct.error, IndexError):
+        return None
+
+
+class TemplateValues:
+    """Field values for one file, each worked out the first time the template asks for it."""
+
+    def __init__(self, file_path, index=0, data=None, size=None):
+        self.file_path = file_path
+        self.index = index
+        self.data = data  # source bytes, when already in memory
+        self.size = size  # (width, height), when already known
+        self._values = {}
+
+    @classmethod
+    def sample(cls, width, height, index=1):
+        # For images without a file (the clipboard preview) and for checking templates
+        values = cls(os.path.join('photos', 'IMG_0001.jpg'), index, size=(width, height))
+        now = datetime.datetime.now().replace(microsecond=0)
+        values._values.update(date=now, mtime=now)
+        return values
+
+    def get(self, field):
+        value = self._values.get(field)
+        if value is None:
+            value = self._values[field] = getattr(self, '_' + field)()
+        return value
+
+    def _name(self):
+        return os.path.splitext(os.path.basename(self.file_path))[0]
+
+    def _filename(self):
+        return os.path.basename(self.file_path)
+
+    def _ext(self):
+        return os.path.splitext(self.file_path)[1].lstrip('.')
+
+    def _folder(self):
+        return os.path.basename(os.path.dirname(os.path.abspath(self.file_path)))
+
+    def _index(self):
+        return self.index
+
+    def _imageSize(self):
+        if self.size is None:
+            size = imageReaderFor(self.file_path, self.data).size()  # header only
+            self.size = (size.width(), size.height()) if size.isValid() else (0, 0)
+        return self.size
+
+    def _width(self):
+        return self._imageSize()[0]
+
+    def _height(self):
+        return self._imageSize()[1]
+
+    def _date(self):
+        return exifCaptureDate(self.file_path, self.data) or self._mtime()
+
+    def _mtime(self):
+        return datetime.datetime.fromtimestamp(os.stat(self.file_path).st_mtime).replace(microsecond=0)
+
+
+class TextTemplate:
+    """Tag text parsed once into literal parts and {field} / {field:format} placeholders ({{ and }} for braces).
+
+    Raises ValueError for syntax errors, unknown fields and formats that do not fit the field.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.parts = []  # literal strings and (field, format spec) pairs
+        try:
+            parsed = list(string.Formatter().parse(text))
+        except ValueError as e:
+            raise ValueError(f"Bad tag text template {text!r}: {e}")
+        for literal, field, spec, conversion in parsed:
+            if literal:
+                self.parts.append(literal)
+            if field is None:
+                continue
+            if field not in TEMPLATE_FIELDS:
+                raise ValueError(f"Unknown field {{{field}}} in tag text; use one of: {', '.join(TEMPLATE_FIELDS)}")
+            if conversion:
+                raise ValueError(f"Conversions like {{{field}!{conversion}}} are not supported in tag text")
+            self.parts.append((field, spec or ''))
+        self.fields = frozenset(part[0] for part in self.parts if isinstance(part, tuple))
+        self.literal = ''.join(self.parts) if not self.fields else None
+        if self.fields:
+            try:
+                self.render(TemplateValues.sample(1, 1))
+            except (ValueError, TypeError) as e:
+                raise ValueError(f"Bad format in tag text {text!r}: {e}")
+
+    def render(self, values):
+        if self.literal is not None:
+            return self.literal
+        return ''.join(part if isinstance(part, str) else format(values.get(part[0]), part[1]) for part in self.parts)
+
+
+@lru_cache(maxsize=64)
+def compileTemplate(text):
+    return TextTemplate(text)
@@ -0,0 +1,314 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import queue
+import select
+import struct
+import sys
+import threading
+import time
+
+from .discovery import IDLE, isImageName, scanImageEntries
+from .settings import OUTPUT_FOLDER_NAME
+
+# inotify(7) event bits
+IN_MODIFY = 0x002
+IN_ATTRIB = 0x004
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+              IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+_EVENT = struct.Struct('iIII')
+
+# File systems where inotify does not see writes made by other machines
+NETWORK_FILESYSTEMS = ('nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'fuse.sshfs', 'afs', 'ceph', 'glusterfs', '9p')
+
+
+def mountFilesystem(path):
+    # Type of the file system `path` lives on, from the longest matching mount point in /proc/mounts
+    try:
+        with open('/proc/mounts') as f:
+            mounts = [line.split()[1:3] for line in f]
+    except OSError:
+        return None
+    path = os.path.realpath(path)
+    best, fs_type = '', None
+    for mount_point, mount_type in mounts:
+        mount_point = mount_point.replace('\\040', ' ')
+        if (path == mount_point or path.startswith(mount_point.rstrip('/') + '/')) and len(mount_point) > len(best):
+            best, fs_type = mount_point, mount_type
+    return fs_type
+
+
+class _Inotify:
+    # Minimal ctypes binding; raises OSError where inotify is unavailable or out of watches
+
+    def __init__(self):
+        if not sys.platform.startswith('linux'):
+            raise OSError(errno.ENOSYS, "inotify is only available on Linux")
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._addWatch = libc.inotify_add_watch
+        self._addWatch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+    def addWatch(self, path, mask=WATCH_MASK):
+        wd = self._addWatch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+        return wd
+
+    def read(self, timeout):
+        # [(wd, mask, name)] for the events that arrive within timeout seconds
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset + _EVENT.size <= len(data):
+            wd, mask, _, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FolderWatcher:
+    """Streams the images that land in (or change in) folders, once they have stopped changing.
+
+    Iterate over it like FileDiscovery; it runs until cancel(). Changes come from inotify where it works and
+    from rescanning every pollInterval seconds elsewhere (other platforms, network mounts, no watches left).
+    A file is handed out `quiet` seconds after its writer closed it (inotify) or once its size and mtime stayed
+    the same across two looks `settle` seconds apart. While nothing is ready it yields IDLE every `idle`
+    seconds so the engine can report results in between. `tagged/` output folders are never watched.
+
+    With initialScan, images already in the folders are handed out first; the manifest skips the tagged ones.
+    """
+
+    def __init__(self, folders, includeSubfolders=False, settle=2.0, quiet=0.2, pollInterval=2.0, idle=0.2,
+                 usePolling=None, initialScan=True):
+        self.folders = [os.path.abspath(folder) for folder in folders]
+        self.includeSubfolders = includeSubfolders
+        self.settle = settle
+        self.quiet = quiet
+        self.pollInterval = pollInterval
+        self.idle = idle
+        self.initialScan = initialScan
+        if usePolling is None:
+            usePolling = any(mountFilesystem(folder) in NETWORK_FILESYSTEMS for folder in self.folders)
+        self.usePolling = usePolling
+        self.discovered = 0  # files handed out so far
+        self.finished = False  # a watch never finishes on its own
+        self.rescans = 0
+        self._pending = {}  # path -> [due, (size, mtime_ns) at the last look, closed by its writer]
+        self._snapshot = {}  # polling: path -> (size, mtime_ns) at the last scan
+        self._queue = queue.Queue()
+        self._queued = set()
+        self._queueLock = threading.Lock()
+        self._cancelled = threading.Event()
+        self._thread = None
+        self._inotify = None
+        self._watches = {}  # inotify wd -> folder
+
+    @property
+    def backend(self):
+        return 'inotify' if self._inotify is not None else 'polling'
+
+    @property
+    def settling(self):
+        # Files seen changing that are not handed out yet
+        return len(self._pending)
+
+    @property
+    def queued(self):
+        return self._queue.qsize()
+
+    def start(self):
+        if self._thread is None:
+            if not self.usePolling:
+                try:
+                    self._inotify = _Inotify()
+                    for folder in self.folders:
+                        self._watchTree(folder)
+                except OSError:
+                    # e.g. not Linux, or fs.inotify.max_user_watches reached
+                    if self._inotify is not None:
+                        self._inotify.close()
+                    self._inotify = None
+                    self._watches.clear()
+            self._thread = threading.Thread(target=self._run, name='FolderWatcher', daemon=True)
+            self._thread.start()
+        return self
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def __iter__(self):
+        self.start()
+        while not self._cancelled.is_set():
+            try:
+                path = self._queue.get(timeout=self.idle)
+            except queue.Empty:
+                yield IDLE
+                continue
+            with self._queueLock:
+                self._queued.discard(path)
+            yield path
+
+    def _emit(self, path):
+        with self._queueLock:
+            if path in self._queued:
+                return
+            self._queued.add(path)
+        self.discovered += 1
+        self._queue.put(path)
+
+    def _watchTree(self, folder):
+        # Watches folder (and with includeSubfolders everything below it except output folders)
+        stack = [folder]
+        while stack:
+            path = stack.pop()
+            if os.path.basename(path) == OUTPUT_FOLDER_NAME:
+                continue
+            try:
+                wd = self._inotify.addWatch(path)
+            except OSError as e:
+                if e.errno in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                    continue
+                raise
+            self._watches[wd] = path
+            if not self.includeSubfolders:
+                continue
+            try:
+                with os.scandir(path) as entries:
+                    stack.extend(entry.path for entry in entries
+                                 if entry.name != OUTPUT_FOLDER_NAME and entry.is_dir(follow_symlinks=False))
+            except OSError:
+                continue
+
+    def _scan(self, folders):
+        for entry in scanImageEntries(folders, self.includeSubfolders):
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            yield entry.path, (stat.st_size, stat.st_mtime_ns)
+
+    def _run(self):
+        try:
+            if self.initialScan or self._inotify is None:
+                for path, signature in self._scan(self.folders):
+                    if self._cancelled.is_set():
+                        return
+                    if self._inotify is None:
+                        self._snapshot[path] = signature
+                    if self.initialScan:
+                        self._emit(path)
+            next_poll = time.monotonic() + self.pollInterval
+            while not self._cancelled.is_set():
+                now = time.monotonic()
+                due = min((entry[0] for entry in self._pending.values()), default=now + 1.0)
+                if self._inotify is None:
+                    due = min(due, next_poll)
+                    self._cancelled.wait(max(0.0, min(due - now, 1.0)))
+                    if time.monotonic() >= next_poll:
+                        self._poll()
+                        next_poll = time.monotonic() + self.pollInterval
+                else:
+                    self._readEvents(max(0.0, min(due - now, 1.0)))
+                self._checkPending()
+        finally:
+            if self._inotify is not None:
+                self._inotify.close()
+
+    def _touch(self, path, closed=False, signature=None):
+        entry = self._pending.get(path)
+        due = time.monotonic() + (self.quiet if closed else self.settle)
+        if entry is None:
+            self._pending[path] = [due, signature, closed]
+        else:
+            entry[0], entry[2] = due, closed
+            if signature is not None:
+                entry[1] = signature
+
+    def _readEvents(self, timeout):
+        for wd, mask, name in self._inotify.read(timeout):
+            if mask & IN_Q_OVERFLOW:
+                # The kernel dropped events: look at everything again; the manifest skips what is unchanged
+                self.rescans += 1
+                for path, _ in self._scan(self.folders):
+                    self._touch(path)
+                continue
+            folder = self._watches.get(wd)
+            if folder is None:
+                continue
+            if mask & (IN_IGNORED | IN_DELETE_SELF | IN_MOVE_SELF):
+                if mask & IN_IGNORED:
+                    del self._watches[wd]
+                continue
+            path = os.path.join(folder, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO) and self.includeSubfolders and name != OUTPUT_FOLDER_NAME:
+                    try:
+                        self._watchTree(path)
+                    except OSError:
+                        pass
+                    # Files written before the watch was added produced no events
+                    for image_path, _ in self._scan([path]):
+                        self._touch(image_path)
+                continue
+            if not isImageName(name):
+                continue
+            if mask & (IN_DELETE | IN_MOVED_FROM):
+                self._pending.pop(path, None)
+            else:
+                self._touch(path, closed=bool(mask & (IN_CLOSE_WRITE | IN_MOVED_TO)))
+
+    def _poll(self):
+        snapshot = dict(self._scan(self.folders))
+        for path, signature in snapshot.items():
+            if self._snapshot.get(path) != signature:
+                self._touch(path, signature=signature)
+        for path in self._pending.keys() - snapshot.keys():
+            del self._pending[path]
+        self._snapshot = snapshot
+
+    def _checkPending(self):
+        now = time.monotonic()
+        for path, entry in list(self._pending.items()):
+            due, signature, closed = entry
+            if due > now:
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                del self._pending[path]
+                continue
+            current = (stat.st_size, stat.st_mtime_ns)
+            if closed or current == signature:
+                del self._pending[path]
+                self._emit(path)
+            else:
+                # Still changing (or first look): check again after another settle period
+                entry[0], entry[1] = now + self.settle, current